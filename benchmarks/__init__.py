@@ -0,0 +1,8 @@
+"""
+Performance benchmarks.
+
+    python -m benchmarks.suite [ --check | --save ]
+
+`benchmarks.corpus` generates the query strings, `benchmarks.suite` times
+the parser on them and compares the results with `baseline.json`.
+"""
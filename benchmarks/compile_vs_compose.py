@@ -0,0 +1,43 @@
+"""
+Compare repeated `Query.compose()` with `CompiledQuery.render()`.
+
+    python benchmarks/compile_vs_compose.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import yaesql
+
+QUERIES = [
+    'foo',
+    'field1:foo OR bar',
+    'message:alpha AND omega OR field1:(-bar -foo)',
+    'NOT (a OR b) c:>=10 +x -r"y.*" field1:(v1 v2 v3 v4 v5 v6 v7 v8)',
+    ' OR '.join([ 'f%d:v%d' % (i, i) for i in range(100) ]),
+]
+
+FIELDS = [ 'message', 'message.raw', 'tenant1.message' ]
+
+def main(number=2000):
+    parser = yaesql.Parser(engine='fast')
+
+    print("%-60s %12s %12s %8s" % ("query", "compose us", "render us", "speedup"))
+
+    for s in QUERIES:
+        query    = parser.parseString(s)
+        compiled = query.compile()
+
+        for f in FIELDS:
+            assert compiled.render(f) == query.compose(f)
+
+        t_compose = timeit.timeit(lambda: [ query.compose(f)    for f in FIELDS ], number=number)
+        t_render  = timeit.timeit(lambda: [ compiled.render(f)  for f in FIELDS ], number=number)
+
+        n = number * len(FIELDS)
+        print("%-60s %12.2f %12.2f %7.1fx" % (s[:60], t_compose / n * 1e6, t_render / n * 1e6, t_compose / t_render))
+
+if __name__ == "__main__":
+    main()
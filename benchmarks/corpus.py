@@ -0,0 +1,101 @@
+"""
+Seeded generator of synthetic, valid query strings covering the whole
+grammar: simple terms, quoted strings, regular expressions, `field:(...)`
+lists, comparisons, `+`/`-`, NOT/AND/OR and nested parentheses.
+
+    python -m benchmarks.corpus [ count [ size [ depth [ seed ] ] ] ]
+"""
+import random
+import sys
+
+FIELDS = [
+    'message', 'host.name', 'level', 'service', 'user.id', 'status',
+    'http.method', 'url.path', 'kubernetes.pod', 'timestamp', 'bytes',
+]
+
+WORDS = [
+    'error', 'warning', 'info', 'timeout', 'refused', 'prod', 'staging',
+    'web01', 'web02', 'db-master', 'api_gateway', 'GET', 'POST',
+    '404', '500', '2020-03-20', '10.0.0.1', 'user:42', 'a+b', 'api/v1/login',
+]
+
+PHRASES = [
+    'connection refused', 'out of memory', 'café', 'say "hi"', "it's", 'back\\slash', '',
+]
+
+REGEXES = [
+    'time.*out', 'web0[0-9]', 'err(or)?', '.*exception', 'db-.*', 'a.c', '[a-z]+[0-9]{2,3}',
+]
+
+COMPARE = [ '<', '<=', '>', '>=' ]
+
+NUMBERS = [ '0', '200', '404', '1024', '0.5', '2020-03-20', '2020-03-20T10:00:00' ]
+
+def _quote(s, q):
+    return q + s.replace('\\', '\\\\').replace(q, '\\' + q) + q
+
+class QueryGenerator(object):
+    """
+    Query strings of about `size` clauses and up to `depth` levels of
+    nested parentheses. The same seed always gives the same queries.
+    """
+
+    def __init__(self, seed=0, size=8, depth=2):
+        self.rnd   = random.Random(seed)
+        self.size  = size
+        self.depth = depth
+
+    def value(self):
+        rnd = self.rnd
+        k = rnd.random()
+        if k < 0.6:
+            return rnd.choice(WORDS)
+        if k < 0.8:
+            return _quote(rnd.choice(PHRASES), rnd.choice('"\''))
+        return 'r' + _quote(rnd.choice(REGEXES), rnd.choice('"\''))
+
+    def term(self, level):
+        rnd = self.rnd
+        k = rnd.random()
+        if k < 0.25:
+            return rnd.choice(['', '', '+', '-']) + self.value()
+        if k < 0.55:
+            return '%s%s%s' % (rnd.choice(FIELDS), rnd.choice([':', ':', '=', ' : ']), self.value())
+        if k < 0.7:
+            items = [ rnd.choice(['', '', '+', '-']) + self.value() for i in range(rnd.randint(1, 6)) ]
+            return '%s:(%s)' % (rnd.choice(FIELDS), ' '.join(items))
+        if k < 0.8:
+            return '%s:%s%s' % (rnd.choice(FIELDS), rnd.choice(COMPARE), rnd.choice(NUMBERS))
+        if k < 0.9 and level < self.depth:
+            return rnd.choice(['', 'NOT ', '+', '-']) + '(%s)' % (self.query(level+1, max(2, self.size // 3)))
+        return 'NOT ' + self.value()
+
+    def query(self, level=0, size=None):
+        rnd = self.rnd
+        size = size or self.size
+
+        exprs = []
+        n = 0
+        while n < size:
+            k = min(rnd.randint(1, 3), size - n)
+            op = ' %s ' % (rnd.choice(['AND', 'OR']))
+            exprs.append( op.join([ self.term(level) for i in range(k) ]) )
+            n += k
+        return ' '.join(exprs)
+
+    def __iter__(self):
+        while True:
+            yield self.query()
+
+def generate(count, seed=0, size=8, depth=2):
+    """
+    Return a list of `count` query strings
+    """
+    gen = QueryGenerator(seed, size, depth)
+    return [ gen.query() for i in range(count) ]
+
+if __name__ == "__main__":
+    args = [ int(a) for a in sys.argv[1:] ]
+    count, size, depth, seed = (args + [ 10, 8, 2, 0 ][len(args):])[:4]
+    for s in generate(count, seed, size, depth):
+        print(s)
@@ -0,0 +1,78 @@
+"""
+Time per node of compose(), compose_json() and dump() on query trees of
+growing depth, past the recursion limit of the interpreter.
+
+    python -m benchmarks.deep [ --max-depth 20000 ]
+
+The trees are built with the node classes: the parsers themselves stop
+at much smaller depths (see the `max_depth` limit of Parser).
+"""
+import argparse
+import gc
+import sys
+import time
+
+from yaesql import Query, NotExpr, OrExpr, ComplexTerm, SimpleTerm, StringLiteral
+
+def chain(depth, width=2):
+    """
+    `(v OR g:w1 ... OR g:wN) NOT (...)` nested `depth` times, with 
+    `width` terms at every level
+    """
+    node = Query([ SimpleTerm(StringLiteral('v0')) ])
+    for i in range(1, depth):
+        leaves = [ SimpleTerm(StringLiteral('v%d' % i)) ] + [ ComplexTerm('g', SimpleTerm(StringLiteral('w%d' % j))) for j in range(1, width) ]
+        node = Query([ OrExpr(leaves) if width > 1 else leaves[0], NotExpr(node) ])
+    return Query([ ComplexTerm('f', node) ])
+
+def nodes(depth, width=2):
+    # per level: Query, NotExpr, OrExpr, the terms with their values and
+    # ComplexTerms
+    return 5 + (depth - 1) * (2 + (width > 1) + 2 * width + (width - 1))
+
+def _time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        gc.disable()
+        try:
+            t = time.perf_counter()
+            fn()
+            t = time.perf_counter() - t
+        finally:
+            gc.enable()
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.deep", description="yaesql deep trees")
+
+    ap.add_argument("--max-depth", type=int, default=20000, help="deepest tree")
+    ap.add_argument("--width"    , type=int, default=2, help="leaves per level")
+    ap.add_argument("--repeat"   , type=int, default=5, help="timed runs per tree (best is kept)")
+
+    args = ap.parse_args(argv)
+
+    out.write("recursion limit %d\n" % (sys.getrecursionlimit(),))
+    out.write("%8s %8s %14s %14s %14s\n" % ("depth", "nodes", "compose ns", "json ns", "dump ns"))
+
+    depth = 10
+    while depth <= args.max_depth:
+        q = chain(depth, args.width)
+        n = nodes(depth, args.width)
+
+        times = [
+            _time(lambda: q.compose('message'), args.repeat),
+            _time(lambda: q.compose_json('message'), args.repeat),
+            _time(q.dump, args.repeat),
+        ]
+        out.write("%8d %8d %14.0f %14.0f %14.0f\n" % tuple([ depth, n ] + [ t / n * 1e9 for t in times ]))
+
+        depth *= 4
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
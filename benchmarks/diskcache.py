@@ -0,0 +1,68 @@
+"""
+Queries per second of a start with the disk cache of parsed queries
+(yaesql.cache.DiskCache), against parsing the same queries.
+
+    python -m benchmarks.diskcache [ --queries 5000 ] [ --engine fast ]
+
+Every run starts from a new Parser, as a new process would: 'cold' parses
+the queries and stores them in an empty cache directory, 'warm' loads
+them from the directory filled by the cold run.
+"""
+import argparse
+import sys
+import tempfile
+
+import yaesql
+
+from .corpus import generate
+from .evaluate import _time
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.diskcache", description="yaesql disk cache")
+
+    ap.add_argument("--queries", type=int, default=5000, help="queries from the corpus")
+    ap.add_argument("--engine" , choices=yaesql.Parser.ENGINES, default='fast', help="parser engine (default: fast)")
+    ap.add_argument("--seed"   , type=int, default=0, help="corpus seed")
+    ap.add_argument("--repeat" , type=int, default=3, help="timed runs (best is kept)")
+
+    args = ap.parse_args(argv)
+
+    strings = generate(args.queries, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        def run_parse():
+            parser = yaesql.Parser(engine=args.engine)
+            for s in strings:
+                parser.parseString(s)
+
+        def run_cold():
+            with tempfile.TemporaryDirectory() as empty:
+                parser = yaesql.Parser(engine=args.engine, cache_dir=empty)
+                for s in strings:
+                    parser.parseString(s)
+
+        def run_warm():
+            parser = yaesql.Parser(engine=args.engine, cache_dir=directory)
+            for s in strings:
+                parser.parseString(s)
+
+        parser = yaesql.Parser(engine=args.engine, cache_dir=directory)
+        expected = [ parser.parseString(s).dump() for s in strings ]
+
+        parser = yaesql.Parser(engine=args.engine, cache_dir=directory)
+        if [ parser.parseString(s).dump() for s in strings ] != expected:
+            out.write("MISMATCH between the parsed and the loaded queries\n")
+            return 1
+
+        out.write("%-10s %14s\n" % ("start", "queries/s"))
+        for name, fn in (('parse', run_parse), ('cold', run_cold), ('warm', run_warm)):
+            t = _time(fn, args.repeat)
+            out.write("%-10s %14.0f\n" % (name, len(strings) / t))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
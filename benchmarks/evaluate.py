@@ -0,0 +1,106 @@
+"""
+Rows per second of the local evaluator (yaesql.evaluate) on columnar
+batches, against the per-row evaluation of the same queries.
+
+    python -m benchmarks.evaluate [ --rows 100000 ] [ --queries 50 ]
+
+The documents are synthetic log records over the fields and values of
+the query corpus; every query of the corpus is evaluated on the whole
+batch, indexing its columns for every query (batch) or once for all of
+them (shared).
+"""
+import argparse
+import gc
+import random
+import sys
+import time
+
+import yaesql
+
+from yaesql.evaluate import Batch
+
+from .corpus import FIELDS, WORDS, generate
+
+def columns(count, seed=0):
+    """
+    A columnar batch of `count` documents: { field: [ value, ... ] }
+    """
+    rnd = random.Random(seed)
+
+    batch = dict([ (field, []) for field in FIELDS ])
+    for i in range(count):
+        for field in FIELDS:
+            if field in ('status', 'bytes'):
+                v = rnd.choice([ 200, 200, 200, 404, 500, rnd.randint(0, 4096) ])
+            elif field == 'timestamp':
+                v = '2020-03-%02dT%02d:00:00' % (rnd.randint(1, 31), rnd.randint(0, 23))
+            elif rnd.random() < 0.1:
+                v = None
+            else:
+                v = rnd.choice(WORDS)
+            batch[field].append(v)
+    return batch
+
+def rows(batch):
+    n = len(next(iter(batch.values())))
+    return [ dict([ (field, values[i]) for field, values in batch.items() ]) for i in range(n) ]
+
+def _time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        gc.disable()
+        try:
+            t = time.perf_counter()
+            fn()
+            t = time.perf_counter() - t
+        finally:
+            gc.enable()
+        if best is None or t < best:
+            best = t
+    return best
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.evaluate", description="yaesql local evaluation")
+
+    ap.add_argument("--rows"   , type=int, default=100000, help="documents in the batch")
+    ap.add_argument("--queries", type=int, default=50, help="queries from the corpus")
+    ap.add_argument("--seed"   , type=int, default=0, help="corpus and documents seed")
+    ap.add_argument("--repeat" , type=int, default=3, help="timed runs (best is kept)")
+
+    args = ap.parse_args(argv)
+
+    batch = columns(args.rows, args.seed)
+    docs  = rows(batch)
+
+    parser = yaesql.Parser(engine='fast')
+    evaluators = [ parser.parseString(s).evaluator('message') for s in generate(args.queries, seed=args.seed) ]
+
+    def run_batch():
+        for e in evaluators:
+            e.bits(batch)
+
+    def run_shared():
+        # the columns are indexed once for all the queries
+        shared = Batch(batch)
+        for e in evaluators:
+            e.bits(shared)
+
+    def run_rows():
+        for e in evaluators:
+            match = e.match
+            for row in docs:
+                match(row)
+
+    total = args.rows * len(evaluators)
+
+    out.write("%-10s %14s\n" % ("evaluator", "rows/s"))
+    for name, fn in (('batch', run_batch), ('shared', run_shared), ('row', run_rows)):
+        t = _time(fn, args.repeat)
+        out.write("%-10s %14.0f\n" % (name, total / t))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
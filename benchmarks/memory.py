@@ -0,0 +1,50 @@
+"""
+Memory held by parsed queries, as kept by a parse cache.
+
+    python benchmarks/memory.py [ count [ engine ] ]
+"""
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import yaesql
+
+FIELDS = [ 'message', 'host.name', 'level', 'service', 'user.id', 'timestamp' ]
+VALUES = [ 'error', 'warning', 'prod', 'staging', 'web01', 'web02', 'db', '"connection refused"', 'r"time.*out"' ]
+
+def make_query(rnd):
+    terms = []
+    for i in range(rnd.randint(2, 6)):
+        k = rnd.randint(0, 3)
+        if k == 0:
+            terms.append( '%s:%s' % (rnd.choice(FIELDS), rnd.choice(VALUES)) )
+        elif k == 1:
+            terms.append( '%s:(%s)' % (rnd.choice(FIELDS), ' '.join(rnd.sample(VALUES, 3))) )
+        elif k == 2:
+            terms.append( 'timestamp:>=2020-03-%02d' % (rnd.randint(1, 28)) )
+        else:
+            terms.append( '-%s:%s' % (rnd.choice(FIELDS), rnd.choice(VALUES)) )
+    return ' AND '.join(terms) + ' id%d' % (rnd.randint(0, 10**9))
+
+def main(count=20000, engine='fast'):
+    rnd = random.Random(0)
+    corpus = [ make_query(rnd) for i in range(count) ]
+
+    parser = yaesql.Parser(engine=engine)
+    parser.parseString(corpus[0])
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    kept = [ parser.parseString(s) for s in corpus ]
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("%d queries, %.0f bytes per parsed query" % (len(kept), (after - before) / len(kept)))
+
+if __name__ == "__main__":
+    main(*[ int(a) if a.isdigit() else a for a in sys.argv[1:] ])
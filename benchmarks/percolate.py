@@ -0,0 +1,103 @@
+"""
+Documents per second of a QuerySet (yaesql.percolate) holding many
+alerting rules, against the evaluation of every rule on every document.
+
+    python -m benchmarks.percolate [ --queries 50000 ] [ --docs 5000 ]
+
+Rules and events are synthetic: rules select services, hosts, users and
+status codes out of a few thousand values, a part of them only with
+negations, regular expressions or ranges (they can not be indexed).
+"""
+import argparse
+import random
+import sys
+import time
+
+from yaesql.percolate import QuerySet
+
+SERVICES = [ 'svc%d' % i for i in range(2000) ]
+HOSTS    = [ 'web%02d' % i for i in range(500) ]
+USERS    = [ 'u%d' % i for i in range(20000) ]
+LEVELS   = [ 'debug', 'info', 'warning', 'error' ]
+WORDS    = [ 'timeout', 'refused', 'denied', 'restarted', 'oom', 'panic' ]
+
+def rules(count, seed=0):
+    rnd = random.Random(seed)
+
+    result = []
+    for i in range(count):
+        k = rnd.random()
+        if k < 0.4:
+            s = 'service:%s AND level:%s' % (rnd.choice(SERVICES), rnd.choice(LEVELS[2:]))
+        elif k < 0.6:
+            s = 'host.name:(%s) status:>=500' % (' '.join(rnd.sample(HOSTS, 3)))
+        elif k < 0.8:
+            s = 'user.id:%s -level:debug' % (rnd.choice(USERS))
+        elif k < 0.99:
+            s = '%s service:%s' % (rnd.choice(WORDS), rnd.choice(SERVICES))
+        else:
+            s = 'NOT level:debug AND host.name:r"web0.*" AND status:>=%d' % (rnd.choice([ 500, 502, 503 ]))
+        result.append(s)
+    return result
+
+def events(count, seed=0):
+    rnd = random.Random(seed)
+    return [
+        {
+            'message'  : rnd.choice(WORDS),
+            'service'  : rnd.choice(SERVICES),
+            'host.name': rnd.choice(HOSTS),
+            'user.id'  : rnd.choice(USERS),
+            'level'    : rnd.choice(LEVELS),
+            'status'   : rnd.choice([ 200, 200, 200, 404, 500, 503 ]),
+        }
+        for i in range(count)
+    ]
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.percolate", description="yaesql query set")
+
+    ap.add_argument("--queries"    , type=int, default=50000, help="stored rules")
+    ap.add_argument("--docs"       , type=int, default=5000, help="events matched against the query set")
+    ap.add_argument("--brute-docs" , type=int, default=20, help="events matched against every rule")
+    ap.add_argument("--seed"       , type=int, default=0, help="rules and events seed")
+
+    args = ap.parse_args(argv)
+
+    strings = rules(args.queries, args.seed)
+    docs    = events(args.docs, args.seed + 1)
+
+    t = time.perf_counter()
+    qs = QuerySet('message', enumerate(strings))
+    t = time.perf_counter() - t
+
+    info = qs.info()
+    out.write("%d queries (%d indexed, %d scanned) added in %.2fs\n" % (info.queries, info.indexed, info.scanned, t))
+
+    t = time.perf_counter()
+    results = [ qs.percolate(doc) for doc in docs ]
+    t = time.perf_counter() - t
+
+    out.write("%-10s %12s %14s %12s\n" % ("engine", "docs/s", "candidates/doc", "matches/doc"))
+    out.write("%-10s %12.0f %14.1f %12.2f\n" % ('queryset', len(docs) / t,
+              sum([ r.candidates for r in results ]) / len(docs), sum([ len(r.ids) for r in results ]) / len(docs)))
+
+    evaluators = list(enumerate([ qs.queries[i][1].evaluator('message') for i in range(len(strings)) ]))
+    brute = docs[:args.brute_docs]
+
+    t = time.perf_counter()
+    expected = [ [ i for i, e in evaluators if e.match(doc) ] for doc in brute ]
+    t = time.perf_counter() - t
+
+    out.write("%-10s %12.0f %14.1f %12.2f\n" % ('brute', len(brute) / t, len(evaluators), sum([ len(ids) for ids in expected ]) / len(brute)))
+
+    if expected != [ r.ids for r in results[:len(brute)] ]:
+        out.write("MISMATCH between the query set and the brute force evaluation\n")
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Parse time against input size on adversarial and fuzzed inputs.
+
+    python -m benchmarks.scaling [ --engine fast ] [ --max-slope 1.3 ]
+
+Every family of inputs is parsed at doubling sizes; the growth exponent
+is the slope of the least squares line of log(time) against log(size)
+(1.0 is linear, 2.0 quadratic). Invalid inputs count as well:
+failing must be as cheap as succeeding. The run fails if any exponent is
+over `--max-slope`.
+"""
+import argparse
+import gc
+import math
+import random
+import sys
+import time
+
+import yaesql
+
+from yaesql.limits import QueryLimitError
+
+from .corpus import QueryGenerator
+
+#
+# name -> function of n building an input of about n tokens
+#
+FAMILIES = [
+    ('and_chain'     , lambda n: ' AND '.join([ 'a' ] * n)),
+    ('or_fields'     , lambda n: ' OR '.join([ 'f:(a -b)' ] * (n // 5))),
+    ('value_list'    , lambda n: 'f:(' + ' '.join([ 'v%d' % i for i in range(n) ]) + ')'),
+    ('unclosed_list' , lambda n: 'f:(' + ' '.join([ 'v%d' % i for i in range(n) ])),
+    ('field_prefixes', lambda n: ' '.join([ 'f.g.h' ] * n)),
+    ('quoted'        , lambda n: ' '.join([ '"a \\" b"' ] * n)),
+    ('trailing_op'   , lambda n: 'a AND ' * n),
+    ('nested'        , lambda n: '(' * (n // 20) + ' '.join([ 'a' ] * n) + ')' * (n // 20)),
+    ('unclosed'      , lambda n: '(' * (n // 20) + ' '.join([ 'a' ] * n)),
+    ('not_nested'    , lambda n: 'NOT (' * (n // 20) + 'a' + ')' * (n // 20) + ' b' * n),
+]
+
+def _fuzz(rnd, s):
+    """
+    Randomly delete, duplicate or swap a few characters of `s`
+    """
+    s = list(s)
+    for i in range(max(1, len(s) // 20)):
+        if not s:
+            break
+        k = rnd.randrange(len(s))
+        op = rnd.randint(0, 2)
+        if op == 0:
+            del s[k]
+        elif op == 1:
+            s.insert(k, s[k])
+        else:
+            j = rnd.randrange(len(s))
+            s[k], s[j] = s[j], s[k]
+    return ''.join(s)
+
+def fuzz_family(seed=0):
+    """
+    A generated query of about n tokens followed by a fuzzed one: the
+    parser goes through the whole input before failing (or not)
+    """
+    def build(n):
+        rnd = random.Random(seed)
+        gen = QueryGenerator(seed, 8, 2)
+        parts = [ gen.query() for i in range(max(1, n // 16)) ]
+        return ' '.join(parts) + ' ' + _fuzz(rnd, gen.query())
+    return build
+
+def _time_parse(parser, s, repeat):
+    best = None
+    for i in range(repeat):
+        # as timeit does: full collections of the growing trees would
+        # add their own (superlinear) cost
+        gc.disable()
+        try:
+            t = time.perf_counter()
+            try:
+                parser.parseString(s)
+            except QueryLimitError:
+                return None
+            except Exception:
+                pass
+            t = time.perf_counter() - t
+        finally:
+            gc.enable()
+        if best is None or t < best:
+            best = t
+    return best
+
+def measure(parser, build, sizes, repeat=3):
+    """
+    Return [ (size, seconds) ] for the inputs built at `sizes`
+    """
+    # warm up
+    _time_parse(parser, build(sizes[0]), 1)
+
+    points = []
+    for n in sizes:
+        t = _time_parse(parser, build(n), repeat)
+        if t is None:
+            break
+        points.append( (n, t) )
+    return points
+
+def slope(points):
+    """
+    Least squares slope of log(time) against log(size)
+    """
+    xs = [ math.log(n) for n, t in points ]
+    ys = [ math.log(t) for n, t in points ]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum([ (x - mx) * (y - my) for x, y in zip(xs, ys) ]) / sum([ (x - mx) ** 2 for x in xs ])
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.scaling", description="yaesql parse time scaling")
+
+    ap.add_argument("--engine"   , choices=yaesql.Parser.ENGINES, action='append', help="engines to test (default: all)")
+    ap.add_argument("--min-size" , type=int, default=400, help="smallest input, in tokens")
+    ap.add_argument("--steps"    , type=int, default=4, help="size doublings")
+    ap.add_argument("--repeat"   , type=int, default=3, help="timed runs per input (best is kept)")
+    ap.add_argument("--max-slope", type=float, default=1.3, help="maximum growth exponent")
+
+    args = ap.parse_args(argv)
+
+    sizes = [ args.min_size << i for i in range(args.steps + 1) ]
+
+    families = FAMILIES + [ ('fuzzed_corpus', fuzz_family()) ]
+
+    failures = 0
+
+    out.write("%-10s %-16s %10s %12s %12s %8s\n" % ("engine", "family", "max size", "first ms", "last ms", "slope"))
+
+    for engine in (args.engine or yaesql.Parser.ENGINES):
+        parser = yaesql.Parser(engine=engine)
+
+        for name, build in families:
+            points = measure(parser, build, sizes, args.repeat)
+            if len(points) < 2:
+                out.write("%-10s %-16s %10s\n" % (engine, name, "too deep"))
+                continue
+
+            k = slope(points)
+            flag = ''
+            if k > args.max_slope:
+                failures += 1
+                flag = '  NOT LINEAR'
+
+            out.write("%-10s %-16s %10d %12.2f %12.2f %8.2f%s\n" % (engine, name, points[-1][0], points[0][1] * 1e3, points[-1][1] * 1e3, k, flag))
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
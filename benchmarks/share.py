@@ -0,0 +1,79 @@
+"""
+Memory and compose time of a library of parsed queries with the nodes
+shared between queries (Parser(share_nodes=True)), against separate trees.
+
+    python -m benchmarks.share [ --queries 20000 ] [ --engine fast ]
+
+The queries are the ones of benchmarks/memory.py: a few terms on the same
+fields and values, so most of their subtrees repeat across the library.
+"""
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+import yaesql
+
+from .memory import make_query
+
+def _bytes(parser, strings):
+    """
+    The parsed queries and the bytes they hold
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    kept = [ parser.parseString(s) for s in strings ]
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, after - before
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.share", description="yaesql shared nodes")
+
+    ap.add_argument("--queries", type=int, default=20000, help="queries in the library")
+    ap.add_argument("--engine" , choices=yaesql.Parser.ENGINES, default='fast', help="parser engine (default: fast)")
+    ap.add_argument("--seed"   , type=int, default=0, help="library seed")
+    ap.add_argument("--repeat" , type=int, default=3, help="compose runs (best is kept)")
+
+    args = ap.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    strings = [ make_query(rnd) for i in range(args.queries) ]
+
+    out.write("%-10s %14s %14s\n" % ("nodes", "bytes/query", "composes/s"))
+
+    results = []
+    for name, share in (('separate', False), ('shared', True)):
+        parser = yaesql.Parser(engine=args.engine, share_nodes=share)
+        parser.parseString(strings[0])
+
+        kept, size = _bytes(parser, strings)
+
+        best = None
+        for i in range(args.repeat):
+            t = time.perf_counter()
+            dsl = [ q.compose('message') for q in kept ]
+            t = time.perf_counter() - t
+            if best is None or t < best:
+                best = t
+
+        results.append(dsl)
+        out.write("%-10s %14.0f %14.0f\n" % (name, size / len(kept), len(kept) / best))
+
+        del kept, dsl
+
+    if results[0] != results[1]:
+        out.write("MISMATCH between the DSL of the shared and separate trees\n")
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
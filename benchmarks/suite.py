@@ -0,0 +1,274 @@
+"""
+Time the parser on a generated corpus and compare with stored baselines.
+
+    python -m benchmarks.suite                  # run and print the report
+    python -m benchmarks.suite --check          # exit 1 on a regression
+    python -m benchmarks.suite --save           # store the new baselines
+
+Every benchmark reports the throughput (operations per second), the
+latency percentiles of single operations and the peak memory allocated
+while running over the whole corpus.
+
+Throughputs are stored in `baseline.json` relative to a calibration loop
+of plain Python code run on the same machine, so baselines recorded on
+a different (slower or faster) machine still compare.
+"""
+import argparse
+import collections
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import yaesql
+
+from .corpus import generate
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+#
+# Default allowed slowdown with respect to the baseline, and the one of
+# benchmarks with more noise
+#
+THRESHOLD = 0.30
+
+THRESHOLDS = {
+    'parser_init': 0.50,
+}
+
+FIELD = 'message'
+
+Result = collections.namedtuple('Result', 'name ops throughput p50 p95 p99 peak')
+
+#----------------------------------------------------------------------#
+# BENCHMARKS                                                           #
+#----------------------------------------------------------------------#
+#
+# Each benchmark prepares its inputs from the corpus (untimed) and
+# returns the list of operations to time, as (function, argument) pairs.
+#
+
+def _parser_init(corpus):
+    return [ (yaesql.Parser, None) ] * len(corpus)
+
+def _parse(engine):
+    def setup(corpus):
+        parser = yaesql.Parser(engine=engine)
+        return [ (parser.parseString, s) for s in corpus ]
+    return setup
+
+def _queries(corpus):
+    parser = yaesql.Parser(engine='fast')
+    return [ parser.parseString(s) for s in corpus ]
+
+def _compose(corpus):
+    return [ (q.compose, FIELD) for q in _queries(corpus) ]
+
+def _json_dumps(corpus):
+    return [ (json.dumps, q.compose(FIELD)) for q in _queries(corpus) ]
+
+def _compose_json(corpus):
+    return [ (q.compose_json, FIELD) for q in _queries(corpus) ]
+
+def _prettyformat(corpus):
+    return [ (yaesql.prettyformat, q.compose(FIELD)) for q in _queries(corpus) ]
+
+def _bind(corpus):
+    parser = yaesql.Parser(engine='fast')
+    ops = []
+    for i, s in enumerate(corpus):
+        bind = parser.prepare(s + ' user.id:$uid', FIELD).bind
+        ops.append( (lambda v, bind=bind: bind(uid=v), 'user%d' % i) )
+    return ops
+
+BENCHMARKS = collections.OrderedDict([
+    ('parser_init'     , _parser_init       ),
+    ('parse_pyparsing' , _parse('pyparsing')),
+    ('parse_fast'      , _parse('fast')     ),
+    ('compose'         , _compose           ),
+    ('json_dumps'      , _json_dumps        ),
+    ('compose_json'    , _compose_json      ),
+    ('prettyformat'    , _prettyformat      ),
+    ('bind'            , _bind              ),
+])
+
+#----------------------------------------------------------------------#
+# TIMING                                                               #
+#----------------------------------------------------------------------#
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def _time_ops(ops):
+    clock = time.perf_counter_ns
+
+    latencies = []
+
+    # as timeit does, collections would only add noise
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = clock()
+        for fn, arg in ops:
+            t = clock()
+            fn() if arg is None else fn(arg)
+            latencies.append(clock() - t)
+        total = clock() - start
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return total, latencies
+
+def _peak_memory(ops):
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        results = [ fn() if arg is None else fn(arg) for fn, arg in ops ]
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    del results
+    return peak
+
+def run(name, corpus, repeat=3):
+    """
+    Time the benchmark `name` on `corpus`: the best of `repeat` rounds
+    """
+    ops = BENCHMARKS[name](corpus)
+
+    # warm up (the shared grammar, caches...)
+    _time_ops(ops[:10])
+
+    best      = None
+    latencies = []
+    for i in range(repeat):
+        total, lat = _time_ops(ops)
+        latencies.extend(lat)
+        if best is None or total < best:
+            best = total
+
+    latencies.sort()
+
+    return Result(
+        name,
+        len(ops),
+        len(ops) / (best / 1e9),
+        _percentile(latencies, 0.50) / 1e3,
+        _percentile(latencies, 0.95) / 1e3,
+        _percentile(latencies, 0.99) / 1e3,
+        _peak_memory(ops),
+    )
+
+def calibrate(repeat=5):
+    """
+    Throughput of a fixed plain Python workload on this machine
+    """
+    def work():
+        d = {}
+        for i in range(20000):
+            d['k%d' % (i % 500)] = [ i, str(i), { 'v': i } ]
+        return d
+
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        work()
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return 1.0 / best
+
+#----------------------------------------------------------------------#
+# BASELINES                                                            #
+#----------------------------------------------------------------------#
+
+def load_baseline(path=BASELINE):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_baseline(results, calibration, options, path=BASELINE):
+    data = {
+        'options'   : options,
+        'threshold' : THRESHOLD,
+        'thresholds': THRESHOLDS,
+        'scores'    : dict([ (r.name, r.throughput / calibration) for r in results ]),
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+def check(results, calibration, baseline, threshold=None):
+    """
+    Return the list of (name, score, baseline score) of the results
+    slower than the baseline by more than the threshold: `threshold` if
+    given, else the one stored in the baseline for the benchmark
+    """
+    regressions = []
+    for r in results:
+        expected = baseline['scores'].get(r.name)
+        if expected is None:
+            continue
+
+        allowed = threshold
+        if allowed is None:
+            allowed = baseline.get('thresholds', {}).get(r.name, baseline.get('threshold', THRESHOLD))
+
+        score = r.throughput / calibration
+        if score < expected * (1.0 - allowed):
+            regressions.append( (r.name, score, expected) )
+    return regressions
+
+#----------------------------------------------------------------------#
+
+def _report(results, out):
+    out.write("%-16s %8s %12s %10s %10s %10s %12s\n" % ("benchmark", "ops", "ops/s", "p50 us", "p95 us", "p99 us", "peak KiB"))
+    for r in results:
+        out.write("%-16s %8d %12.0f %10.1f %10.1f %10.1f %12.1f\n" % (r.name, r.ops, r.throughput, r.p50, r.p95, r.p99, r.peak / 1024.0))
+
+def main(argv=None, out=None):
+    out = out or sys.stdout
+
+    ap = argparse.ArgumentParser(prog="python -m benchmarks.suite", description="yaesql benchmarks")
+
+    ap.add_argument("--count"    , type=int, default=1000, help="queries in the corpus")
+    ap.add_argument("--size"     , type=int, default=8   , help="clauses per query")
+    ap.add_argument("--depth"    , type=int, default=2   , help="nesting depth of the queries")
+    ap.add_argument("--seed"     , type=int, default=0   , help="corpus seed")
+    ap.add_argument("--repeat"   , type=int, default=3   , help="timed rounds per benchmark")
+    ap.add_argument("--only"     , action='append', choices=list(BENCHMARKS), help="run only these benchmarks")
+    ap.add_argument("--baseline" , default=BASELINE, help="baseline file")
+    ap.add_argument("--threshold", type=float, help="allowed slowdown (default: from the baseline file)")
+    ap.add_argument("--check"    , action='store_true', help="fail on a regression with respect to the baseline")
+    ap.add_argument("--save"     , action='store_true', help="store the results as the new baseline")
+
+    args = ap.parse_args(argv)
+
+    corpus = generate(args.count, args.seed, args.size, args.depth)
+
+    calibration = calibrate()
+
+    results = []
+    for name in (args.only or BENCHMARKS):
+        results.append( run(name, corpus, args.repeat) )
+
+    _report(results, out)
+
+    if args.save:
+        options = { 'count': args.count, 'size': args.size, 'depth': args.depth, 'seed': args.seed }
+        save_baseline(results, calibration, options, args.baseline)
+        out.write("baseline saved to %s\n" % (args.baseline,))
+
+    if args.check:
+        regressions = check(results, calibration, load_baseline(args.baseline), args.threshold)
+        for name, score, expected in regressions:
+            out.write("REGRESSION %s: %.1f%% of the baseline\n" % (name, 100.0 * score / expected))
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,7 +8,7 @@ install_requires = [
 setup(
     name="Yaesql",
     version="0.1",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
 
     install_requires=install_requires,
 
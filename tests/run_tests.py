@@ -60,11 +60,15 @@ class TestStringMethods(unittest.TestCase):
             ),
             (
              'r"foo"', 
-             '{"query": {"regexp": {"message": {"value": "foo"}}}}'
+             '{"query": {"term": {"message": {"value": "foo"}}}}'
             ), 
             (
              "r'foo'", 
-             '{"query": {"regexp": {"message": {"value": "foo"}}}}'
+             '{"query": {"term": {"message": {"value": "foo"}}}}'
+            ),
+            (
+             'r"fo+"', 
+             '{"query": {"regexp": {"message": {"value": "fo+"}}}}'
             ),
             #
             # Complex field
@@ -83,11 +87,15 @@ class TestStringMethods(unittest.TestCase):
             ),
             (
              'field1:r"foo"', 
-             '{"query": {"regexp": {"field1": {"value": "foo"}}}}'
+             '{"query": {"term": {"field1": {"value": "foo"}}}}'
             ), 
             (
              "field1:r'foo'", 
-             '{"query": {"regexp": {"field1": {"value": "foo"}}}}'
+             '{"query": {"term": {"field1": {"value": "foo"}}}}'
+            ),
+            (
+             "field1:r'fo+'", 
+             '{"query": {"regexp": {"field1": {"value": "fo+"}}}}'
             ),
 
         ]
@@ -99,6 +107,2287 @@ class TestStringMethods(unittest.TestCase):
             self.assertEqual( json.dumps(qs), s2 )
         
         
+#----------------------------------------------------------------------#
+
+def _random_query(rnd, depth=0):
+    """
+    Generate a random (mostly valid) query string
+    """
+    values = [
+        'foo', 'bar', 'x1', '10', '2020-03-20', 'a.b', 'x_y', 'a:b', 'a-b',
+        '"foo"', '"hello world"', "'foo'", '"esc\\"aped"', "'tab\\tbed'",
+        'r"foo.*"', "r'ba?r'", 'ORANGE', 'NOTE', 'ANDROID', 'r',
+        '0.5', '1e3', '-7', '007', '10.0.0.1', 'now-1d/d', 'nowhere', '2020-03-20||+1M', '2020-03-20T10:00Z',
+    ]
+    fields = [ 'field1', 'message', 'a.b', 'x' ]
+
+    def value():
+        return rnd.choice(values)
+
+    def term():
+        k = rnd.randint(0, 5)
+        if k == 0:
+            return value()
+        if k == 1:
+            return '%s%s%s' % (rnd.choice(fields), rnd.choice([':', '=', ' : ']), value())
+        if k == 2:
+            items = [ rnd.choice(['', '+', '-']) + value() for i in range(rnd.randint(1, 4)) ]
+            return '%s:(%s)' % (rnd.choice(fields), ' '.join(items))
+        if k == 3:
+            return '%s:%s%s' % (rnd.choice(fields), rnd.choice(['<', '<=', '>', '>=']), value())
+        if k == 4 and depth < 3:
+            return '(%s)' % (_random_query(rnd, depth+1))
+        return rnd.choice(['', '+', '-', 'NOT ']) + value()
+
+    def expr():
+        n = rnd.randint(1, 3)
+        return (' %s ' % rnd.choice(['AND', 'OR'])).join([ term() for i in range(n) ])
+
+    return ' '.join([ expr() for i in range(rnd.randint(1, 3)) ])
+
+
+def _random_garbage(rnd):
+    """
+    Generate a random sequence of tokens, mostly invalid queries
+    """
+    tokens = [
+        'foo', 'f1', 'NOT', 'AND', 'OR', 'ORx', '(', ')', ':', '=', '+', '-',
+        '<', '<=', '>', '>=', '"q s"', "'x'", 'r"re"', 'r', '"', '\\', 'x_y', 
+        'field1:', 'a.b', '$', '\t',
+    ]
+    return rnd.choice(['', ' ']).join([ rnd.choice(tokens) for i in range(rnd.randint(1, 8)) ])
+
+
+class TestFastEngine(unittest.TestCase):
+
+    def _result(self, parser, s):
+        try:
+            q = parser.parseString(s)
+        except Exception as e:
+            return (type(e).__name__,)
+        try:
+            c = q.compose("message")
+        except Exception as e:
+            c = type(e).__name__
+        return (q.dump(), c)
+
+    def test_unknown_engine(self):
+
+        with self.assertRaises(ValueError):
+            yaesql.Parser(engine="nope")
+
+    def test_equivalence(self):
+
+        import random
+
+        rnd = random.Random(1234)
+
+        slow = yaesql.Parser()
+        fast = yaesql.Parser(engine="fast")
+
+        corpus  = [ _random_query(rnd) for i in range(2000) ]
+        corpus += [ _random_garbage(rnd) for i in range(2000) ]
+
+        for s in corpus:
+            self.assertEqual( self._result(fast, s), self._result(slow, s), s )
+
+    def test_parse_error(self):
+
+        import pyparsing as pp
+
+        parser = yaesql.Parser(engine="fast")
+
+        for s in [ ':foo', '', 'foo AND', '(foo', 'field1:(', '"foo' ]:
+            with self.assertRaises(pp.ParseException):
+                parser.parseString(s)
+
+
+class TestSharedGrammar(unittest.TestCase):
+
+    def test_built_once(self):
+
+        p1 = yaesql.Parser()
+        p2 = yaesql.Parser()
+
+        p1.parseString("foo")
+        p2.parseString("bar")
+
+        self.assertIs( yaesql._shared_grammar(), yaesql._shared_grammar() )
+
+    def test_factory_override(self):
+
+        class UpperParser(yaesql.Parser):
+            def create_StringLiteral(self, s, loc, toks):
+                return yaesql.StringLiteral( toks[0].upper() )
+
+        for engine in yaesql.Parser.ENGINES:
+            upper = UpperParser(engine=engine)
+            plain = yaesql.Parser(engine=engine)
+
+            self.assertEqual( upper.parseString("field1:foo").dump(), "Query(ComplexTerm(field1:SimpleTerm(STRING('FOO'))))" )
+            self.assertEqual( plain.parseString("field1:foo").dump(), "Query(ComplexTerm(field1:SimpleTerm(STRING('foo'))))" )
+
+    def test_threads(self):
+
+        import random
+        from concurrent.futures import ThreadPoolExecutor
+
+        rnd = random.Random(42)
+        corpus = [ _random_query(rnd) for i in range(400) ]
+
+        class TaggedParser(yaesql.Parser):
+            def __init__(self, tag):
+                super().__init__()
+                self.tag = tag
+            def create_StringLiteral(self, s, loc, toks):
+                return yaesql.StringLiteral( self.tag + toks[0] )
+
+        parsers = [ TaggedParser("a_"), TaggedParser("b_") ]
+
+        def parse(i):
+            parser = parsers[i % 2]
+            try:
+                return parser.parseString(corpus[i]).dump()
+            except Exception as e:
+                return str(e)
+
+        expected = [ parse(i) for i in range(len(corpus)) ]
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(parse, range(len(corpus))))
+
+        self.assertEqual(results, expected)
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_normalize(self):
+
+        from yaesql.cache import normalize_query
+
+        self.assertEqual( normalize_query("  a   AND\n b "), "a AND b" )
+        self.assertEqual( normalize_query('f:"a   b"  c'), 'f:"a   b" c' )
+        self.assertEqual( normalize_query("f:'a \\'  b'   c"), "f:'a \\'  b' c" )
+
+    def test_hits_and_misses(self):
+
+        import json
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine, cache_size=2)
+
+            q1 = parser.parseString("field1:foo OR bar")
+            q2 = parser.parseString("  field1:foo   OR bar ")
+
+            self.assertIs(q1, q2)
+            self.assertEqual( json.dumps(q2.compose("message")), '{"query": {"bool": {"should": [{"term": {"field1": {"value": "foo"}}}, {"term": {"message": {"value": "bar"}}}]}}}')
+            self.assertEqual( json.dumps(q2.compose("message")), json.dumps(q1.compose("message")) )
+
+            parser.parseString("a")
+            parser.parseString("b")
+
+            info = parser.cache_info()
+            self.assertEqual( (info.hits, info.misses, info.evictions, info.currsize), (1, 3, 1, 2) )
+
+            # evicted
+            self.assertIsNot( parser.parseString("field1:foo OR bar"), q1 )
+
+    def test_errors_not_cached(self):
+
+        parser = yaesql.Parser(cache_size=10)
+
+        for i in range(2):
+            with self.assertRaises(Exception):
+                parser.parseString(":foo")
+
+        self.assertEqual( parser.cache_info().currsize, 0 )
+
+    def test_ttl(self):
+
+        from yaesql.cache import ParseCache
+
+        now = [ 0.0 ]
+        cache = ParseCache(10, ttl=5, timer=lambda: now[0])
+
+        cache.put("a", 1)
+        self.assertEqual( cache.get("a"), 1 )
+
+        now[0] = 6.0
+        self.assertIsNone( cache.get("a") )
+
+        info = cache.info()
+        self.assertEqual( (info.hits, info.misses, info.expirations, info.currsize), (1, 1, 1, 0) )
+
+    def test_same_as_uncached(self):
+
+        import random
+        import tempfile
+
+        rnd = random.Random(3)
+
+        corpus = [ '"a b"', '"a\nb"', 'f:"a  b"  c', 'f:"a\n  b"  c', "'a   b", "x:'a\n b' \"c  d\"" ]
+        for i in range(300):
+            # white spaces anywhere, quoted values included
+            s = _random_query(rnd)
+            corpus.append( ''.join([ c + rnd.choice(['', '', ' ', '  ', '\n', '\t']) for c in s ]) )
+
+        def parse(parser, s):
+            try:
+                return parser.parseString(s).dump()
+            except Exception as e:
+                return type(e).__name__
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for engine in yaesql.Parser.ENGINES:
+                plain   = yaesql.Parser(engine=engine)
+                parsers = [
+                    yaesql.Parser(engine=engine, cache_size=1000),
+                    yaesql.Parser(engine=engine, cache_dir=tmp),
+                    yaesql.Parser(engine=engine, share_nodes=True),
+                ]
+                for s in corpus:
+                    expected = parse(plain, s)
+                    for parser in parsers:
+                        self.assertEqual( parse(parser, s), expected, s )
+
+    def test_no_cache(self):
+
+        parser = yaesql.Parser()
+
+        self.assertIsNone( parser.cache_info() )
+        self.assertIsNot( parser.parseString("foo"), parser.parseString("foo") )
+
+
+class TestCompiledQuery(unittest.TestCase):
+
+    def test_render(self):
+
+        import random
+
+        rnd = random.Random(7)
+
+        parser = yaesql.Parser(engine="fast")
+
+        n = 0
+        while n < 500:
+            try:
+                q = parser.parseString(_random_query(rnd))
+                q.compose("message")
+            except Exception:
+                continue
+
+            compiled = q.compile()
+            for f in [ "message", "message.raw", "x" ]:
+                self.assertEqual( compiled.render(f), q.compose(f) )
+            n += 1
+
+    def test_fresh_result(self):
+
+        compiled = yaesql.Parser().parseString("field1:foo OR bar").compile()
+
+        r1 = compiled.render("message")
+        r1['query']['bool']['should'].append(None)
+
+        self.assertEqual( compiled.render("message"), {'query': {'bool': {'should': [{'term': {'field1': {'value': 'foo'}}}, {'term': {'message': {'value': 'bar'}}}]}}} )
+
+    def test_deep(self):
+
+        parser = yaesql.Parser(engine="fast")
+
+        q = parser.parseString( "(" * 80 + "foo" + ")" * 80 + " NOT (" * 40 + "bar" + ")" * 40 )
+
+        self.assertEqual( q.compile().render("message"), q.compose("message") )
+
+
+class TestComposeJson(unittest.TestCase):
+
+    def test_same_bytes(self):
+
+        import json
+        import random
+
+        rnd = random.Random(11)
+
+        parser = yaesql.Parser(engine="fast")
+
+        corpus  = [ _random_query(rnd) for i in range(1000) ]
+        corpus += [ 'f\u00e8:"caf\u00e9 \u65e5\u672c" r"\\d+"', 'x:(+"\u00e0" -b c)' ]
+
+        n = 0
+        for s in corpus:
+            try:
+                q = parser.parseString(s)
+                expected = json.dumps(q.compose("message")).encode('utf-8')
+            except Exception:
+                continue
+            self.assertEqual( q.compose_json("message"), expected, s )
+            n += 1
+
+        self.assertGreater(n, 300)
+
+    def test_buffer(self):
+
+        q = yaesql.Parser().parseString("field1:foo OR bar")
+
+        buf = bytearray(b'{}\n')
+        self.assertIs( q.compose_json("message", buf), buf )
+        self.assertEqual( bytes(buf), b'{}\n{"query": {"bool": {"should": [{"term": {"field1": {"value": "foo"}}}, {"term": {"message": {"value": "bar"}}}]}}}' )
+
+    def test_bare_values(self):
+
+        import json
+
+        # the values of field:(...) are term queries on the field, in the
+        # bool clauses too
+        parser = yaesql.Parser()
+
+        tests = [
+            (
+             'field1:(foo bar +x -y)',
+             {'query': {'bool': {'must': {'term': {'field1': {'value': 'x'}}}, 'must_not': {'term': {'field1': {'value': 'y'}}}, 'should': [{'term': {'field1': {'value': 'foo'}}}, {'term': {'field1': {'value': 'bar'}}}]}}}
+            ),
+            (
+             'field1:(-y) a',
+             {'query': {'bool': {'must': [{'bool': {'must_not': {'term': {'field1': {'value': 'y'}}}}}, {'term': {'message': {'value': 'a'}}}]}}}
+            ),
+        ]
+
+        for s, expected in tests:
+            q = parser.parseString(s)
+            self.assertEqual( q.compose("message"), expected, s )
+            self.assertEqual( q.compose_json("message"), json.dumps(expected).encode('utf-8'), s )
+
+
+def _reference_prettyformat(o, l=0, ind='    '):
+    # the original recursive implementation
+    s = ''
+    if isinstance(o, dict):
+        s += "{\n"
+        for k,v in o.items():
+            s += ind * (l+1)
+            s += '"%s" : %s' % (k, _reference_prettyformat(v, l+1, ind))
+        s += ind * l
+        s += "}\n"
+    elif isinstance(o, list):
+        s += "[\n"
+        for o2 in o:
+            s += ind * (l+1) + _reference_prettyformat(o2, l+1, ind) 
+            s += ind * (l+1) + ',\n'
+        s += ind * l
+        s +="]\n"
+    else:
+        s = repr(o) + '\n'
+    return s
+
+
+class TestPrettyFormat(unittest.TestCase):
+
+    def test_same_output(self):
+
+        import random
+
+        rnd = random.Random(3)
+
+        parser = yaesql.Parser(engine="fast")
+
+        for i in range(300):
+            try:
+                o = parser.parseString(_random_query(rnd)).compose("message")
+            except Exception:
+                continue
+            self.assertEqual( yaesql.prettyformat(o), _reference_prettyformat(o) )
+            self.assertEqual( yaesql.prettyformat(o, 2, '  '), _reference_prettyformat(o, 2, '  ') )
+
+        for o in [ {}, [], 'foo', 10, [ [], {} ], { 'a': [ 1, { 'b': None } ] } ]:
+            self.assertEqual( yaesql.prettyformat(o), _reference_prettyformat(o) )
+
+    def test_stream(self):
+
+        import io
+
+        o = { 'query': { 'bool': { 'should': [ { 'term': { 'f': { 'value': 'v%d' % i } } } for i in range(20000) ] } } }
+
+        fp = io.StringIO()
+        yaesql.prettywrite(o, fp)
+
+        self.assertEqual( fp.getvalue(), yaesql.prettyformat(o) )
+        self.assertEqual( fp.getvalue().count("'v"), 20000 )
+
+    def test_deep(self):
+
+        o = 'foo'
+        for i in range(5000):
+            o = { 'bool': { 'must': [ o ] } }
+
+        chunks = yaesql.iterprettyformat(o)
+        self.assertEqual( next(chunks), "{\n" )
+        self.assertEqual( sum(1 for c in chunks if c == "'foo'\n"), 1 )
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_backends(self):
+
+        import random
+
+        rnd = random.Random(5)
+        corpus = [ _random_query(rnd) for i in range(300) ] + [ ':bad' ]
+
+        parser = yaesql.Parser(engine="fast", cache_size=100)
+
+        expected = []
+        for s in corpus:
+            try:
+                expected.append( parser.parseString(s).compose("message") )
+            except Exception as e:
+                expected.append( type(e) )
+
+        for backend in [ 'serial', 'thread', 'process' ]:
+            results = list(parser.compose_many(corpus, "message", backend=backend, workers=2, chunksize=16))
+            results = [ type(r) if isinstance(r, Exception) else r for r in results ]
+            self.assertEqual(results, expected, backend)
+
+    def test_parse_many(self):
+
+        import json
+        import pyparsing as pp
+
+        parser = yaesql.Parser()
+
+        results = list(parser.parse_many([ "foo", ":bad", "field1:foo OR bar" ], backend='process', workers=2, chunksize=1))
+
+        self.assertEqual( results[0].dump(), "Query(SimpleTerm(STRING('foo')))" )
+        self.assertIsInstance( results[1], pp.ParseException )
+        self.assertEqual( json.dumps(results[2].compose("message")), '{"query": {"bool": {"should": [{"term": {"field1": {"value": "foo"}}}, {"term": {"message": {"value": "bar"}}}]}}}')
+
+        results = list(parser.compose_many(iter([ "foo" ]), "message", as_json=True))
+        self.assertEqual( results, [ b'{"query": {"term": {"message": {"value": "foo"}}}}' ] )
+
+    def test_limit_errors(self):
+
+        from yaesql.limits import QueryLimitError
+
+        parser = yaesql.Parser(engine="fast", max_depth=3)
+        corpus = [ "foo", "((((a))))", "field1:foo OR bar", "(((((b)))))" ]
+
+        for backend in [ 'thread', 'process' ]:
+            results = list(parser.compose_many(corpus, "message", backend=backend, workers=2, chunksize=1))
+
+            self.assertEqual( [ type(r).__name__ for r in results ], [ 'dict', 'QueryLimitError', 'dict', 'QueryLimitError' ], backend )
+            self.assertEqual( (results[3].limit, results[3].value, results[3].maximum), ('max_depth', 5, 3) )
+            self.assertEqual( str(results[3]), "Query exceeds max_depth: 5 > 3" )
+
+            results = list(parser.parse_many(corpus, backend=backend, workers=2, chunksize=2))
+            self.assertIsInstance( results[1], QueryLimitError, backend )
+
+    def test_bad_backend(self):
+
+        with self.assertRaises(ValueError):
+            yaesql.Parser().parse_many([ "foo" ], backend="gpu")
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def _run(self, argv, data):
+        import io
+        from yaesql.cli import main
+
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        stderr = io.StringIO()
+
+        rc = main(argv, stdin=io.StringIO(data), stdout=stdout, stderr=stderr)
+
+        stdout.flush()
+        return rc, stdout.buffer.getvalue(), stderr.getvalue()
+
+    def test_msearch(self):
+
+        rc, out, err = self._run([ "--msearch", "logs", "message" ], "foo\n\n:bad\nfield1:foo OR bar\n")
+
+        self.assertEqual( rc, 1 )
+        self.assertEqual( out.decode('utf-8').splitlines(), [
+            '{"index": "logs"}',
+            '{"query": {"term": {"message": {"value": "foo"}}}}',
+            '{"index": "logs"}',
+            '{"query": {"bool": {"should": [{"term": {"field1": {"value": "foo"}}}, {"term": {"message": {"value": "bar"}}}]}}}',
+        ])
+        self.assertTrue( err.startswith("line 3: ParseException") )
+
+    def test_msearch_json_input(self):
+
+        data = '{"query": "foo"}\n{"query": "bar", "index": "other"}\nnot json\n'
+
+        rc, out, err = self._run([ "--msearch", "--json-input", "-", "message" ], data)
+
+        self.assertEqual( rc, 1 )
+        self.assertEqual( out.decode('utf-8').splitlines(), [
+            '{}',
+            '{"query": {"term": {"message": {"value": "foo"}}}}',
+            '{"index": "other"}',
+            '{"query": {"term": {"message": {"value": "bar"}}}}',
+        ])
+        self.assertTrue( err.startswith("line 3: JSONDecodeError") )
+
+    def test_show(self):
+
+        import io
+        from yaesql.cli import main
+
+        out = io.StringIO()
+        self.assertEqual( main([ "logs", "message", "foo" ], stdout=out), 0 )
+        self.assertIn( "Query(SimpleTerm(STRING('foo')))", out.getvalue() )
+
+
+class TestCompactNodes(unittest.TestCase):
+
+    def _nodes(self, e):
+        yield e
+        for name in ('expr', 'value_expr'):
+            if isinstance(getattr(e, name, None), yaesql.Expr):
+                yield from self._nodes(getattr(e, name))
+        for c in getattr(e, 'exprs', ()):
+            yield from self._nodes(c)
+
+    def test_slots(self):
+
+        import pyparsing as pp
+
+        for engine in yaesql.Parser.ENGINES:
+            q = yaesql.Parser(engine=engine).parseString('NOT (a OR b AND c) f1:(x -y +z) f2:>=10 +r"x.*"')
+
+            for node in self._nodes(q):
+                self.assertFalse( hasattr(node, '__dict__'), node )
+                if hasattr(node, 'exprs'):
+                    self.assertIs( type(node.exprs), tuple )
+                self.assertNotIsInstance( getattr(node, 'expr', None), pp.ParseResults )
+
+    def test_interned(self):
+
+        parser = yaesql.Parser(engine="fast")
+
+        q1 = parser.parseString("".join([ "field", "1:foo" ]))
+        q2 = parser.parseString("".join([ "field1", ":foo" ]))
+
+        self.assertIs( q1.exprs[0].field_expr, q2.exprs[0].field_expr )
+        self.assertIs( q1.exprs[0].value_expr.expr.val, q2.exprs[0].value_expr.expr.val )
+
+    def test_pickle(self):
+
+        import pickle
+
+        q = yaesql.Parser().parseString('NOT (a OR b AND c) f1:(x -y +z) f2:>=10')
+        q2 = pickle.loads(pickle.dumps(q))
+
+        self.assertEqual( q2.dump(), q.dump() )
+        self.assertEqual( q2.compose("message"), q.compose("message") )
+
+
+class TestCanonical(unittest.TestCase):
+
+    def test_equivalent(self):
+
+        parser = yaesql.Parser(engine="fast")
+
+        groups = [
+            [ 'a AND b', 'b AND a', '(b a)', 'a b', '((a)) AND (b)', 'b (a)' ],
+            [ 'a OR (b OR c)', '(c OR b) OR a', '((a OR b) OR c)' ],
+            [ 'field1:foo', 'field1=foo', 'field1:"foo"', "field1 = 'foo'", '(field1:foo)' ],
+            [ 'field1:(a b -c)', 'field1=(-c b a)' ],
+            [ 'NOT (a)', 'NOT ((a))' ],
+            [ '+a -b c', 'c -b +a' ],
+            [ 'x:<=10 AND (y OR z)', '(z OR y) AND x:<=10', '(z OR y) x:<=10' ],
+        ]
+
+        fingerprints = set()
+        for group in groups:
+            queries = [ parser.parseString(s) for s in group ]
+
+            dsl = queries[0].canonical().compose("message")
+            fp  = queries[0].fingerprint()
+
+            for s, q in zip(group, queries):
+                self.assertEqual( q.canonical().compose("message"), dsl, s )
+                self.assertEqual( q.fingerprint(), fp, s )
+
+            fingerprints.add(fp)
+
+        self.assertEqual( len(fingerprints), len(groups) )
+
+    def test_not_equivalent(self):
+
+        parser = yaesql.Parser(engine="fast")
+
+        for s1, s2 in [ ('+a b', 'a b'), ('(+a) b', '+a b'), ('a OR b', 'a b'), ('a -b', '-a b'), ('x:<1', 'x:<=1') ]:
+            self.assertNotEqual( parser.parseString(s1).fingerprint(), parser.parseString(s2).fingerprint(), (s1, s2) )
+
+    def test_idempotent(self):
+
+        import random
+
+        rnd = random.Random(17)
+
+        parser = yaesql.Parser(engine="fast")
+
+        for i in range(500):
+            try:
+                q = parser.parseString(_random_query(rnd))
+            except Exception:
+                continue
+            c = q.canonical()
+            self.assertEqual( c.canonical().dump(), c.dump() )
+            self.assertFalse( c.is_sub )
+
+    def test_parentheses(self):
+
+        import random
+
+        from yaesql import Query, BoolExpr, AndExpr, OrExpr, NotExpr, BoolMust, BoolMustNot
+
+        parser = yaesql.Parser(engine="fast")
+        self.assertEqual( parser.parseString("((+a)) AND b").fingerprint(), parser.parseString("(+a) AND b").fingerprint() )
+        self.assertEqual( parser.parseString("((-7)) 10").fingerprint(), parser.parseString("(10 AND -7)").fingerprint() )
+
+        rnd = random.Random(19)
+
+        def wrap(e, in_query):
+            # the same tree with redundant parentheses added here and there
+            if isinstance(e, (Query, AndExpr, OrExpr)):
+                e = type(e)([ wrap(c, isinstance(e, Query) and len(e.exprs) > 1) for c in e.exprs ])
+            elif isinstance(e, (NotExpr, BoolMust, BoolMustNot)):
+                e = type(e)( wrap(e.expr, False) )
+            # (+a) is not +a among the clauses of a query
+            if rnd.random() < 0.4 and not (in_query and isinstance(e, BoolExpr)):
+                e = Query([ e ])
+            return e
+
+        docs = [ _random_doc(rnd) for i in range(30) ]
+
+        n = 0
+        while n < 500:
+            try:
+                q = parser.parseString(_random_query(rnd))
+            except Exception:
+                continue
+            n += 1
+
+            w = Query([ wrap(q, False) ])
+            for c in [ q.canonical(), w.canonical() ]:
+                self.assertEqual( c.canonical().dump(), c.dump(), q.dump() )
+
+            dsl = q.compose("message")
+            for other in [ w.compose("message"), w.canonical().compose("message") ]:
+                for doc in docs:
+                    self.assertEqual( _dsl_match(other, doc), _dsl_match(dsl, doc), (q.dump(), w.dump()) )
+
+            self.assertEqual( w.fingerprint(), q.fingerprint(), (q.dump(), w.dump()) )
+
+
+def _dsl_values(doc, field):
+    v = doc.get(field, [])
+    return v if isinstance(v, list) else [ v ]
+
+def _dsl_match(q, doc):
+    """
+    Reference matching semantics of the DSL produced by compose()
+    """
+    import re
+
+    def as_list(v):
+        return v if isinstance(v, list) else [ v ]
+
+    if 'query' in q:
+        q = q['query']
+
+    if 'constant_score' in q:
+        return _dsl_match(q['constant_score']['filter'], doc)
+
+    (kind, body), = q.items()
+
+    if kind == 'bool':
+        must     = as_list(body.get('must', [])) + as_list(body.get('filter', []))
+        should   = as_list(body.get('should', []))
+        must_not = as_list(body.get('must_not', []))
+
+        if not all([ _dsl_match(c, doc) for c in must ]):
+            return False
+        if any([ _dsl_match(c, doc) for c in must_not ]):
+            return False
+        if should and not must:
+            return any([ _dsl_match(c, doc) for c in should ])
+        return True
+
+    (field, spec), = body.items()
+    values = _dsl_values(doc, field)
+
+    # the fields are keywords: numbers match their string form
+    if kind == 'term':
+        return _keyword(spec['value']) in values
+    if kind == 'terms':
+        return any([ _keyword(v) in values for v in spec ])
+    if kind == 'regexp':
+        return any([ re.fullmatch(spec['value'], v) is not None for v in values ])
+    if kind == 'prefix':
+        return any([ v.startswith(spec['value']) for v in values ])
+    if kind == 'wildcard':
+        import fnmatch
+        return any([ fnmatch.fnmatchcase(v, spec['value']) for v in values ])
+    if kind == 'range':
+        ops = { 'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b, 'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b }
+        return any([ all([ ops[op](v, _keyword(b)) for op, b in spec.items() if op in ops ]) for v in values ])
+
+    raise ValueError(kind)
+
+def _keyword(v):
+    return v if isinstance(v, str) else str(v)
+
+def _random_doc(rnd):
+    values = [ 'foo', 'bar', 'x1', '10', '2020-03-20', 'a.b', 'esc"aped', 'E', 'ANGE', 'foo.bar', 'baar', 'r' ]
+    doc = {}
+    for field in [ 'message', 'field1', 'a.b', 'x' ]:
+        doc[field] = rnd.sample(values, rnd.randint(0, 3))
+    return doc
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def test_multi_value_terms(self):
+
+        import json
+
+        parser = yaesql.Parser()
+
+        q = parser.parseString("field1:(foo r'ba.*' +x -y)")
+
+        self.assertEqual( json.dumps(q.compose("message")), '{"query": {"bool": {"must": {"term": {"field1": {"value": "x"}}}, "must_not": {"term": {"field1": {"value": "y"}}}, "should": [{"term": {"field1": {"value": "foo"}}}, {"prefix": {"field1": {"value": "ba"}}}]}}}' )
+
+    def test_optimize(self):
+
+        parser = yaesql.Parser()
+
+        tests = [
+            (
+             'field1:(v1 v2 v3)',
+             {'query': {'terms': {'field1': ['v1', 'v2', 'v3']}}}
+            ),
+            (
+             'field1:(-v1 -v2)',
+             {'query': {'bool': {'must_not': {'terms': {'field1': ['v1', 'v2']}}}}}
+            ),
+            (
+             '(a OR b) OR (c OR field1:d)',
+             {'query': {'bool': {'should': [{'terms': {'message': ['a', 'b', 'c']}}, {'term': {'field1': {'value': 'd'}}}]}}}
+            ),
+            (
+             'a (b c) AND d',
+             {'query': {'bool': {'must': [{'term': {'message': {'value': 'a'}}}, {'term': {'message': {'value': 'b'}}}, {'term': {'message': {'value': 'c'}}}, {'term': {'message': {'value': 'd'}}}]}}}
+            ),
+            (
+             'NOT (a OR b)',
+             {'query': {'bool': {'must_not': {'terms': {'message': ['a', 'b']}}}}}
+            ),
+            (
+             '(foo)',
+             {'query': {'term': {'message': {'value': 'foo'}}}}
+            ),
+        ]
+
+        for s, expected in tests:
+            q = parser.parseString(s)
+            self.assertEqual( q.compose("message", optimize=True), expected, s )
+            self.assertEqual( q.compile(optimize=True).render("message"), expected, s )
+
+    def test_default_field_named(self):
+
+        parser = yaesql.Parser()
+
+        q = parser.parseString('message:a OR b')
+        compiled = q.compile(optimize=True)
+        prepared = parser.prepare('message:a OR b', "message", optimize=True)
+
+        self.assertEqual( compiled.render("message"), {'query': {'terms': {'message': ['a', 'b']}}} )
+        self.assertEqual( prepared.bind(), {'query': {'terms': {'message': ['a', 'b']}}} )
+        for f in [ "message", "x" ]:
+            self.assertEqual( compiled.render(f), q.compose(f, optimize=True), f )
+            self.assertEqual( prepared.render(f), q.compose(f, optimize=True), f )
+
+    def test_input_unchanged(self):
+
+        import copy
+        from yaesql.optimizer import optimize
+
+        dsl = yaesql.Parser().parseString('(a OR b) OR field1:(c -d -e)').compose("message")
+        saved = copy.deepcopy(dsl)
+
+        optimize(dsl)
+
+        self.assertEqual(dsl, saved)
+
+    def test_equivalent(self):
+
+        import random
+
+        rnd = random.Random(23)
+
+        parser = yaesql.Parser(engine="fast")
+        docs = [ _random_doc(rnd) for i in range(60) ]
+
+        n = 0
+        while n < 400:
+            try:
+                q = parser.parseString(_random_query(rnd))
+                dsl = q.compose("message")
+            except Exception:
+                continue
+            n += 1
+
+            optimized = q.compose("message", optimize=True)
+
+            for doc in docs:
+                self.assertEqual( _dsl_match(optimized, doc), _dsl_match(dsl, doc), (q.dump(), doc) )
+
+
+class TestFilterContext(unittest.TestCase):
+
+    def test_modes(self):
+
+        parser = yaesql.Parser()
+
+        tests = [
+            (
+             'a field1:foo x:<10',
+             {'query': {'constant_score': {'filter': {'bool': {'filter': [{'term': {'message': {'value': 'a'}}}, {'term': {'field1': {'value': 'foo'}}}, {'range': {'x': {'lt': 10}}}]}}}}},
+             {'query': {'bool': {'must': {'term': {'message': {'value': 'a'}}}, 'filter': [{'term': {'field1': {'value': 'foo'}}}, {'range': {'x': {'lt': 10}}}]}}},
+            ),
+            (
+             'field1:foo -field2:bar',
+             {'query': {'constant_score': {'filter': {'bool': {'must_not': {'term': {'field2': {'value': 'bar'}}}, 'filter': {'term': {'field1': {'value': 'foo'}}}}}}}},
+             {'query': {'constant_score': {'filter': {'bool': {'must_not': {'term': {'field2': {'value': 'bar'}}}, 'filter': {'term': {'field1': {'value': 'foo'}}}}}}}},
+            ),
+            (
+             'a',
+             {'query': {'constant_score': {'filter': {'term': {'message': {'value': 'a'}}}}}},
+             {'query': {'term': {'message': {'value': 'a'}}}},
+            ),
+        ]
+
+        for s, filtered, auto in tests:
+            q = parser.parseString(s)
+            self.assertEqual( q.compose("message", mode="filter"), filtered, s )
+            self.assertEqual( q.compose("message", mode="auto"), auto, s )
+            self.assertEqual( q.compile(mode="auto").render("message"), auto, s )
+            self.assertEqual( q.compose("message", mode="query"), q.compose("message") )
+
+    def test_default_field_named(self):
+
+        parser = yaesql.Parser()
+
+        s = 'message:foo x:<3'
+        q = parser.parseString(s)
+
+        self.assertEqual( q.compile(mode="auto").render("message"),
+            {'query': {'bool': {'must': {'term': {'message': {'value': 'foo'}}}, 'filter': {'range': {'x': {'lt': 3}}}}}} )
+
+        for options in [ { 'mode': 'filter' }, { 'mode': 'auto' }, { 'mode': 'auto', 'optimize': True } ]:
+            compiled = q.compile(**options)
+            prepared = parser.prepare(s, "message", **options)
+            for f in [ "message", "x" ]:
+                self.assertEqual( compiled.render(f), q.compose(f, **options), (f, options) )
+                self.assertEqual( prepared.render(f), q.compose(f, **options), (f, options) )
+
+    def test_compiled_equal(self):
+
+        import random
+
+        rnd = random.Random(31)
+
+        parser = yaesql.Parser(engine="fast")
+
+        n = 0
+        while n < 300:
+            try:
+                q = parser.parseString(_random_query(rnd))
+                q.compose("message")
+            except Exception:
+                continue
+            n += 1
+
+            for options in [ { 'mode': 'auto' }, { 'optimize': True } ]:
+                compiled = q.compile(**options)
+                for f in [ "message", "field1" ]:
+                    self.assertEqual( compiled.render(f), q.compose(f, **options), (q.dump(), f, options) )
+
+    def test_unknown_mode(self):
+
+        q = yaesql.Parser().parseString('a')
+
+        with self.assertRaises(ValueError):
+            q.compose("message", mode="scoring")
+
+    def test_equivalent(self):
+
+        import random
+
+        rnd = random.Random(29)
+
+        parser = yaesql.Parser(engine="fast")
+        docs = [ _random_doc(rnd) for i in range(60) ]
+
+        n = 0
+        while n < 300:
+            try:
+                q = parser.parseString(_random_query(rnd))
+                dsl = q.compose("message")
+            except Exception:
+                continue
+            n += 1
+
+            for options in [ { 'mode': 'filter' }, { 'mode': 'auto' }, { 'mode': 'auto', 'optimize': True } ]:
+                other = q.compose("message", **options)
+                for doc in docs:
+                    self.assertEqual( _dsl_match(other, doc), _dsl_match(dsl, doc), (q.dump(), options, doc) )
+
+
+def _wildcard_match(pattern, s):
+    import re
+    return re.fullmatch(''.join([ '.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern ]), s, re.DOTALL) is not None
+
+class TestRegexRewrite(unittest.TestCase):
+
+    def test_analyze(self):
+
+        from yaesql.regex import analyze
+
+        tests = [
+            ( 'error'     , ('term'    , 'error'   ) ),
+            ( 'a\\.b'     , ('term'    , 'a.b'     ) ),
+            ( 'err.*'     , ('prefix'  , 'err'     ) ),
+            ( 'e.r.*or'   , ('wildcard', 'e?r*or'  ) ),
+            ( '.*'        , ('wildcard', '*'       ) ),
+            ( 'a\\*.*'    , ('prefix'  , 'a*'      ) ),
+            ( 'a\\*.b'    , ('regexp'  , 'a\\*.b'  ) ),
+            ( 'fo+'       , ('regexp'  , 'fo+'     ) ),
+            ( 'a|b'       , ('regexp'  , 'a|b'     ) ),
+            ( '[ab].*'    , ('regexp'  , '[ab].*'  ) ),
+            ( 'a.*?'      , ('regexp'  , 'a.*?'    ) ),
+            ( 'a.**'      , ('regexp'  , 'a.**'    ) ),
+            ( 'a@'        , ('regexp'  , 'a@'      ) ),
+            ( 'a\\'       , ('regexp'  , 'a\\'     ) ),
+            ( ''          , ('regexp'  , ''        ) ),
+            # character classes
+            ( '\\d'       , ('regexp'  , '\\d'     ) ),
+            ( 'a\\s.*'    , ('regexp'  , 'a\\s.*'  ) ),
+            ( '\\W.b'     , ('regexp'  , '\\W.b'   ) ),
+        ]
+
+        for pattern, expected in tests:
+            self.assertEqual( analyze(pattern), expected, pattern )
+
+    def test_equivalent(self):
+
+        #
+        # Every pattern up to 4 tokens over a small alphabet, against every
+        # string up to 4 characters
+        #
+        import itertools
+        import re
+
+        from yaesql.regex import analyze
+
+        tokens  = [ 'a', 'b', '.', '*', '+', '?', '|', '\\.', '\\*', '(', ')', '[ab]' ]
+        strings = [ ''.join(t) for n in range(5) for t in itertools.product('ab.*', repeat=n) ]
+
+        rewritten = 0
+        for n in range(5):
+            for t in itertools.product(tokens, repeat=n):
+                pattern = ''.join(t)
+                kind, value = analyze(pattern)
+                if kind == 'regexp':
+                    continue
+                rewritten += 1
+
+                regex = re.compile(pattern, re.DOTALL)
+
+                for s in strings:
+                    if kind == 'term':
+                        matched = (s == value)
+                    elif kind == 'prefix':
+                        matched = s.startswith(value)
+                    else:
+                        matched = _wildcard_match(value, s)
+                    self.assertEqual( matched, regex.fullmatch(s) is not None, (pattern, kind, value, s) )
+
+        self.assertTrue( rewritten > 500 )
+
+    def test_compose(self):
+
+        import json
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            q = parser.parseString('r"err.*" f1:(r"a.b" -r"x") f2:r"a|b"')
+
+            expected = '{"query": {"bool": {"must": [{"prefix": {"message": {"value": "err"}}}, {"bool": {"must_not": {"term": {"f1": {"value": "x"}}}, "should": {"wildcard": {"f1": {"value": "a?b"}}}}}, {"regexp": {"f2": {"value": "a|b"}}}]}}}'
+
+            self.assertEqual( json.dumps(q.compose("message")), expected )
+            self.assertEqual( q.compose_json("message").decode('utf-8'), expected )
+            self.assertEqual( q.compile().render("message"), json.loads(expected) )
+            self.assertIn( { 'prefix': { 'message': { 'value': 'err' } } }, q.canonical().compose("message")['query']['bool']['must'] )
+
+    def test_opt_out(self):
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine, rewrite_regex=False)
+
+            q = parser.parseString('r"err.*"')
+
+            self.assertEqual( q.compose("message"), { 'query': { 'regexp': { 'message': { 'value': 'err.*' } } } } )
+            self.assertEqual( q.compose_json("message"), b'{"query": {"regexp": {"message": {"value": "err.*"}}}}' )
+
+
+def _dsl_size(q):
+    """
+    (leaf queries, bool nesting depth) of a composed query
+    """
+    (kind, body), = q.items()
+    if kind != 'bool':
+        return 1, 0
+
+    clauses = 0
+    depth   = 0
+    for v in body.values():
+        for c in (v if isinstance(v, list) else [ v ]):
+            n, d = _dsl_size(c)
+            clauses += n
+            depth = max(depth, d)
+    return clauses, depth + 1
+
+class TestCost(unittest.TestCase):
+
+    def test_cost(self):
+
+        parser = yaesql.Parser()
+
+        c = parser.parseString('NOT (a OR b) x:>1 r".*foo" f:r"ab.*" f:(r"a.b" r"fo+")').cost("message", field_weights={ 'f': 3 })
+
+        self.assertEqual( c.clauses, 7 )
+        self.assertEqual( c.depth, 3 )
+        self.assertEqual( c.regexes, { 'prefix': 1, 'wildcard': 2, 'regexp': 1 } )
+        self.assertEqual( c.leading_wildcards, 1 )
+        self.assertEqual( c.cost, 1 + 1 + 2 + 100 + 3 * (5 + 10 + 25) )
+
+        c = parser.parseString('a f:b').cost("message", weights={ 'term': 2 }, field_weights={ 'message': 10 })
+
+        self.assertEqual( c.cost, 2 * 10 + 2 )
+
+    def test_matches_dsl(self):
+
+        import random
+
+        rnd = random.Random(31)
+
+        parser = yaesql.Parser(engine="fast")
+
+        n = 0
+        while n < 500:
+            try:
+                q = parser.parseString(_random_query(rnd))
+                dsl = q.compose("message")
+            except Exception:
+                continue
+            n += 1
+
+            c = q.cost("message")
+
+            self.assertEqual( (c.clauses, c.depth), _dsl_size(dsl['query']), q.dump() )
+
+    def test_validate(self):
+
+        from yaesql.analysis import QueryBudgetError
+
+        parser = yaesql.Parser()
+
+        q = parser.parseString('field1:(%s) r".*x" r"y.*z"' % (' '.join([ 'v%d' % i for i in range(2000) ])))
+
+        self.assertEqual( q.validate({ 'clauses': 5000, 'regexes': 2 }).clauses, 2002 )
+
+        with self.assertRaises(QueryBudgetError) as ctx:
+            q.validate({ 'clauses': 1024, 'depth': 5, 'regexes': 1, 'leading_wildcards': None })
+
+        self.assertEqual( ctx.exception.violations, [ ('clauses', 2002, 1024), ('regexes', 2, 1) ] )
+        self.assertTrue( isinstance(ctx.exception, ValueError) )
+
+        with self.assertRaises(ValueError):
+            q.validate({ 'size': 1 })
+
+    def test_pickle_errors(self):
+
+        import pickle
+
+        from yaesql.analysis import QueryBudgetError
+        from yaesql.limits import QueryLimitError
+
+        with self.assertRaises(QueryBudgetError) as ctx:
+            yaesql.Parser().parseString('a b c').validate({ 'clauses': 2 })
+
+        for e in [ ctx.exception, QueryLimitError('max_tokens', 12, 10), QueryLimitError('max_depth', 5000, None, "Query too deeply nested: depth 5000") ]:
+            copy = pickle.loads(pickle.dumps(e))
+            self.assertIs( type(copy), type(e) )
+            self.assertEqual( str(copy), str(e) )
+            self.assertEqual( copy.__dict__, e.__dict__ )
+
+    def test_deep(self):
+
+        q = yaesql.Parser(engine="fast").parseString( "NOT (" * 150 + "foo" + ")" * 150 )
+
+        self.assertEqual( q.cost().depth, 150 )
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_corpus(self):
+
+        from benchmarks.corpus import generate
+
+        self.assertEqual( generate(20, seed=3), generate(20, seed=3) )
+        self.assertNotEqual( generate(20, seed=3), generate(20, seed=4) )
+
+        p1 = yaesql.Parser()
+        p2 = yaesql.Parser(engine="fast")
+
+        for size, depth in [ (1, 0), (8, 2), (24, 4) ]:
+            for s in generate(40, 11, size, depth):
+                q = p2.parseString(s)
+                self.assertEqual( p1.parseString(s).dump(), q.dump(), s )
+                q.compose("message")
+
+    def test_run(self):
+
+        from benchmarks.corpus import generate
+        from benchmarks import suite
+
+        r = suite.run('compose', generate(20), repeat=1)
+
+        self.assertEqual( r.ops, 20 )
+        self.assertTrue( r.throughput > 0 and r.p50 <= r.p95 <= r.p99 )
+
+    def test_check(self):
+
+        from benchmarks import suite
+
+        baseline = { 'threshold': 0.3, 'thresholds': { 'b': 0.5 }, 'scores': { 'a': 10.0, 'b': 10.0 } }
+
+        def result(name, throughput):
+            return suite.Result(name, 1, throughput, 0, 0, 0, 0)
+
+        self.assertEqual( suite.check([ result('a', 80.0), result('b', 60.0), result('c', 1.0) ], 10.0, baseline), [] )
+        self.assertEqual( suite.check([ result('a', 60.0), result('b', 40.0) ], 10.0, baseline), [ ('a', 6.0, 10.0), ('b', 4.0, 10.0) ] )
+        self.assertEqual( suite.check([ result('a', 80.0) ], 10.0, baseline, threshold=0.1), [ ('a', 8.0, 10.0) ] )
+
+    def test_scaling(self):
+
+        from benchmarks import scaling
+
+        self.assertAlmostEqual( scaling.slope([ (100, 1.0), (200, 2.0), (400, 4.0) ]), 1.0 )
+        self.assertAlmostEqual( scaling.slope([ (100, 1.0), (200, 4.0), (400, 16.0) ]), 2.0 )
+
+        parser = yaesql.Parser(engine="fast")
+
+        for name, build in scaling.FAMILIES + [ ('fuzzed_corpus', scaling.fuzz_family()) ]:
+            points = scaling.measure(parser, build, [ 40, 80 ], repeat=1)
+            self.assertEqual( [ n for n, t in points ], [ 40, 80 ], name )
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_parse_events(self):
+
+        for engine in yaesql.Parser.ENGINES:
+            events = []
+            parser = yaesql.Parser(engine=engine, instrument=events.append, cache_size=10)
+
+            q = parser.parseString('a AND b field1:(x y) NOT c')
+            parser.parseString('a AND b  field1:(x y) NOT c')
+
+            with self.assertRaises(Exception):
+                parser.parseString(':bad')
+
+            self.assertEqual( [ e['cache'] for e in events ], [ 'miss', 'hit', 'miss' ] )
+            self.assertEqual( [ e['error'] for e in events ], [ None, None, 'ParseException' ] )
+            self.assertEqual( events[0]['length'], 26 )
+            self.assertEqual( events[0]['engine'], engine )
+            self.assertEqual( events[0]['nodes'], { 'StringLiteral': 5, 'SimpleTerm': 3, 'AndExpr': 1, 'MultiValue': 1, 'ComplexTerm': 1, 'NotExpr': 1, 'Query': 1 } )
+            self.assertEqual( events[1]['nodes'], {} )
+
+            e = events[0]
+            self.assertTrue( 0 < e['actions_seconds'] < e['seconds'] )
+            self.assertAlmostEqual( e['actions_seconds'] + e['match_seconds'], e['seconds'] )
+
+            self.assertEqual( q.dump(), yaesql.Parser(engine=engine).parseString('a AND b field1:(x y) NOT c').dump() )
+
+    def test_compose_events(self):
+
+        events = []
+        parser = yaesql.Parser(instrument=events.append)
+
+        dsl = parser.compose('field1:(a b)', 'message', optimize=True, mode='filter')
+
+        self.assertEqual( dsl, parser.parseString('field1:(a b)').compose('message', optimize=True, mode='filter') )
+        self.assertEqual( [ e['phase'] for e in events ], [ 'parse', 'compose', 'parse' ] )
+
+        e = events[1]
+        self.assertEqual( e['options'], { 'optimize': True, 'mode': 'filter', 'mapping': False } )
+        self.assertEqual( e['field'], 'message' )
+        self.assertAlmostEqual( e['compose_seconds'] + e['optimize_seconds'], e['seconds'] )
+
+    def test_compose_mapping(self):
+
+        events = []
+        parser = yaesql.Parser(instrument=events.append)
+
+        s = 'title:foo bytes:"10" x:1'
+        dsl = parser.compose(s, 'message', mapping=_MAPPING, mode='auto')
+
+        self.assertEqual( dsl, yaesql.Parser().parseString(s).compose('message', mapping=_MAPPING, mode='auto') )
+        self.assertEqual( events[1]['options'], { 'optimize': False, 'mode': 'auto', 'mapping': True } )
+
+    def test_metrics(self):
+
+        import pickle
+
+        from yaesql.instrument import Metrics
+
+        metrics = Metrics(keep=2)
+        parser = yaesql.Parser(engine="fast", instrument=metrics)
+
+        for s in [ 'a', 'a b', 'a b c', ':bad' ]:
+            try:
+                parser.compose(s, 'message')
+            except Exception:
+                pass
+
+        snapshot = metrics.snapshot()
+
+        self.assertEqual( snapshot['phases']['parse']['count'], 4 )
+        self.assertEqual( snapshot['phases']['parse']['errors'], 1 )
+        self.assertEqual( snapshot['phases']['parse']['length'], 1 + 3 + 5 + 4 )
+        self.assertEqual( snapshot['phases']['compose']['count'], 3 )
+        self.assertEqual( snapshot['nodes']['StringLiteral'], 6 )
+        self.assertEqual( len(snapshot['slowest']), 2 )
+        self.assertTrue( snapshot['slowest'][0][0] >= snapshot['slowest'][1][0] )
+
+        self.assertEqual( pickle.loads(pickle.dumps(parser)).instrument.snapshot()['phases'], {} )
+
+        metrics.reset()
+        self.assertEqual( metrics.snapshot()['phases'], {} )
+
+    def test_disabled(self):
+
+        parser = yaesql.Parser(engine="fast")
+
+        self.assertIs( parser.parser.factory, parser )
+        self.assertEqual( parser.compose('a', 'message'), parser.parseString('a').compose('message') )
+
+
+class TestLimits(unittest.TestCase):
+
+    def test_limits(self):
+
+        from yaesql.limits import QueryLimitError
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine, max_length=100, max_depth=3, max_tokens=10)
+
+            tests = [
+                ( 'a' * 101              , 'max_length', 101, 100 ),
+                ( '((((a))))'            , 'max_depth' , 4  , 3   ),
+                ( 'a b c d e f g h i j k', 'max_tokens', 11 , 10  ),
+                ( 'f:(a b c d e f g h i)', 'max_tokens', 12 , 10  ),
+            ]
+
+            for s, limit, value, maximum in tests:
+                with self.assertRaises(QueryLimitError) as ctx:
+                    parser.parseString(s)
+                e = ctx.exception
+                self.assertEqual( (e.limit, e.value, e.maximum), (limit, value, maximum), s )
+                self.assertTrue( isinstance(e, ValueError) )
+
+            # parentheses in quoted strings do not count
+            self.assertEqual( parser.parseString('"((((" (((a)))').dump(), yaesql.Parser().parseString('"((((" (((a)))').dump() )
+            self.assertEqual( parser.parseString('a' * 100).dump(), "Query(SimpleTerm(STRING('%s')))" % ('a' * 100) )
+
+    def test_timeout(self):
+
+        import yaesql.limits
+
+        from yaesql.limits import QueryLimitError
+
+        ticks = iter(range(0, 10**6, 1))
+
+        clock = yaesql.limits._clock
+        yaesql.limits._clock = lambda: next(ticks)
+        try:
+            for engine in yaesql.Parser.ENGINES:
+                parser = yaesql.Parser(engine=engine, timeout=5.5)
+
+                parser.parseString('a')
+
+                with self.assertRaises(QueryLimitError) as ctx:
+                    parser.parseString('a b c d e f g')
+                self.assertEqual( ctx.exception.limit, 'timeout' )
+        finally:
+            yaesql.limits._clock = clock
+
+    def test_recursion(self):
+
+        from yaesql.limits import QueryLimitError
+
+        with self.assertRaises(QueryLimitError) as ctx:
+            yaesql.Parser(engine="pyparsing").parseString('(' * 5000 + 'a' + ')' * 5000)
+        self.assertEqual( ctx.exception.value, 5000 )
+
+        # the fast engine parses groups without recursion
+        q = yaesql.Parser(engine="fast").parseString('(' * 5000 + 'a' + ')' * 5000)
+        self.assertEqual( q.dump(), 'Query(' * 5001 + "SimpleTerm(STRING('a'))" + ')' * 5001 )
+
+    def test_instrumented(self):
+
+        from yaesql.limits import QueryLimitError
+
+        events = []
+        parser = yaesql.Parser(engine="fast", instrument=events.append, max_depth=2, timeout=60)
+
+        self.assertEqual( parser.parseString('(a) b').dump(), "Query(Query(SimpleTerm(STRING('a'))) SimpleTerm(STRING('b')))" )
+        self.assertEqual( events[0]['nodes']['StringLiteral'], 2 )
+
+        with self.assertRaises(QueryLimitError):
+            parser.parseString('(((a)))')
+
+class TestDeepTrees(unittest.TestCase):
+
+    def _chain(self, n):
+        # Query(f:(v<n-1> NOT(... (v1 NOT(v0)))))
+        from yaesql import Query, NotExpr, SimpleTerm, StringLiteral, ComplexTerm
+        node = Query([ SimpleTerm(StringLiteral('v0')) ])
+        for i in range(1, n):
+            node = Query([ SimpleTerm(StringLiteral('v%d' % i)), NotExpr(node) ])
+        return Query([ ComplexTerm('f', node) ])
+
+    def test_deeper_than_the_stack(self):
+        import sys
+
+        n = sys.getrecursionlimit() * 5
+        q = self._chain(n)
+
+        # compose
+        d = q.compose('message')['query']
+        for i in range(n - 1, 0, -1):
+            must = d['bool']['must']
+            self.assertEqual( must[0], { 'term': { 'f': { 'value': 'v%d' % i } } } )
+            d = must[1]['bool']['must_not']
+        self.assertEqual( d, { 'term': { 'f': { 'value': 'v0' } } } )
+
+        # compose_json
+        expected = [ '{"query": ' ]
+        for i in range(n - 1, 0, -1):
+            expected.append( '{"bool": {"must": [{"term": {"f": {"value": "v%d"}}}, {"bool": {"must_not": ' % i )
+        expected.append( '{"term": {"f": {"value": "v0"}}}' + '}}]}}' * (n - 1) + '}' )
+        self.assertEqual( q.compose_json('message'), ''.join(expected).encode('utf-8') )
+
+        # dump
+        expected = [ 'Query(ComplexTerm(f:' ]
+        for i in range(n - 1, 0, -1):
+            expected.append( "Query(SimpleTerm(STRING('v%d')) NOT(" % i )
+        expected.append( "Query(SimpleTerm(STRING('v0')))" + '))' * (n - 1) + '))' )
+        self.assertEqual( q.dump(), ''.join(expected) )
+
+    def test_recursive_walks(self):
+        from yaesql.limits import QueryLimitError
+
+        n = 3000
+        q = self._chain(n)
+
+        mapping = { 'properties': { 'f': { 'type': 'keyword' } } }
+        walks = [
+            ('compose optimize'   , lambda: q.compose('message', optimize=True)),
+            ('compose mode'       , lambda: q.compose('message', mode='filter')),
+            ('compose mapping'    , lambda: q.compose('message', mapping=mapping)),
+            ('compose_json'       , lambda: q.compose_json('message', optimize=True)),
+            ('compile'            , lambda: q.compile()),
+            ('compile optimize'   , lambda: q.compile(optimize=True).render('message')),
+            ('prepare'            , lambda: q.prepare('message')),
+            ('canonical'          , lambda: q.canonical()),
+            ('fingerprint'        , lambda: q.fingerprint()),
+            ('evaluator'          , lambda: q.evaluator('message')),
+        ]
+        for name, walk in walks:
+            with self.assertRaises(QueryLimitError, msg=name) as ctx:
+                walk()
+            self.assertEqual( (ctx.exception.limit, ctx.exception.value), ('max_depth', n), name )
+            self.assertEqual( str(ctx.exception), "Query too deeply nested: depth %d" % (n,), name )
+
+        # the same walks of a shallower tree
+        q = self._chain(20)
+        for name, walk in walks:
+            walk()
+
+    def test_parsed(self):
+        from yaesql import Query, NotExpr, SimpleTerm, StringLiteral
+
+        n = 1000
+        s = 'v0'
+        expected = Query([ SimpleTerm(StringLiteral('v0')) ])
+        for i in range(1, n):
+            s = 'v%d NOT (%s)' % (i, s)
+            expected = Query([ SimpleTerm(StringLiteral('v%d' % i)), NotExpr(expected) ])
+
+        q = yaesql.Parser(engine="fast").parseString(s)
+
+        self.assertEqual( q.dump(), expected.dump() )
+        self.assertEqual( q.compose_json('message'), expected.compose_json('message') )
+
+        d = q.compose('message')['query']
+        for i in range(n - 1, 0, -1):
+            must = d['bool']['must']
+            self.assertEqual( must[0], { 'term': { 'message': { 'value': 'v%d' % i } } } )
+            d = must[1]['bool']['must_not']
+        self.assertEqual( d, { 'term': { 'message': { 'value': 'v0' } } } )
+
+    def test_walk(self):
+        from benchmarks.corpus import generate
+
+        parser = yaesql.Parser(engine="fast")
+        for s in generate(300, seed=5, size=10, depth=4):
+            q = parser.parseString(s)
+
+            self.assertEqual( yaesql._compose_tree(q, 'message', yaesql._QUERY), q.compose('message'), s )
+            self.assertEqual( yaesql._dump_tree(q, yaesql._QUERY), q.dump(), s )
+
+            out = []
+            yaesql._write_json_tree(q, 'message', out, yaesql._QUERY)
+            self.assertEqual( ''.join(out).encode('utf-8'), q.compose_json('message'), s )
+
+    def test_subclasses(self):
+        import sys
+
+        class Upper(yaesql.SimpleTerm):
+            __slots__ = ()
+            def compose(self, field_name):
+                return { 'match': { field_name: self.expr.val.upper() } }
+
+        class Or(yaesql.OrExpr):
+            __slots__ = ()
+
+        n = sys.getrecursionlimit() * 2
+        node = yaesql.Query([ Upper(yaesql.StringLiteral('a')) ])
+        for i in range(n):
+            node = yaesql.Query([ Or([ yaesql.SimpleTerm(yaesql.StringLiteral('b')), node ]) ])
+        node = yaesql.Query([ node ])
+
+        d = node.compose('m')['query']
+        for i in range(n):
+            self.assertEqual( d['bool']['should'][0], { 'term': { 'm': { 'value': 'b' } } } )
+            d = d['bool']['should'][1]
+        self.assertEqual( d, { 'match': { 'm': 'A' } } )
+
+        self.assertEqual( Or._compose_kind, yaesql._OR )
+        self.assertEqual( Upper._compose_kind, yaesql._LEAF )
+
+class TestPreparedQuery(unittest.TestCase):
+
+    def test_grammar(self):
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            self.assertEqual( parser.parseString('user:$uid AND ts:>=$from_1 f:($a -$b) $c "$d"').dump(),
+                "Query((ComplexTerm(user:SimpleTerm(PARAM('uid'))) AND ComplexTerm(ts:COMPARE(>=, PARAM('from_1')))) "
+                "ComplexTerm(f:VALUES(PARAM('a'), MustNot(PARAM('b')))) SimpleTerm(PARAM('c')) SimpleTerm(STRING('$d')))" )
+
+            for s in [ '$', '$1', 'f:$', 'f:$a.b' ]:
+                with self.assertRaises(Exception):
+                    parser.parseString(s)
+
+    def test_bind(self):
+
+        tests = [
+            ('user:$uid AND timestamp:>=$from', { 'uid': 'u1', 'from': '2020-01-01' }, 'user:"u1" AND timestamp:>="2020-01-01"'),
+            ('$q f:($a -$b) +g:$c'            , { 'q': 'x', 'a': 'y', 'b': 'z', 'c': 'w' }, 'x f:(y -z) +g:w'),
+            ('f:$a OR f:$b OR f:c'            , { 'a': 'a', 'b': 'b' }, 'f:a OR f:b OR f:c'),
+        ]
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            for s, params, expected in tests:
+                q = parser.parseString(expected)
+                for options in [ {}, { 'optimize': True }, { 'mode': 'auto' } ]:
+                    prepared = parser.prepare(s, "message", **options)
+
+                    self.assertEqual( prepared.params, frozenset(params) )
+                    self.assertEqual( prepared.bind(**params), q.compose("message", **options), s )
+                    self.assertEqual( prepared.render("x", **params), q.compose("x", **options), s )
+
+    def test_values(self):
+
+        prepared = yaesql.Parser().prepare('user:$uid count:>$n', "message")
+
+        # values are matched as they are, never parsed
+        for v in [ 'a" OR *:*', ') OR (x', 'NOT', '', 10, 2.5, True ]:
+            self.assertEqual( prepared.bind(uid=v, n=v), {'query': {'bool': {'must': [{'term': {'user': {'value': v}}}, {'range': {'count': {'gt': v}}}]}}} )
+
+        r = prepared.bind(uid='a', n=1)
+        r['query']['bool']['must'].append(None)
+        self.assertEqual( len(prepared.bind(uid='a', n=1)['query']['bool']['must']), 2 )
+
+    def test_errors(self):
+
+        prepared = yaesql.Parser().prepare('user:$uid count:>$n', "message")
+
+        with self.assertRaises(TypeError):
+            prepared.bind(uid='a')
+        with self.assertRaises(TypeError):
+            prepared.bind(uid='a', n=1, x=2)
+        with self.assertRaises(TypeError):
+            prepared.bind(uid=['a'], n=1)
+        with self.assertRaises(TypeError):
+            prepared.bind(uid=None, n=1)
+
+        q = yaesql.Parser().parseString('user:$uid')
+        self.assertEqual( repr(q.compose("message")), "{'query': {'term': {'user': {'value': $uid}}}}" )
+        with self.assertRaises(ValueError):
+            q.compose_json("message")
+
+class TestTypedLiterals(unittest.TestCase):
+
+    def test_values(self):
+        import json
+
+        tests = [
+            ('x:10'                      , {'term': {'x': {'value': 10}}}),
+            ('x:(0.5 -2.0)'              , {'bool': {'must_not': {'term': {'x': {'value': 2.0}}}, 'should': {'term': {'x': {'value': 0.5}}}}}),
+            ('x:<=10'                    , {'range': {'x': {'lte': 10}}}),
+            ('x:>-2.5'                   , {'range': {'x': {'gt': -2.5}}}),
+            ('x:< +3'                    , {'range': {'x': {'lt': 3}}}),
+            ('x:>2020-03-20'             , {'range': {'x': {'gt': '2020-03-20'}}}),
+            ('x:>=now-1d/d'              , {'range': {'x': {'gte': 'now-1d/d'}}}),
+            ('x:<2020-03-20||+1M/d'      , {'range': {'x': {'lt': '2020-03-20||+1M/d'}}}),
+            # quoted values are strings
+            ('x:"10"'                    , {'term': {'x': {'value': '10'}}}),
+            ("x:<='10'"                  , {'range': {'x': {'lte': '10'}}}),
+            # not whole numbers, or not fitting a JSON number
+            ('x:(007 10.0.0.1 10a 1e999)', {'bool': {'should': [{'term': {'x': {'value': v}}} for v in [ '007', '10.0.0.1', '10a', '1e999' ]]}}),
+            ('x:18446744073709551616'    , {'term': {'x': {'value': '18446744073709551616'}}}),
+            # numbers written otherwise in JSON keep their form
+            ('x:(1.10 0.50 1e3 1E+3)'    , {'bool': {'should': [{'term': {'x': {'value': v}}} for v in [ '1.10', '0.50', '1e3', '1E+3' ]]}}),
+            ('x:>=1.50'                  , {'range': {'x': {'gte': '1.50'}}}),
+            ('x:>+1.5'                   , {'range': {'x': {'gt': 1.5}}}),
+            ('x:1e+20'                   , {'term': {'x': {'value': 1e+20}}}),
+        ]
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            for s, expected in tests:
+                q = parser.parseString(s)
+                self.assertEqual( q.compose("message"), { 'query': expected }, s )
+                self.assertEqual( q.compose_json("message"), json.dumps({ 'query': expected }).encode('utf-8'), s )
+
+            self.assertEqual( parser.parseString('1 2020-03-20T10:00:00.5+01:00 now nowhere 2020-13-01').dump(), 
+                "Query(SimpleTerm(NUMBER(1)) SimpleTerm(DATE('2020-03-20T10:00:00.5+01:00')) SimpleTerm(DATE('now')) "
+                "SimpleTerm(STRING('nowhere')) SimpleTerm(STRING('2020-13-01')))" )
+
+            for s in [ 'x:<-a', 'x:<-', 'x:2020-03-20|' ]:
+                with self.assertRaises(Exception):
+                    parser.parseString(s)
+
+    def test_date_options(self):
+        import json
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine, date_format="yyyy-MM-dd", time_zone="+01:00")
+
+            q = parser.parseString('ts:>=2020-03-20 ts:<"2020-04-01" ts:2020-03-21 n:>10')
+            self.assertEqual( q.compose("message"), {'query': {'bool': {'must': [
+                {'range': {'ts': {'gte': '2020-03-20', 'format': 'yyyy-MM-dd', 'time_zone': '+01:00'}}},
+                {'range': {'ts': {'lt': '2020-04-01'}}},
+                {'term': {'ts': {'value': '2020-03-21'}}},
+                {'range': {'n': {'gt': 10}}},
+            ]}}} )
+            self.assertEqual( q.compose_json("message"), json.dumps(q.compose("message")).encode('utf-8') )
+            self.assertEqual( q.compile().render("message"), q.compose("message") )
+
+            # the options are part of the canonical form
+            self.assertNotEqual( q.fingerprint(), yaesql.Parser(engine=engine).parseString('ts:>=2020-03-20 ts:<"2020-04-01" ts:2020-03-21 n:>10').fingerprint() )
+            self.assertEqual( q.fingerprint(), parser.parseString('n:>10 ts:2020-03-21 ts:<"2020-04-01" ts:>=2020-03-20').fingerprint() )
+
+_MAPPING = {
+    "logs": {
+        "mappings": {
+            "properties": {
+                "message": { "type": "text" },
+                "title"  : { "type": "text", "fields": { "raw": { "type": "keyword" }, "keyword": { "type": "keyword" } } },
+                "host"   : { "type": "keyword" },
+                "bytes"  : { "type": "long" },
+                "ts"     : { "type": "date" },
+                "user"   : { "properties": { "id": { "type": "keyword" }, "age": { "type": "integer" } } },
+                "size"   : { "type": "alias", "path": "bytes" },
+            }
+        }
+    }
+}
+
+class TestMapping(unittest.TestCase):
+
+    def test_fields(self):
+        from yaesql.mapping import Mapping
+
+        m = Mapping(_MAPPING)
+
+        self.assertEqual( m.fields, {
+            'message'      : ('text', None),
+            'title'        : ('text', 'title.keyword'),
+            'title.raw'    : ('keyword', None),
+            'title.keyword': ('keyword', None),
+            'host'         : ('keyword', None),
+            'bytes'        : ('long', None),
+            'ts'           : ('date', None),
+            'user.id'      : ('keyword', None),
+            'user.age'     : ('integer', None),
+            'size'         : ('long', None),
+        })
+        self.assertEqual( m.field_type('user.age'), 'integer' )
+        self.assertEqual( m.field_type('other'), None )
+
+        for body in [ _MAPPING['logs'], _MAPPING['logs']['mappings'], { 'mappings': { '_doc': _MAPPING['logs']['mappings'] } } ]:
+            self.assertEqual( Mapping(body).fields, m.fields )
+
+        with self.assertRaises(ValueError):
+            Mapping({ 'a': 1, 'b': 2 })
+
+    def test_compose(self):
+
+        tests = [
+            ('error'            , {'match': {'message': {'query': 'error'}}}),
+            ('"disk full"'      , {'match_phrase': {'message': {'query': 'disk full'}}}),
+            ('title:(a -b)'     , {'bool': {'must_not': {'match': {'title': {'query': 'b'}}}, 'should': {'match': {'title': {'query': 'a'}}}}}),
+            ('title:r"ab.*"'    , {'prefix': {'title.keyword': {'value': 'ab'}}}),
+            ('title:>m'         , {'range': {'title.keyword': {'gt': 'm'}}}),
+            ('host:web1'        , {'term': {'host': {'value': 'web1'}}}),
+            ('bytes:"10"'       , {'term': {'bytes': {'value': 10}}}),
+            ('size:>="-1.5"'    , {'range': {'size': {'gte': -1.5}}}),
+            ('user.age:x'       , {'match_none': {}}),
+            ('bytes:r"1.*"'     , {'match_none': {}}),
+            ('ts:r"2020.*"'     , {'match_none': {}}),
+            ('ts:>now-1d'       , {'range': {'ts': {'gt': 'now-1d'}}}),
+            ('other:r"a.*"'     , {'prefix': {'other': {'value': 'a'}}}),
+        ]
+
+        from yaesql.mapping import load_mapping
+        mapping = load_mapping(_MAPPING)
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            for s, expected in tests:
+                q = parser.parseString(s)
+                self.assertEqual( q.compose("message", mapping=mapping), { 'query': expected }, s )
+                # a dict is accepted as well
+                self.assertEqual( q.compose("message", mapping=_MAPPING), { 'query': expected }, s )
+
+    def test_options(self):
+        import json
+
+        parser = yaesql.Parser(engine="fast")
+
+        q = parser.parseString('error host:web1 bytes:>"1000" title:(a b)')
+        for options in [ {}, { 'optimize': True }, { 'mode': 'auto' } ]:
+            dsl = q.compose("message", mapping=_MAPPING, **options)
+
+            self.assertEqual( q.compose_json("message", mapping=_MAPPING, **options), json.dumps(dsl).encode('utf-8') )
+
+            compiled = q.compile(mapping=_MAPPING, **options)
+            self.assertEqual( compiled.render("message"), dsl )
+            self.assertEqual( compiled.render("host"), q.compose("host", mapping=_MAPPING, **options) )
+
+            self.assertEqual( list(parser.compose_many([ 'error host:web1 bytes:>"1000" title:(a b)' ], "message", mapping=_MAPPING, **options)), [ dsl ] )
+
+        self.assertEqual( q.compose("message", mode="auto", mapping=_MAPPING), {'query': {'bool': {
+            'must'  : {'match': {'message': {'query': 'error'}}}, 
+            'filter': [{'term': {'host': {'value': 'web1'}}}, {'range': {'bytes': {'gt': 1000}}}, 
+                       {'bool': {'should': [{'match': {'title': {'query': 'a'}}}, {'match': {'title': {'query': 'b'}}}]}}],
+        }}} )
+
+        prepared = parser.prepare('$q host:$h', "message", mapping=_MAPPING)
+        self.assertEqual( prepared.bind(q="a", h="b"), parser.parseString('a host:b').compose("message", mapping=_MAPPING) )
+        self.assertEqual( prepared.render("host", q="a", h="b"), parser.parseString('a host:b').compose("host", mapping=_MAPPING) )
+
+    def test_command_line(self):
+        import io
+        import json
+        import os
+        import tempfile
+        from yaesql.cli import main
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'mapping.json')
+            with open(path, 'w') as fp:
+                json.dump(_MAPPING, fp)
+
+            stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+            self.assertEqual( main([ "--msearch", "--mapping", path, "logs", "message" ], stdin=io.StringIO("error bytes:x\n"), stdout=stdout), 0 )
+            stdout.flush()
+
+        self.assertEqual( stdout.buffer.getvalue().decode('utf-8').splitlines(), [
+            '{"index": "logs"}',
+            '{"query": {"bool": {"must": [{"match": {"message": {"query": "error"}}}, {"match_none": {}}]}}}',
+        ])
+
+class TestEvaluate(unittest.TestCase):
+
+    batch = {
+        'message': [ 'error', 'info', 'error', None, [ 'warn', 'error' ] ],
+        'status' : [ 200, '404', 500, 200.0, None ],
+        'host'   : [ 'web01', 'web02', 'db-1', 'web03', 'x.y' ],
+        'ts'     : [ '2020-03-19', '2020-03-21T10:00:00', '2020-03-22', '2020-03-20', None ],
+    }
+
+    def test_values(self):
+
+        tests = [
+            ('error'                       , [ True , False, True , False, True  ]),
+            ('-error'                      , [ False, True , False, True , False ]),
+            ('error -host:web01'           , [ False, False, True , False, True  ]),
+            ('+error status:>300'          , [ True , False, True , False, True  ]),
+            ('-error status:>300'          , [ False, True , False, False, False ]),
+            ('status:200 OR status:"404"'  , [ True , True , False, True , False ]),
+            ('status:(404 500)'            , [ False, True , True , False, False ]),
+            ('status:>=404'                , [ False, True , True , False, False ]),
+            ('status:<"3"'                 , [ False, False, False, False, False ]),
+            ('ts:>2020-03-20'              , [ False, True , True , False, False ]),
+            ('host:r"web.*"'               , [ True , True , False, True , False ]),
+            ('host:r"web0[12]|db-.*"'      , [ True , True , True , False, False ]),
+            ('host:r"w?b0.*"'              , [ False, False, False, False, False ]),
+            ('host:r"x\\.y"'               , [ False, False, False, False, True  ]),
+            ('host:(web01 web02 -web02)'   , [ True , False, False, False, False ]),
+            ('host:(-web01)'               , [ False, True , True , True , True  ]),
+            ('NOT (error OR info)'         , [ False, False, False, True , False ]),
+            ('error AND NOT host:x.y'      , [ True , False, True , False, False ]),
+            ('missing:foo'                 , [ False, False, False, False, False ]),
+        ]
+
+        from yaesql.evaluate import Batch
+
+        rows = [ dict([ (k, v[i]) for k, v in self.batch.items() ]) for i in range(5) ]
+        shared = Batch(self.batch)
+
+        for engine in yaesql.Parser.ENGINES:
+            parser = yaesql.Parser(engine=engine)
+
+            for s, expected in tests:
+                e = parser.parseString(s).evaluator("message")
+                self.assertEqual( e.evaluate(self.batch), expected, s )
+                self.assertEqual( e.evaluate(shared), expected, s )
+                self.assertEqual( [ e.match(row) for row in rows ], expected, s )
+                self.assertEqual( e.count(self.batch), expected.count(True), s )
+
+        self.assertEqual( parser.parseString('a').evaluator("message").evaluate({ 'message': [] }), [] )
+
+    def test_compose(self):
+        # same matches as the composed DSL
+        import random
+
+        rnd = random.Random(11)
+        parser = yaesql.Parser(engine="fast")
+        docs = [ _random_doc(rnd) for i in range(30) ]
+
+        n = 0
+        while n < 300:
+            s = _random_query(rnd)
+            if '<' in s or '>' in s:
+                # ranges compare numbers as numbers, not as keywords
+                continue
+            try:
+                q = parser.parseString(s)
+            except Exception:
+                continue
+            try:
+                e = q.evaluator("message")
+            except ValueError:
+                # date math
+                continue
+
+            dsl = q.compose("message")
+            self.assertEqual( [ e.match(doc) for doc in docs ], [ _dsl_match(dsl, doc) for doc in docs ], s )
+            n += 1
+
+    def test_batch(self):
+        from benchmarks.corpus import generate
+        from benchmarks.evaluate import columns, rows
+
+        batch = columns(200, seed=3)
+        docs  = rows(batch)
+
+        parser = yaesql.Parser(engine="fast")
+        for s in generate(200, seed=3):
+            e = parser.parseString(s).evaluator("message")
+            self.assertEqual( e.evaluate(batch), [ e.match(doc) for doc in docs ], s )
+
+    def test_errors(self):
+
+        parser = yaesql.Parser()
+
+        for s in [ 'ts:>now-1d', 'f:$x', 'f:r"a&b"', 'f:r"~a"' ]:
+            with self.assertRaises(ValueError, msg=s):
+                parser.parseString(s).evaluator("message")
+
+        with self.assertRaises(ValueError):
+            parser.parseString('a').evaluator("message").evaluate({ 'a': [ 1 ], 'b': [ 1, 2 ] })
+
+    def test_numeric_ranges(self):
+
+        # number bounds compare numbers, as on a numeric field, not strings
+        # as on a keyword field
+        column = [ '9', 9, '10', '11', 11.5, 'x', '1e3' ]
+        e = yaesql.Parser().parseString('f:>10').evaluator("message")
+        expected = [ False, False, False, True, True, False, True ]
+        self.assertEqual( e.evaluate({ 'f': column }), expected )
+        self.assertEqual( [ e.match({ 'f': v }) for v in column ], expected )
+
+        # string bounds compare strings
+        e = yaesql.Parser().parseString('f:>"10"').evaluator("message")
+        self.assertEqual( e.evaluate({ 'f': column }), [ True, False, False, True, False, True, True ] )
+
+    def test_date_math_terms(self):
+
+        from yaesql.percolate import QuerySet
+
+        # a term query matches date math as a string
+        column = [ 'now', 'now-1d', '2020-03-20||+1M', '2020-03-20' ]
+        for s, expected in [ ('now', [ True, False, False, False ]), ('f:(now-1d 2020-03-20||+1M)', [ False, True, True, False ]) ]:
+            e = yaesql.Parser().parseString(s).evaluator("f")
+            self.assertEqual( e.evaluate({ 'f': column }), expected, s )
+            self.assertEqual( [ e.match({ 'f': v }) for v in column ], expected, s )
+
+        qs = QuerySet("message", { 'q1': 'now', 'q2': 'ts:2020-03-20||+1M' })
+        self.assertEqual( qs.match({ 'message': 'now' }), [ 'q1' ] )
+        self.assertEqual( qs.match({ 'ts': '2020-03-20||+1M' }), [ 'q2' ] )
+
+    def test_tuples(self):
+
+        e = yaesql.Parser().parseString('host:a').evaluator("message")
+
+        # tuples are multi-valued too, even when the whole column is hashable
+        for column in [ [ ('a', 'b'), 'c', ('c',), [ 'a' ] ], [ ('a', 'b'), 'c', ('c',) ] ]:
+            expected = [ e.match({ 'host': v }) for v in column ]
+            self.assertEqual( expected[:3], [ True, False, False ] )
+            self.assertEqual( e.evaluate({ 'host': column }), expected )
+
+    def test_regex(self):
+
+        column = [ 'web01', 'web 1', 'x$y', '^a', 'd', 'a_b' ]
+        tests = [
+            # backslashes are escaped in the quoted regular expression
+            (r'f:r"web\\d\\d"'  , [ True , False, False, False, False, False ]),
+            (r'f:r"web\\s\\d"'  , [ False, True , False, False, False, False ]),
+            (r'f:r"\\w+"'       , [ True , False, False, False, True , True  ]),
+            (r'f:r"\\S+\\W.*"'  , [ False, True , True , False, False, False ]),
+            (r'f:r"\\d"'        , [ False, False, False, False, False, False ]),
+            (r'f:r"x$y"'        , [ False, False, True , False, False, False ]),
+            (r'f:r"^a"'         , [ False, False, False, True , False, False ]),
+            (r'f:r"a\\_b"'      , [ False, False, False, False, False, True  ]),
+        ]
+
+        parser = yaesql.Parser()
+        for s, expected in tests:
+            e = parser.parseString(s).evaluator("message")
+            self.assertEqual( e.evaluate({ 'f': column }), expected, s )
+            self.assertEqual( [ e.match({ 'f': v }) for v in column ], expected, s )
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+
+        batch = dict([ (k, numpy.array(v, dtype=object)) for k, v in self.batch.items() ])
+        mask = yaesql.Parser().parseString('error -host:web01').evaluator("message").evaluate(batch)
+
+        self.assertIsInstance( mask, numpy.ndarray )
+        self.assertEqual( mask.tolist(), [ False, False, True , False, True ] )
+
+class TestPercolate(unittest.TestCase):
+
+    def test_match(self):
+
+        from yaesql.percolate import QuerySet
+
+        qs = QuerySet("message", [
+            ('a', 'error host:web01'),
+            ('b', 'error OR warn'),
+            ('c', 'status:>=500'),
+            ('d', '-error'),
+            ('e', 'host:(web01 web02) AND status:500'),
+            ('f', 'tags:x'),
+        ])
+
+        self.assertEqual( qs.match({ 'message': 'error', 'host': 'web01', 'status': 200 }), [ 'a', 'b' ] )
+        self.assertEqual( qs.match({ 'message': 'info', 'host': 'web02', 'status': '500' }), [ 'c', 'd', 'e' ] )
+        self.assertEqual( qs.match({ 'message': [ 'warn', 'error' ], 'tags': [ 'y', 'x' ] }), [ 'b', 'f' ] )
+        self.assertEqual( qs.match({}), [ 'd' ] )
+
+        info = qs.info()
+        self.assertEqual( (info.queries, info.indexed, info.scanned, info.documents), (6, 4, 2, 4) )
+
+        r = qs.percolate({ 'message': 'debug' })
+        self.assertEqual( (r.ids, r.candidates), ([ 'd' ], 2) )
+
+    def test_update(self):
+
+        from yaesql.percolate import QuerySet
+
+        qs = QuerySet("message")
+        qs.add(1, 'foo')
+        qs.add(2, yaesql.Parser().parseString('bar'))
+        qs.add(3, 'foo bar')
+
+        self.assertEqual( len(qs), 3 )
+        self.assertEqual( qs.match({ 'message': 'foo' }), [ 1 ] )
+
+        qs.add(1, 'bar')
+        qs.remove(2)
+
+        self.assertTrue( 1 in qs and 2 not in qs )
+        self.assertEqual( qs.match({ 'message': 'foo' }), [] )
+        self.assertEqual( qs.match({ 'message': [ 'foo', 'bar' ] }), [ 3, 1 ] )
+
+        with self.assertRaises(KeyError):
+            qs.remove(2)
+
+        qs.remove(1)
+        qs.remove(3)
+        self.assertEqual( (len(qs), qs.index, qs.scan), (0, {}, set()) )
+
+    def test_brute_force(self):
+
+        from benchmarks.percolate import rules, events
+        from yaesql.percolate import QuerySet
+
+        strings = rules(2000, seed=5) + [ 'a b', 'a OR (b AND NOT c)', '+x:1 y:(2 3)', 'x:1 OR x:r"[0-9]"' ]
+        docs    = events(100, seed=6) + [ { 'message': 'b', 'x': 1, 'y': [ 3 ] }, { 'message': 'a', 'x': '7' } ]
+
+        qs = QuerySet("message", enumerate(strings))
+        evaluators = [ yaesql.Parser().parseString(s).evaluator("message") for s in strings ]
+
+        for doc in docs:
+            r = qs.percolate(doc)
+            self.assertEqual( r.ids, [ i for i, e in enumerate(evaluators) if e.match(doc) ], doc )
+            self.assertTrue( len(r.ids) <= r.candidates < len(strings) )
+
+
+class TestSerialize(unittest.TestCase):
+
+    def _check(self, q, loaded):
+        self.assertEqual( loaded.dump(), q.dump() )
+        self.assertEqual( loaded.compose_json("message"), q.compose_json("message") )
+        self.assertFalse( loaded.is_sub )
+
+    def test_roundtrip(self):
+        import random
+        from benchmarks.corpus import generate
+        from yaesql.serialize import dumps, loads
+
+        rnd = random.Random(23)
+
+        strings = generate(100, seed=2) + [ _random_query(rnd) for i in range(300) ] + [
+            'ts:>=now-1d/d f:[1 TO 5] x:<-2.5e3 y:(a -b +c) NOT $p r"ab.*" field2:r"x[0-9]+"',
+        ]
+
+        for engine in yaesql.Parser.ENGINES:
+            for parser in [ yaesql.Parser(engine=engine, date_format='yyyy-MM-dd', time_zone='+01:00'), yaesql.Parser(engine=engine, rewrite_regex=False) ]:
+                for s in strings:
+                    try:
+                        q = parser.parseString(s)
+                    except Exception:
+                        continue
+                    text = dumps(q)
+                    self.assertTrue( text.isascii() and '\n' not in text, s )
+                    self._check(q, loads(text))
+                    self._check(q, loads(text.encode('utf-8')))
+
+    def test_deep(self):
+        import sys
+        from yaesql.serialize import dumps, loads
+
+        q = TestDeepTrees()._chain(sys.getrecursionlimit() * 2)
+        self.assertEqual( loads(dumps(q)).dump(), q.dump() )
+
+    def test_errors(self):
+        from yaesql.serialize import dumps, loads
+
+        class MyLiteral(yaesql.StringLiteral):
+            __slots__ = ()
+
+        with self.assertRaises(TypeError):
+            dumps( yaesql.Query([ yaesql.SimpleTerm(MyLiteral('a')) ]) )
+
+        for text in [ '[]', '{"yaesql": 0, "nodes": []}', '{"yaesql": 1, "nodes": []}', '{"yaesql": 1, "nodes": [["X", 1]]}', '{"yaesql": 1, "nodes": [["T", 3]]}' ]:
+            with self.assertRaises(ValueError, msg=text):
+                loads(text)
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def test_shared(self):
+        import tempfile
+
+        strings = [ 'foo', 'field1:(a b) -c', 'ts:>2020-01-01', 'x:$p' ]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            p1 = yaesql.Parser(engine="fast", cache_dir=tmp)
+            trees = [ p1.parseString(s) for s in strings ]
+            self.assertEqual( p1.disk_cache.info(), (0, 4, 4, 4) )
+
+            # another process
+            p2 = yaesql.Parser(cache_dir=tmp, cache_size=10)
+            for s, q in zip(strings, trees):
+                self.assertEqual( p2.parseString(' ' + s + '  ').dump(), q.dump() )
+            self.assertEqual( p2.disk_cache.info(), (4, 0, 0, 4) )
+
+            # lines appended by another process after the first read
+            p1.parseString('bar')
+            self.assertEqual( p2.parseString('bar').dump(), p1.parseString('bar').dump() )
+            self.assertEqual( p2.disk_cache.info().writes, 0 )
+
+            # other options build other trees
+            p3 = yaesql.Parser(cache_dir=tmp, time_zone='Z')
+            self.assertEqual( p3.parseString('ts:>2020-01-01').dump(), "Query(ComplexTerm(ts:COMPARE(>, DATE('2020-01-01', time_zone='Z'))))" )
+            self.assertEqual( p3.disk_cache.info().hits, 0 )
+
+    def test_versions(self):
+        import os
+        import tempfile
+        from yaesql.cache import DiskCache
+
+        q = yaesql.Parser().parseString('foo')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            old = DiskCache(tmp, version='old')
+            old.put('foo', q)
+
+            new = DiskCache(tmp)
+            self.assertIsNone( new.get('foo') )
+            new.put('foo', q)
+
+            new.prune()
+            self.assertEqual( os.listdir(tmp), [ os.path.basename(new.path) ] )
+            self.assertEqual( DiskCache(tmp).get('foo').dump(), q.dump() )
+
+    def test_grammar_version(self):
+        import pyparsing
+        from yaesql import serialize
+
+        version = serialize.grammar_version()
+        saved   = pyparsing.__version__
+        try:
+            pyparsing.__version__ = saved + '.other'
+            serialize._grammar_version = None
+            self.assertNotEqual( serialize.grammar_version(), version )
+        finally:
+            pyparsing.__version__ = saved
+            serialize._grammar_version = None
+        self.assertEqual( serialize.grammar_version(), version )
+
+    def test_short_writes(self):
+        import os
+        import tempfile
+        from unittest import mock
+        from yaesql.cache import DiskCache
+
+        q = yaesql.Parser().parseString('foo AND bar')
+        write = os.write
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(tmp)
+            with mock.patch('os.write', lambda fd, data: write(fd, data[:5])):
+                cache.put('foo AND bar', q)
+            self.assertEqual( DiskCache(tmp).get('foo AND bar').dump(), q.dump() )
+
+    def test_damaged(self):
+        import pickle
+        import tempfile
+        from yaesql.cache import DiskCache
+
+        parser = yaesql.Parser()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(tmp)
+            cache.put('a', parser.parseString('a'))
+            with open(cache.path, 'ab') as fp:
+                fp.write(b'garbage\n%s {"yaesql": 1, "nodes": [["S"\n' % (cache._hash('b').encode('ascii'),))
+                fp.write(b'%s {"yaesql": 1, "nodes": [["S", "c"], ["T", 0]' % (cache._hash('c').encode('ascii'),))
+
+            copy = pickle.loads(pickle.dumps(cache))
+            self.assertEqual( len(copy), 0 )
+            self.assertEqual( copy.get('a').dump(), 'Query(SimpleTerm(STRING(\'a\')))' )
+            self.assertIsNone( copy.get('b') )
+            self.assertIsNone( copy.get('c') )
+
+            # the end of a line being written
+            with open(cache.path, 'ab') as fp:
+                fp.write(b', ["Q", 1]]}\n')
+            self.assertEqual( copy.get('c').dump(), 'Query(SimpleTerm(STRING(\'c\')))' )
+
+    def test_custom_nodes(self):
+        import tempfile
+
+        class MyLiteral(yaesql.StringLiteral):
+            __slots__ = ()
+
+        class MyParser(yaesql.Parser):
+            def create_StringLiteral(self, s, loc, toks):
+                return MyLiteral(toks[0])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            parser = MyParser(cache_dir=tmp)
+            parser.parseString('foo')
+            self.assertEqual( parser.disk_cache.info().writes, 0 )
+            self.assertIsInstance( MyParser(cache_dir=tmp).parseString('foo').exprs[0].expr, MyLiteral )
+
+    def test_cache_salt(self):
+        import tempfile
+
+        class LowerParser(yaesql.Parser):
+            def __init__(self, lower=True, **options):
+                self.lower = lower
+                super().__init__(**options)
+
+            def cache_salt(self):
+                return repr(self.lower)
+
+            def create_StringLiteral(self, s, loc, toks):
+                return yaesql.StringLiteral( toks[0].lower() if self.lower else toks[0] )
+
+        self.assertIsNone( yaesql.Parser().cache_salt() )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual( LowerParser(cache_dir=tmp).parseString('Foo').dump(), "Query(SimpleTerm(STRING('foo')))" )
+
+            # not the trees of the other parser
+            parser = LowerParser(lower=False, cache_dir=tmp)
+            self.assertEqual( parser.parseString('Foo').dump(), "Query(SimpleTerm(STRING('Foo')))" )
+            self.assertEqual( parser.disk_cache.info().hits, 0 )
+
+            parser = LowerParser(cache_dir=tmp)
+            self.assertEqual( parser.parseString('Foo').dump(), "Query(SimpleTerm(STRING('foo')))" )
+            self.assertEqual( parser.disk_cache.info().hits, 1 )
+
+    def test_benchmark(self):
+        import io
+        from benchmarks import diskcache
+
+        out = io.StringIO()
+        self.assertEqual( diskcache.main([ '--queries', '50', '--repeat', '1' ], out), 0 )
+        self.assertEqual( [ line.split()[0] for line in out.getvalue().splitlines() ], [ 'start', 'parse', 'cold', 'warm' ] )
+
+
+class TestShareNodes(unittest.TestCase):
+
+    def test_same_trees(self):
+        import random
+        from benchmarks.corpus import generate
+
+        rnd = random.Random(29)
+
+        strings = generate(200, seed=5) + [ _random_query(rnd) for i in range(300) ] + [ 'x:1 a', 'x:1.0 b', 'x:(1 1.0) -x:1', 'r"ab" ab' ]
+
+        for engine in yaesql.Parser.ENGINES:
+            p1 = yaesql.Parser(engine=engine)
+            p2 = yaesql.Parser(engine=engine, share_nodes=True)
+
+            for i in range(2):
+                for s in strings:
+                    try:
+                        expected = p1.parseString(s)
+                    except Exception:
+                        continue
+                    q = p2.parseString(s)
+
+                    self.assertEqual( q.dump(), expected.dump(), s )
+                    self.assertFalse( q.is_sub )
+                    for field_name in ("message", "other"):
+                        self.assertEqual( q.compose(field_name, optimize=True), expected.compose(field_name, optimize=True), s )
+                        self.assertEqual( q.compose(field_name), expected.compose(field_name), s )
+                        if '$' not in s:
+                            self.assertEqual( q.compose_json(field_name), expected.compose_json(field_name), s )
+
+            self.assertTrue( p2.nodes.info().hits > 0 )
+
+    def test_shared(self):
+        import gc
+
+        parser = yaesql.Parser(share_nodes=True)
+
+        q1 = parser.parseString('env:prod -level:debug foo')
+        q2 = parser.parseString('env:prod -level:debug foo')
+        q3 = parser.parseString('-level:debug AND env:prod foo')
+
+        # values are shared at once, the other nodes when seen again: roots never
+        self.assertIsNot( q1.exprs[0], q2.exprs[0] )
+        self.assertIs( q1.exprs[0].value_expr.expr, q2.exprs[0].value_expr.expr )
+        self.assertIsNot( q2, q1 )
+        self.assertIs( q3.exprs[0].exprs[0], q2.exprs[1] )
+        self.assertIs( q3.exprs[0].exprs[1], q2.exprs[0] )
+        self.assertIs( q3.exprs[1], q2.exprs[2] )
+
+        # the DSL of shared terms is composed once per default field
+        d2 = q2.compose("message")['query']['bool']
+        d3 = q3.compose("message")['query']['bool']
+        self.assertIs( d3['must'][0]['bool']['must'][0]['bool']['must_not'], d2['must_not'] )
+        self.assertIs( d3['must'][0]['bool']['must'][1], d2['should'][0] )
+        self.assertIs( d3['must'][1], d2['should'][1] )
+        self.assertEqual( q3.compose("other")['query']['bool']['must'][1], { 'term': { 'other': { 'value': 'foo' } } } )
+
+        del q1, q2, q3, d2, d3
+        gc.collect()
+        self.assertEqual( len(parser.nodes), 0 )
+
+    def test_values(self):
+        parser = yaesql.Parser(share_nodes=True)
+
+        q1 = parser.parseString('x:1 a')
+        q2 = parser.parseString('x:1.0 a')
+        q3 = parser.parseString('x:"1" a')
+
+        self.assertEqual( [ q.compose("m")['query']['bool']['must'][0]['term']['x']['value'] for q in (q1, q2, q3) ], [ 1, 1.0, '1' ] )
+        self.assertEqual( [ type(q.exprs[0].value_expr.expr.val) for q in (q1, q2, q3) ], [ int, float, str ] )
+
+    def test_caches(self):
+        import pickle
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            yaesql.Parser(cache_dir=tmp).parseString('a b')
+
+            parser = yaesql.Parser(engine="fast", cache_dir=tmp, cache_size=10, share_nodes=True)
+            q1 = parser.parseString('a b')
+            q2 = parser.parseString('b a')
+
+            self.assertEqual( parser.disk_cache.info().hits, 1 )
+            self.assertIs( q1.exprs[0].expr, q2.exprs[1].expr )
+
+            copy = pickle.loads(pickle.dumps(parser))
+            self.assertEqual( len(copy.nodes), 0 )
+            self.assertEqual( copy.parseString('b a').dump(), q2.dump() )
+
+    def test_benchmark(self):
+        import io
+        from benchmarks import share
+
+        out = io.StringIO()
+        self.assertEqual( share.main([ '--queries', '200', '--repeat', '1' ], out), 0 )
+        self.assertEqual( [ line.split()[0] for line in out.getvalue().splitlines() ], [ 'nodes', 'separate', 'shared' ] )
+
 
 if __name__ == '__main__':
     unittest.main()
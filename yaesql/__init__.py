@@ -1,12 +1,90 @@
 
+import hashlib
+import json
+import math
+import sys
+import threading
+
 import pyparsing as pp
 
+#----------------------------------------------------------------------#
+# JSON                                                                 #
+#----------------------------------------------------------------------#
+#
+# compose_json() writes the same text as json.dumps(compose()), with the
+# default separators and ASCII escaping.
+#
+
+_json_str = json.encoder.encode_basestring_ascii
+
+def _json_value(v):
+    if isinstance(v, str):
+        return _json_str(v)
+    return json.dumps(v)
+
+def _json_list(parts, out):
+    """
+    Write a list of composed children, or the child itself when it is
+    alone, as compose() does for bool clauses.
+    """
+    if len(parts) == 1:
+        out.extend(parts[0])
+        return
+    out.append('[')
+    first = True
+    for part in parts:
+        if not first:
+            out.append(', ')
+        first = False
+        out.extend(part)
+    out.append(']')
+
 #----------------------------------------------------------------------#
 # CLASSES                                                              #
 #----------------------------------------------------------------------#
 
+#
+# Nodes use __slots__ and keep their children in tuples: parsed queries
+# are often cached by the hundred thousands. Field names and string 
+# values are interned, they repeat a lot across queries. Whole subtrees
+# can be shared between queries as well (see yaesql.share): nodes can be
+# weakly referenced, and term nodes memoize their DSL once shared.
+#
+
+def _intern(v):
+    if type(v) is str:
+        return sys.intern(v)
+    return v
+
+#
+# How compose(), write_json() and dump() walk the nodes of a class (see
+# TREE TRAVERSAL below)
+#
+_LEAF, _COMPLEX, _MUST, _MUST_NOT, _NOT, _AND, _OR, _QUERY = range(8)
+
 class Expr(object):
 
+    __slots__ = ('is_sub', '__weakref__')
+
+    _kind = _LEAF
+
+    _compose_kind = _json_kind = _dump_kind = _LEAF
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        if '_kind' in cls.__dict__:
+            cls._compose_kind = cls._json_kind = cls._dump_kind = cls._kind
+            return
+
+        # subclasses composing (dumping...) on their own are leaves
+        if 'compose' in cls.__dict__ or '_compose' in cls.__dict__:
+            cls._compose_kind = _LEAF
+        if 'write_json' in cls.__dict__:
+            cls._json_kind = _LEAF
+        if 'dump' in cls.__dict__:
+            cls._dump_kind = _LEAF
+
     def __init__(self, sub=None):
         #print(">>>", self.__class__.__name__, "init", repr(sub))
         self.is_sub = False
@@ -17,30 +95,118 @@ class Expr(object):
     def compose(self, field_name):
         raise NotImplementedError
 
+    def canonical(self):
+        """
+        Return an equivalent tree in canonical form: nested AND/OR and
+        redundant parentheses are flattened and the children of 
+        commutative nodes are sorted. Equivalent queries have the same 
+        canonical form, and so the same DSL.
+        """
+        raise NotImplementedError
+
+    def fingerprint(self):
+        """
+        Stable hash of the canonical form
+        """
+        return hashlib.blake2b(self.canonical().dump().encode('utf-8'), digest_size=16).hexdigest()
+
+    def cost(self, field_name=None, weights=None, field_weights=None):
+        """
+        Static cost estimate of the query: clause count, nesting depth,
+        regular expressions and a weighted cost (see yaesql.analysis)
+        """
+        from .analysis import cost
+        return cost(self, field_name, weights, field_weights)
+
+    def validate(self, limits, field_name=None, weights=None, field_weights=None):
+        """
+        Return cost() or raise QueryBudgetError if it exceeds `limits`, 
+        e.g. {'clauses': 1024, 'depth': 20, 'regexes': 4}
+        """
+        from .analysis import validate
+        return validate(self, limits, field_name, weights, field_weights)
+
+    def compose_json(self, field_name, buf=None, **options):
+        """
+        Return `json.dumps(self.compose(field_name, **options))` encoded in
+        UTF-8, written straight from the tree when there are no options. 
+        If `buf` (a bytearray) is given the JSON is appended to it and `buf`
+        is returned.
+        """
+        if options:
+            q = self.compose(field_name, **options)
+            try:
+                data = json.dumps(q).encode('utf-8')
+            except RecursionError:
+                raise _too_deep(self) from None
+        else:
+            out = []
+            self.write_json(field_name, out)
+            data = ''.join(out).encode('utf-8')
+        if buf is None:
+            return data
+        buf += data
+        return buf
+
+    def write_json(self, field_name, out):
+        """
+        Append the JSON text of `compose(field_name)` to the list `out`
+        """
+        out.append(json.dumps(self.compose(field_name)))
+
 #----------------------------------------------------------------------#
 
 class Literal(Expr):
 
+    __slots__ = ('val',)
+
     def __init__(self, val):
         super().__init__(val)
-        self.val = val
+        self.val = _intern(val)
 
     def compose(self, field_name):
         return self.val
 
+    def write_json(self, field_name, out):
+        out.append(_json_value(self.val))
+
+    def canonical(self):
+        return type(self)(self.val)
+
 class RegExLiteral(Literal):
 
-    def __init__(self, val):
+    #
+    # `query` is the (query type, value) pair composed for the regular 
+    # expression: a cheaper term/prefix/wildcard query when there is an
+    # equivalent one and `rewrite` is true (see yaesql.regex)
+    #
+    __slots__ = ('query',)
+
+    def __init__(self, val, rewrite=True):
         super().__init__(val)
 
+        if rewrite:
+            from .regex import analyze
+            kind, value = analyze(self.val)
+            self.query = (_intern(kind), _intern(value))
+        else:
+            self.query = ('regexp', self.val)
+
     def dump(self):
         return "REGEX(%s)" % (repr(self.val))
 
     def compose(self, field_name):
         return self.val
 
+    def canonical(self):
+        c = type(self)(self.val, rewrite=False)
+        c.query = self.query
+        return c
+
 class StringLiteral(Literal):
 
+    __slots__ = ()
+
     def __init__(self, val):
         super().__init__(val)
 
@@ -49,68 +215,196 @@ class StringLiteral(Literal):
 
 class NumberLiteral(Literal):
 
+    #
+    # `val` is an int or a float: it composes as a JSON number
+    #
+    __slots__ = ()
+
     def __init__(self, val):
         super().__init__(val)
 
     def dump(self):
         return "NUMBER(%s)" % (repr(self.val))
 
+class DateLiteral(Literal):
+
+    #
+    # An ISO 8601 date or a date math expression, composed as a string. 
+    # Range queries on it carry its `format` and `time_zone` if set
+    #
+    __slots__ = ('format', 'time_zone')
+
+    def __init__(self, val, format=None, time_zone=None):
+        super().__init__(val)
+        self.format    = _intern(format)
+        self.time_zone = _intern(time_zone)
+
+    def dump(self):
+        args = [ repr(self.val) ]
+        if self.format is not None:
+            args.append("format=%r" % (self.format,))
+        if self.time_zone is not None:
+            args.append("time_zone=%r" % (self.time_zone,))
+        return "DATE(%s)" % (', '.join(args))
+
+    def canonical(self):
+        return type(self)(self.val, self.format, self.time_zone)
+
+class Placeholder(Literal):
+
+    #
+    # A `$name` parameter: `val` is the name. It composes as itself and
+    # PreparedQuery replaces it with the bound value
+    #
+    __slots__ = ()
+
+    def __init__(self, val):
+        super().__init__(val)
+
+    def __repr__(self):
+        return "$%s" % (self.val)
+
+    # composed queries with the same parameters compare equal
+    def __eq__(self, other):
+        return isinstance(other, Placeholder) and other.val == self.val
+
+    def __hash__(self):
+        return hash(('$', self.val))
+
+    def dump(self):
+        return "PARAM(%s)" % (repr(self.val))
+
+    def compose(self, field_name):
+        return self
+
+    def write_json(self, field_name, out):
+        raise ValueError("Unbound query parameter $%s (see Parser.prepare())" % (self.val,))
+
 #----------------------------------------------------------------------#
 
 class SimpleTerm(Expr):
 
+    #
+    # `_composed` is None, or the DSL composed for each default field once
+    # the node is shared
+    #
+    __slots__ = ('expr', '_composed')
+
     def __init__(self, expr):
         super().__init__(expr)
         self.expr = expr
 
+        self._composed = None
+
     def dump(self):
         return "SimpleTerm(%s)" % (self.expr.dump()) #.dump())
 
+    def canonical(self):
+        return type(self)(self.expr.canonical())
+
     def compose(self, field_name):
+        memo = self._composed
+        if memo is None:
+            return _compose_term(self.expr, field_name)
+        q = memo.get(field_name)
+        if q is None:
+            q = memo[field_name] = _compose_term(self.expr, field_name)
+        return q
+
+    def write_json(self, field_name, out):
+        _write_json_term(self.expr, field_name, out)
+
+def _compose_term(expr, field_name):
         
-        if isinstance(self.expr, RegExLiteral):
-            q = {
-                'regexp': {
-                    field_name: {
-                        "value": self.expr.compose(field_name)
-                    }
+    if isinstance(expr, RegExLiteral):
+        kind, value = expr.query
+        q = {
+            kind: {
+                field_name: {
+                    "value": value
                 }
-            
             }
-        else:
-            q = {
-                'term': {
-                    field_name: {
-                        "value": self.expr.compose(field_name)
-                    }
+        
+        }
+    else:
+        q = {
+            'term': {
+                field_name: {
+                    "value": expr.compose(field_name)
                 }
-            
             }
-        return q
+        
+        }
+    return q
+
+def _write_json_term(expr, field_name, out):
+    if isinstance(expr, RegExLiteral):
+        kind, value = expr.query
+        out.append('{"%s": {%s: {"value": %s}}}' % (kind, _json_str(field_name), _json_value(value)))
+        return
+    out.append('{"term": {%s: {"value": ' % (_json_str(field_name)))
+    expr.write_json(field_name, out)
+    out.append('}}}')
+
+#
+# A bare value in a bool clause, as in `field1:(foo -bar)`, matches the 
+# field as a simple term
+#
+
+def _compose_clause(expr, field_name):
+    if isinstance(expr, Literal):
+        return _compose_term(expr, field_name)
+    return expr.compose(field_name)
+
+def _write_json_clause(expr, field_name, out):
+    if isinstance(expr, Literal):
+        _write_json_term(expr, field_name, out)
+    else:
+        expr.write_json(field_name, out)
 
 #----------------------------------------------------------------------#
 
 class ComplexTerm(Expr):
 
+    # `_composed` as in SimpleTerm
+    __slots__ = ('field_expr', 'value_expr', '_composed')
+
+    _kind = _COMPLEX
+
     def __init__(self, field_expr, value_expr):
         super().__init__( (field_expr, value_expr) )
-        self.field_expr = field_expr
+        self.field_expr = _intern(field_expr)
         self.value_expr = value_expr
 
         value_expr.is_sub = True
 
+        self._composed = None
+
     def dump(self):
         return "ComplexTerm(%s:%s)" % (self.field_expr, self.value_expr.dump())
 
+    def canonical(self):
+        return type(self)(self.field_expr, self.value_expr.canonical())
+
     def compose(self, field_name):
         field_name = self.field_expr
-        q = self.value_expr.compose(field_name)
+        memo = self._composed
+        if memo is None:
+            return self.value_expr.compose(field_name)
+        q = memo.get(field_name)
+        if q is None:
+            q = memo[field_name] = self.value_expr.compose(field_name)
         return q
 
+    def write_json(self, field_name, out):
+        self.value_expr.write_json(self.field_expr, out)
+
 #----------------------------------------------------------------------#
 
 class CompareValue(Expr):
 
+    __slots__ = ('type', 'expr')
+
     OPS = {
         '<' : 'lt' ,
         '<=': 'lte',
@@ -120,13 +414,16 @@ class CompareValue(Expr):
 
     def __init__(self, exprs):
         super().__init__( exprs )
-        self.type = exprs[0]
+        self.type = _intern(exprs[0])
         self.expr = exprs[1]
         self.expr.is_sub = True
 
     def dump(self):
         return "COMPARE(%s, %s)" % ( self.type, self.expr.dump() )
 
+    def canonical(self):
+        return type(self)( (self.type, self.expr.canonical()) )
+
     def compose(self, field_name):
 
         op = CompareValue.OPS[self.type]
@@ -140,16 +437,36 @@ class CompareValue(Expr):
                 }
             }
         }
+
+        if isinstance(self.expr, DateLiteral):
+            if self.expr.format is not None:
+                q['range'][field_name]['format'   ] = self.expr.format
+            if self.expr.time_zone is not None:
+                q['range'][field_name]['time_zone'] = self.expr.time_zone
         
         return q
 
+    def write_json(self, field_name, out):
+        op = CompareValue.OPS[self.type]
+
+        out.append('{"range": {%s: {"%s": ' % (_json_str(field_name), op))
+        self.expr.write_json(field_name, out)
+        if isinstance(self.expr, DateLiteral):
+            if self.expr.format is not None:
+                out.append(', "format": %s' % (_json_str(self.expr.format)))
+            if self.expr.time_zone is not None:
+                out.append(', "time_zone": %s' % (_json_str(self.expr.time_zone)))
+        out.append('}}}')
+
 #----------------------------------------------------------------------#
 
 class MultiValue(Expr):
 
+    __slots__ = ('exprs',)
+
     def __init__(self, exprs):
         super().__init__( exprs )
-        self.exprs = exprs
+        self.exprs = tuple(exprs)
 
         for e in self.exprs:
             e.is_sub = True
@@ -157,6 +474,9 @@ class MultiValue(Expr):
     def dump(self):
         return "VALUES(%s)" % ( ', '.join([ e.dump() for e in self.exprs ]) )
 
+    def canonical(self):
+        return type(self)( _sorted([ e.canonical() for e in self.exprs ]) )
+
     def compose(self, field_name):
 
         q = {
@@ -169,15 +489,14 @@ class MultiValue(Expr):
         should_conds   = []
 
         for e in self.exprs:
-            subq = e.compose(field_name)
-
             if   isinstance(e, BoolMust): 
-                subq = subq['bool']['must']
+                subq = _compose_clause(e.expr, field_name)
                 must_conds.append( subq )
             elif isinstance(e, BoolMustNot): 
-                subq = subq['bool']['must_not']
+                subq = _compose_clause(e.expr, field_name)
                 must_not_conds.append( subq )
             else:
+                subq = _compose_clause(e, field_name)
                 should_conds.append(subq)
 
         if not must_conds and not must_not_conds and should_conds:
@@ -195,14 +514,58 @@ class MultiValue(Expr):
 
         return q
 
+    def write_json(self, field_name, out):
+
+        must_conds     = []
+        must_not_conds = []
+        should_conds   = []
+
+        for e in self.exprs:
+            part = []
+            if   isinstance(e, BoolMust): 
+                _write_json_clause(e.expr, field_name, part)
+                must_conds.append( part )
+            elif isinstance(e, BoolMustNot): 
+                _write_json_clause(e.expr, field_name, part)
+                must_not_conds.append( part )
+            else:
+                _write_json_clause(e, field_name, part)
+                should_conds.append( part )
+
+        if not must_conds and not must_not_conds and should_conds:
+            if len(should_conds) > 1:
+                out.append('{"bool": {"should": ')
+                _json_list(should_conds, out)
+                out.append('}}')
+            else:
+                out.extend(should_conds[0])
+        else:
+            _write_json_bool(must_conds, must_not_conds, should_conds, out)
+
+def _write_json_bool(must_conds, must_not_conds, should_conds, out):
+    sep = '{"bool": {'
+    for key, conds in (('must', must_conds), ('must_not', must_not_conds), ('should', should_conds)):
+        if conds:
+            out.append('%s"%s": ' % (sep, key))
+            _json_list(conds, out)
+            sep = ', '
+    out.append('}}')
+
 #----------------------------------------------------------------------#
 
 class BoolExpr(Expr):
+
+    __slots__ = ()
+
     def __init__(self, expr):
         super().__init__(expr)
 
 class BoolMust(BoolExpr):
 
+    __slots__ = ('expr',)
+
+    _kind = _MUST
+
     def __init__(self, expr):
         super().__init__(expr)
         self.expr = expr
@@ -212,8 +575,11 @@ class BoolMust(BoolExpr):
     def dump(self):
         return "Must(%s)" % (self.expr.dump())
 
+    def canonical(self):
+        return type(self)( _unwrap(self.expr.canonical()) )
+
     def compose(self, field_name):
-        q = self.expr.compose(field_name)
+        q = _compose_clause(self.expr, field_name)
         r = {
             'bool': {
                 "must": q
@@ -221,8 +587,17 @@ class BoolMust(BoolExpr):
         }
         return r
 
+    def write_json(self, field_name, out):
+        out.append('{"bool": {"must": ')
+        _write_json_clause(self.expr, field_name, out)
+        out.append('}}')
+
 class BoolMustNot(BoolExpr):
 
+    __slots__ = ('expr',)
+
+    _kind = _MUST_NOT
+
     def __init__(self, expr):
         super().__init__(expr)
 
@@ -233,8 +608,11 @@ class BoolMustNot(BoolExpr):
     def dump(self):
         return "MustNot(%s)" % (self.expr.dump())
 
+    def canonical(self):
+        return type(self)( _unwrap(self.expr.canonical()) )
+
     def compose(self, field_name):
-        q = self.expr.compose(field_name)
+        q = _compose_clause(self.expr, field_name)
         r = {
             'bool': {
                 "must_not": q
@@ -242,10 +620,19 @@ class BoolMustNot(BoolExpr):
         }
         return r
 
+    def write_json(self, field_name, out):
+        out.append('{"bool": {"must_not": ')
+        _write_json_clause(self.expr, field_name, out)
+        out.append('}}')
+
 #----------------------------------------------------------------------#
 
 class NotExpr(Expr):
 
+    __slots__ = ('expr',)
+
+    _kind = _NOT
+
     def __init__(self, expr):
         super().__init__(expr)
         self.expr = expr
@@ -255,8 +642,11 @@ class NotExpr(Expr):
     def dump(self):
         return "NOT(%s)" % (self.expr.dump())
 
+    def canonical(self):
+        return type(self)( _unwrap(self.expr.canonical()) )
+
     def compose(self, field_name):
-        q = self.expr.compose(field_name)
+        q = _compose_clause(self.expr, field_name)
 
         q = {
             'bool': {
@@ -266,12 +656,21 @@ class NotExpr(Expr):
 
         return q
 
+    def write_json(self, field_name, out):
+        out.append('{"bool": {"must_not": ')
+        _write_json_clause(self.expr, field_name, out)
+        out.append('}}')
+
 class AndExpr(Expr):
 
+    __slots__ = ('exprs',)
+
+    _kind = _AND
+
     def __init__(self, exprs):
         super().__init__(exprs)
         
-        self.exprs = exprs
+        self.exprs = tuple(exprs)
 
         for e in exprs:
             e.is_sub = True
@@ -279,10 +678,15 @@ class AndExpr(Expr):
     def dump(self):
         return "(%s)" % ( ' AND '.join([e.dump() for e in self.exprs]) )
 
+    def canonical(self):
+        exprs = []
+        _flatten_and([ _unwrap(e.canonical()) for e in self.exprs ], exprs)
+        return type(self)( _sorted(exprs) )
+
     def compose(self, field_name):
         if len(self.exprs) == 1:
 
-            q = self.expr[0].compose(field_name)
+            q = self.exprs[0].compose(field_name)
             if 'query' in q:
                 return q['query']
             else:
@@ -302,11 +706,23 @@ class AndExpr(Expr):
             }
             return q
 
+    def write_json(self, field_name, out):
+        if len(self.exprs) == 1:
+            return super().write_json(field_name, out)
+
+        out.append('{"bool": {"must": [')
+        _write_json_items(self.exprs, field_name, out)
+        out.append(']}}')
+
 class OrExpr(Expr):
 
+    __slots__ = ('exprs',)
+
+    _kind = _OR
+
     def __init__(self, exprs):
         super().__init__()
-        self.exprs = exprs
+        self.exprs = tuple(exprs)
 
         for e in exprs:
             e.is_sub = True
@@ -314,9 +730,19 @@ class OrExpr(Expr):
     def dump(self):
         return "(%s)" % ( ' OR '.join([e.dump() for e in self.exprs]) )
 
+    def canonical(self):
+        exprs = []
+        for e in self.exprs:
+            e = _unwrap(e.canonical())
+            if isinstance(e, OrExpr):
+                exprs.extend(e.exprs)
+            else:
+                exprs.append(e)
+        return type(self)( _sorted(exprs) )
+
     def compose(self, field_name):
         if len(self.exprs) == 1:
-            return self.expr[0].compose(field_name)
+            return self.exprs[0].compose(field_name)
         else:
             conds = []
             for e in self.exprs:
@@ -330,77 +756,858 @@ class OrExpr(Expr):
             }
             return q
 
+    def write_json(self, field_name, out):
+        if len(self.exprs) == 1:
+            return super().write_json(field_name, out)
+
+        out.append('{"bool": {"should": [')
+        _write_json_items(self.exprs, field_name, out)
+        out.append(']}}')
+
+def _write_json_items(exprs, field_name, out):
+    first = True
+    for e in exprs:
+        if not first:
+            out.append(', ')
+        first = False
+        e.write_json(field_name, out)
+
 #----------------------------------------------------------------------#
 
 class Query(Expr):
 
+    __slots__ = ('exprs',)
+
+    _kind = _QUERY
+
     def __init__(self, exprs):
         super().__init__(exprs)
 
-        self.exprs = exprs
+        self.exprs = tuple(exprs)
 
         for e in exprs:
             e.is_sub = True
 
+    #
+    # The root Query walks its tree again without recursion when it is 
+    # deeper than the interpreter stack (see TREE TRAVERSAL)
+    #
+
     def dump(self):
-        return "Query(%s)" % (' '.join([e.dump() for e in self.exprs]))
+        try:
+            return "Query(%s)" % (' '.join([e.dump() for e in self.exprs]))
+        except RecursionError:
+            if self.is_sub:
+                raise
+            return _dump_tree(self, _QUERY)
 
-    def compose(self, field_name):
+    def canonical(self):
+        try:
+            return self._canonical()
+        except RecursionError:
+            if self.is_sub:
+                raise
+            raise _too_deep(self) from None
 
-        if len(self.exprs) == 1:
-            e = self.exprs[0]
+    def _canonical(self):
+        exprs = []
+        for e in self.exprs:
+            e = e.canonical()
+            if isinstance(e, Query) and _is_conjunction(e):
+                e = _unwrap(e)
+            exprs.append(e)
+
+        #
+        # A single group in parentheses is the query itself: ((+a)) is (+a)
+        # (the group is canonical already, without such a group in it)
+        #
+        if len(exprs) == 1 and isinstance(exprs[0], Query):
+            return type(self)( exprs[0].exprs )
+
+        #
+        # Without +/- clauses a query is the conjunction of its clauses
+        #
+        if not any([ isinstance(e, BoolExpr) for e in exprs ]):
+            flat = []
+            _flatten_and([ _unwrap(e) for e in exprs ], flat)
+            if any([ isinstance(e, BoolExpr) for e in flat ]):
+                # (a AND -b) c and (-b) c are a AND -b AND c, which only 
+                # AND can hold
+                flat = [ _and_of(flat) ]
+            exprs = flat
+
+        return type(self)( _sorted(exprs) )
+
+    def compose(self, field_name, optimize=False, mode='query', mapping=None):
+        """
+        Compose the DSL object. With an index `mapping` (a dict or a 
+        yaesql.mapping.Mapping) the leaf queries are chosen for the types
+        of their fields. With `optimize` the bool tree is flattened and 
+        term clauses are merged. `mode` ('query', 'filter' or 'auto')
+        selects the clauses put in filter context (see yaesql.optimizer)
+        """
+        q = self._compose(field_name)
+
+        if self.is_sub:
+            return q
+
+        try:
+            if mapping is not None:
+                from .mapping import Mapping
+                if not isinstance(mapping, Mapping):
+                    mapping = Mapping(mapping)
+                q = mapping.rewrite(q)
+
+            if optimize:
+                from .optimizer import optimize as optimize_dsl
+                q = optimize_dsl(q)
+
+            if mode != 'query':
+                from .optimizer import set_context
+                q = set_context(q, mode, field_name)
+        except RecursionError:
+            raise _too_deep(self) from None
+
+        return q
+
+    def _compose(self, field_name):
+        try:
+
+            if len(self.exprs) == 1:
+                e = self.exprs[0]
             
-            q = e.compose(field_name)
+                q = e.compose(field_name)
             
+                if self.is_sub:
+                    return q
+
+                return {
+                    'query': q
+                }
+
+            else:
+                must_conds     = []
+                must_not_conds = []
+                should_conds   = []
+
+                conds = []
+                for e in self.exprs:
+                    subq = e.compose(field_name)
+
+                    if   isinstance(e, BoolMust): 
+                        subq = subq['bool']['must']
+                        must_conds.append( subq )
+                    elif isinstance(e, BoolMustNot): 
+                        subq = subq['bool']['must_not']
+                        must_not_conds.append( subq )
+                    else:
+                        should_conds.append(subq)
+
+                    conds.append(subq)
+
+                if not must_conds and not must_not_conds and should_conds:
+                    must_conds = should_conds
+                    should_conds = []
+
+                q = { 
+                    'bool': {
+                    }
+                }
+
+                if must_conds    : 
+                    q['bool']['must'    ] = must_conds if len(must_conds) > 1 else must_conds[0]
+                if must_not_conds: 
+                    q['bool']['must_not'] = must_not_conds if len(must_not_conds) > 1 else must_not_conds[0] 
+                if should_conds  : 
+                    q['bool']['should'  ] = should_conds if len(should_conds) > 1 else should_conds[0] 
+            
+                if self.is_sub:
+                    return q
+
+                return {
+                    'query': q
+                }
+        except RecursionError:
             if self.is_sub:
-                return q
+                raise
+            return _compose_tree(self, field_name, _QUERY)
 
-            return {
-                'query': q
-            }
+    def write_json(self, field_name, out):
+        n = len(out)
+        try:
+
+            if not self.is_sub:
+                out.append('{"query": ')
+
+            if len(self.exprs) == 1:
+                self.exprs[0].write_json(field_name, out)
+
+            else:
+                must_conds     = []
+                must_not_conds = []
+                should_conds   = []
+
+                for e in self.exprs:
+                    part = []
+                    if   isinstance(e, BoolMust): 
+                        e.expr.write_json(field_name, part)
+                        must_conds.append( part )
+                    elif isinstance(e, BoolMustNot): 
+                        e.expr.write_json(field_name, part)
+                        must_not_conds.append( part )
+                    else:
+                        e.write_json(field_name, part)
+                        should_conds.append( part )
+
+                if not must_conds and not must_not_conds and should_conds:
+                    must_conds = should_conds
+                    should_conds = []
+
+                _write_json_bool(must_conds, must_not_conds, should_conds, out)
+
+            if not self.is_sub:
+                out.append('}')
+        except RecursionError:
+            if self.is_sub:
+                raise
+            del out[n:]
+            _write_json_tree(self, field_name, out, _QUERY)
+
+    def compile(self, **options):
+        try:
+            return CompiledQuery(self, **options)
+        except RecursionError:
+            raise _too_deep(self) from None
+
+    def prepare(self, field_name, **options):
+        try:
+            return PreparedQuery(self, field_name, **options)
+        except RecursionError:
+            raise _too_deep(self) from None
+
+    def evaluator(self, field_name):
+        """
+        Return a yaesql.evaluate.Evaluator running the query on in-memory
+        documents
+        """
+        from .evaluate import Evaluator
+        try:
+            return Evaluator(self, field_name)
+        except RecursionError:
+            raise _too_deep(self) from None
 
+#----------------------------------------------------------------------#
+# TREE TRAVERSAL                                                       #
+#----------------------------------------------------------------------#
+#
+# The compose(), write_json() and dump() methods recurse, which is the 
+# fastest way to walk the trees of ordinary queries. For a tree deeper
+# than the interpreter stack the root Query falls back to the functions
+# below: they walk the tree with an explicit stack of frames, so the depth
+# of a query is only bounded by memory. Leaves (terms, values, 
+# comparisons...), field:value terms and +/-/NOT clauses of a leaf are 
+# handled in the frame of their parent: only the nodes with a subtree get
+# a frame of their own.
+#
+# The JSON text and the dump are written in order to a list of strings.
+# Leaves, and nodes of subclasses overriding the method, are composed 
+# (dumped...) by calling their own method.
+#
+# The other walks (canonical(), the evaluator, and the optimizer, mapping
+# and compiled render passes over the DSL) recurse only: they raise 
+# QueryLimitError('max_depth', ...) for such a tree, as the parser does
+# for a query string nested that deep.
+#
+
+def _children(node, kind):
+    if kind == _COMPLEX:
+        return (node.value_expr,)
+    if kind <= _NOT:
+        return (node.expr,)
+    return node.exprs
+
+def _bool_clauses(exprs, conds):
+    """
+    The bool query of the composed clauses `conds` of a Query
+    """
+    must_conds     = []
+    must_not_conds = []
+    should_conds   = []
+
+    for e, subq in zip(exprs, conds):
+        if   isinstance(e, BoolMust):
+            must_conds.append( subq['bool']['must'] )
+        elif isinstance(e, BoolMustNot):
+            must_not_conds.append( subq['bool']['must_not'] )
         else:
-            must_conds     = []
-            must_not_conds = []
-            should_conds   = []
+            should_conds.append(subq)
 
-            conds = []
-            for e in self.exprs:
-                subq = e.compose(field_name)
+    if not must_conds and not must_not_conds and should_conds:
+        must_conds = should_conds
+        should_conds = []
+
+    q = {
+        'bool': {
+        }
+    }
 
-                if   isinstance(e, BoolMust): 
-                    subq = subq['bool']['must']
-                    must_conds.append( subq )
-                elif isinstance(e, BoolMustNot): 
-                    subq = subq['bool']['must_not']
-                    must_not_conds.append( subq )
+    if must_conds    :
+        q['bool']['must'    ] = must_conds if len(must_conds) > 1 else must_conds[0]
+    if must_not_conds:
+        q['bool']['must_not'] = must_not_conds if len(must_not_conds) > 1 else must_not_conds[0]
+    if should_conds  :
+        q['bool']['should'  ] = should_conds if len(should_conds) > 1 else should_conds[0]
+
+    return q
+
+def _compose_tree(node, field_name, kind):
+    """
+    Compose the tree under `node`, a node of the given kind
+    """
+    if kind == _COMPLEX:
+        field_name = node.field_expr
+    elif kind <= _NOT and isinstance(node.expr, Literal):
+        return { 'bool': { 'must' if kind == _MUST else 'must_not': _compose_term(node.expr, field_name) } }
+
+    stack    = []
+    children = _children(node, kind)
+    conds    = []
+    it       = iter(children)
+
+    while True:
+        for e in it:
+            k = e._compose_kind
+            if k == _LEAF:
+                conds.append( e.compose(field_name) )
+                continue
+
+            f = field_name
+            while k == _COMPLEX:
+                f = e.field_expr
+                e = e.value_expr
+                k = e._compose_kind
+
+            if k == _LEAF:
+                conds.append( e.compose(f) )
+                continue
+
+            if k <= _NOT:
+                c = e.expr
+                if isinstance(c, Literal):
+                    conds.append( { 'bool': { 'must' if k == _MUST else 'must_not': _compose_term(c, f) } } )
+                    continue
+                if c._compose_kind == _LEAF:
+                    conds.append( { 'bool': { 'must' if k == _MUST else 'must_not': c.compose(f) } } )
+                    continue
+
+            stack.append( (node, field_name, kind, children, conds, it) )
+
+            node       = e
+            kind       = k
+            field_name = f
+            children   = _children(node, kind)
+            conds      = []
+            it         = iter(children)
+            break
+
+        else:
+            # all the children are composed
+            if kind == _COMPLEX:
+                q = conds[0]
+            elif kind == _MUST:
+                q = { 'bool': { 'must': conds[0] } }
+            elif kind <= _NOT:
+                q = { 'bool': { 'must_not': conds[0] } }
+            elif kind == _QUERY:
+                q = conds[0] if len(conds) == 1 else _bool_clauses(children, conds)
+                if not node.is_sub:
+                    q = { 'query': q }
+            elif len(conds) == 1:
+                q = conds[0]
+                if kind == _AND:
+                    q = q['query'] if 'query' in q else { 'query': q }
+            else:
+                q = { 'bool': { 'must' if kind == _AND else 'should': conds } }
+
+            if not stack:
+                return q
+
+            node, field_name, kind, children, conds, it = stack.pop()
+            conds.append(q)
+
+def _json_parts(node, field_name, kind):
+    """
+    The JSON text of `node` as a list of strings and children: nodes, or
+    (value,) tuples for bare values composed as terms
+    """
+    if kind <= _NOT:
+        e = node.expr
+        if isinstance(e, Literal):
+            e = (e,)
+        return [ '{"bool": {"must": ' if kind == _MUST else '{"bool": {"must_not": ', e, '}}' ]
+
+    exprs = node.exprs
+
+    if kind != _QUERY:
+        if len(exprs) == 1:
+            if kind == _AND:
+                return [ json.dumps(node.compose(field_name)) ]
+            return [ exprs[0] ]
+
+        parts = [ '{"bool": {"must": [' if kind == _AND else '{"bool": {"should": [' ]
+        for e in exprs:
+            parts.append(e)
+            parts.append(', ')
+        if exprs:
+            parts.pop()
+        parts.append(']}}')
+        return parts
+
+    if len(exprs) == 1:
+        parts = [ exprs[0] ]
+    else:
+        must_conds     = []
+        must_not_conds = []
+        should_conds   = []
+
+        for e in exprs:
+            if   isinstance(e, BoolMust):
+                must_conds.append( (e.expr,) if isinstance(e.expr, Literal) else e.expr )
+            elif isinstance(e, BoolMustNot):
+                must_not_conds.append( (e.expr,) if isinstance(e.expr, Literal) else e.expr )
+            else:
+                should_conds.append(e)
+
+        if not must_conds and not must_not_conds and should_conds:
+            must_conds = should_conds
+            should_conds = []
+
+        parts = []
+        sep   = '{"bool": {'
+        for key, conds in (('must', must_conds), ('must_not', must_not_conds), ('should', should_conds)):
+            if conds:
+                parts.append( '%s"%s": ' % (sep, key) )
+                if len(conds) > 1:
+                    parts.append('[')
+                    for c in conds:
+                        parts.append(c)
+                        parts.append(', ')
+                    parts[-1] = ']'
                 else:
-                    should_conds.append(subq)
+                    parts.append(conds[0])
+                sep = ', '
+        parts.append('}}')
+
+    if not node.is_sub:
+        parts.insert(0, '{"query": ')
+        parts.append('}')
+
+    return parts
+
+def _write_json_tree(node, field_name, out, kind):
+    """
+    Append the JSON text of the tree under `node`, a node of the given 
+    kind, to `out`
+    """
+    if kind == _COMPLEX:
+        # no text of its own
+        node.value_expr.write_json(node.field_expr, out)
+        return
+
+    stack = []
+    it    = iter(_json_parts(node, field_name, kind))
+
+    while True:
+        for p in it:
+            if type(p) is str:
+                out.append(p)
+                continue
+            if type(p) is tuple:
+                _write_json_term(p[0], field_name, out)
+                continue
+
+            k = p._json_kind
+            f = field_name
+            while k == _COMPLEX:
+                f = p.field_expr
+                p = p.value_expr
+                k = p._json_kind
+
+            if k == _LEAF:
+                p.write_json(f, out)
+                continue
+
+            stack.append( (field_name, it) )
+
+            field_name = f
+            it         = iter(_json_parts(p, f, k))
+            break
 
-                conds.append(subq)
+        else:
+            if not stack:
+                return
+
+            field_name, it = stack.pop()
+
+def _dump_parts(node, kind):
+    """
+    The dump of `node` as a list of strings and children
+    """
+    if kind == _COMPLEX:
+        return [ "ComplexTerm(%s:" % (node.field_expr), node.value_expr, ")" ]
+    if kind <= _NOT:
+        return [ ("Must(", "MustNot(", "NOT(")[kind - _MUST], node.expr, ")" ]
+
+    if kind == _QUERY:
+        parts, sep = [ "Query(" ], " "
+    else:
+        parts, sep = [ "(" ], " AND " if kind == _AND else " OR "
+
+    for e in node.exprs:
+        parts.append(e)
+        parts.append(sep)
+    if node.exprs:
+        parts.pop()
+    parts.append(")")
+    return parts
+
+def _dump_tree(node, kind):
+    """
+    Dump the tree under `node`, a node of the given kind
+    """
+    out   = []
+    stack = []
+    it    = iter(_dump_parts(node, kind))
+
+    while True:
+        for p in it:
+            if type(p) is str:
+                out.append(p)
+                continue
+
+            k = p._dump_kind
+            if k == _LEAF:
+                out.append(p.dump())
+                continue
+
+            stack.append(it)
+            it = iter(_dump_parts(p, k))
+            break
 
-            if not must_conds and not must_not_conds and should_conds:
-                must_conds = should_conds
-                should_conds = []
+        else:
+            if not stack:
+                return ''.join(out)
+
+            it = stack.pop()
+
+def _depth(node):
+    """
+    Nesting depth of the groups in parentheses under `node`, counted 
+    without recursion
+    """
+    depth = 0
+    stack = [ (node, 0) ]
+    while stack:
+        node, level = stack.pop()
+        if level > depth:
+            depth = level
+        children = list(getattr(node, 'exprs', ()))
+        for name in ('expr', 'value_expr'):
+            child = getattr(node, name, None)
+            if isinstance(child, Expr):
+                children.append(child)
+        for child in children:
+            stack.append( (child, level + 1 if isinstance(child, Query) else level) )
+    return depth
+
+def _too_deep(node):
+    """
+    The error raised for a tree deeper than the interpreter stack by the
+    walks that recurse (see TREE TRAVERSAL)
+    """
+    from .limits import QueryLimitError
+    depth = _depth(node)
+    return QueryLimitError('max_depth', depth, None, "Query too deeply nested: depth %d" % (depth,))
+
+#
+# Canonical form helpers
+#
+
+def _sorted(exprs):
+    return sorted(exprs, key=lambda e: e.dump())
+
+def _unwrap(e):
+    """
+    A parenthesized query with a single clause composes as the clause
+    itself (when its parent is not a Query or MultiValue that treats +/- 
+    clauses apart), however many parentheses there are
+    """
+    while isinstance(e, Query) and len(e.exprs) == 1:
+        e = e.exprs[0]
+    if isinstance(e, Query) and _is_conjunction(e):
+        # (a b) is a AND b
+        return _and_of(e.exprs)
+    return e
+
+def _and_of(exprs):
+    """
+    The canonical AND of canonical `exprs`, as AndExpr.canonical() builds it
+    """
+    flat = []
+    _flatten_and([ _unwrap(e) for e in exprs ], flat)
+    return AndExpr( _sorted(flat) )
+
+def _flatten_and(exprs, out):
+    for e in exprs:
+        if isinstance(e, AndExpr) or _is_conjunction(e):
+            _flatten_and(e.exprs, out)
+        else:
+            out.append(e)
 
-            q = { 
-                'bool': {
-                }
-            }
+def _is_conjunction(e):
+    """
+    True for AND expressions and queries without +/- clauses
+    """
+    return isinstance(e, (AndExpr, Query)) and not any([ isinstance(c, BoolExpr) for c in e.exprs ])
 
-            if must_conds    : 
-                q['bool']['must'    ] = must_conds if len(must_conds) > 1 else must_conds[0]
-            if must_not_conds: 
-                q['bool']['must_not'] = must_not_conds if len(must_not_conds) > 1 else must_not_conds[0] 
-            if should_conds  : 
-                q['bool']['should'  ] = should_conds if len(should_conds) > 1 else should_conds[0] 
-            
-            if self.is_sub:
-                return q
+#----------------------------------------------------------------------#
+# COMPILED QUERIES                                                     #
+#----------------------------------------------------------------------#
 
-            return {
-                'query': q
-            }
+class _FieldSlot(object):
+    """
+    Stands for the default field while composing a compiled query
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'field_name'
+
+_FIELD_SLOT = _FieldSlot()
+
+def _render_source(skeleton, max_nesting=32, params=None):
+    """
+    Translate a composed skeleton into the source of a function that 
+    builds it again from scratch. Containers are built by nested literal
+    expressions, spilled into local variables every `max_nesting` levels
+    to stay within the limits of the Python compiler.
+
+    With a `params` set the function takes the dict of the parameter 
+    values as second argument: placeholders are replaced with them and 
+    their names added to the set.
+    """
+    if params is None:
+        lines = [ 'def render(field_name):' ]
+    else:
+        lines = [ 'def render(field_name, params):' ]
+    consts = []
+
+    def emit(o):
+        # returns (code, nesting)
+        if o is _FIELD_SLOT:
+            return 'field_name', 0
+
+        if params is not None and isinstance(o, Placeholder):
+            params.add(o.val)
+            return 'params[%r]' % (o.val,), 0
+
+        if isinstance(o, dict):
+            items = [ (emit(k), emit(v)) for k, v in o.items() ]
+            code  = '{%s}' % (', '.join([ '%s: %s' % (k[0], v[0]) for k, v in items ]))
+            depth = 1 + max([ v[1] for k, v in items ] or [ 0 ])
+        elif isinstance(o, list):
+            items = [ emit(v) for v in o ]
+            code  = '[%s]' % (', '.join([ v[0] for v in items ]))
+            depth = 1 + max([ v[1] for v in items ] or [ 0 ])
+        elif o is None or isinstance(o, (str, bool, int)):
+            return repr(o), 0
+        else:
+            consts.append(o)
+            return '_consts[%d]' % (len(consts) - 1), 0
+
+        if depth < max_nesting:
+            return code, depth
+
+        name = '_%d' % (len(lines))
+        lines.append('    %s = %s' % (name, code))
+        return name, 0
+
+    lines.append('    return %s' % (emit(skeleton)[0]))
+
+    return '\n'.join(lines) + '\n', consts
+
+class CompiledQuery(object):
+    """
+    A query composed once with a slot for the default field. 
+    
+    `render(field_name)` returns the same DSL as 
+    `query.compose(field_name, **options)` without walking the query tree 
+    again.
+
+    With a `mapping` the queries on the default field depend on its type,
+    and with `optimize` or a `mode` the clauses are merged or scored by
+    field: the query is composed once per default field instead.
+    """
+
+    def __init__(self, query, **options):
+        self.query = query
+
+        self.options = _field_options(options)
+        if self.options is not None:
+            self.source  = None
+            self.renders = {}
+            self.render  = self._render_for
+            return
+
+        skeleton = query.compose(_FIELD_SLOT, **options)
+
+        self.source, consts = _render_source(skeleton)
+
+        self.render = _exec_render(self.source, consts)
+
+    def _render_for(self, field_name):
+        render = self.renders.get(field_name)
+        if render is None:
+            try:
+                source, consts = _render_source(self.query.compose(field_name, **self.options))
+                render = self.renders[field_name] = _exec_render(source, consts)
+            except RecursionError:
+                raise _too_deep(self.query) from None
+        return render(field_name)
+
+def _mapping_options(options):
+    """
+    `options` with the mapping as a Mapping object, None without mapping
+    """
+    mapping = options.get('mapping')
+    if mapping is None:
+        return None
+    from .mapping import Mapping
+    if not isinstance(mapping, Mapping):
+        options = dict(options, mapping=Mapping(mapping))
+    return options
+
+def _field_options(options):
+    """
+    `options` as _mapping_options() if the DSL depends on the default
+    field name (not only at its place), None otherwise
+    """
+    if options.get('optimize') or options.get('mode', 'query') != 'query':
+        return _mapping_options(options) or options
+    return _mapping_options(options)
+
+def _exec_render(source, consts):
+    namespace = { '_consts': consts }
+    exec(compile(source, '<compiled query>', 'exec'), namespace)
+    return namespace['render']
+
+#
+# Values accepted for the parameters of a prepared query: they end up in
+# the DSL as they are
+#
+PARAM_TYPES = (str, int, float, bool)
+
+class PreparedQuery(object):
+    """
+    A query with `$name` parameters composed once for `field_name`.
+
+    `bind(**params)` returns the DSL of the query with the parameters 
+    replaced by the given values, without parsing or composing it again.
+    Values are never parsed: whatever they contain they are matched as
+    they are. `params` is the set of the parameter names.
+    """
+
+    def __init__(self, query, field_name, **options):
+        self.query      = query
+        self.field_name = field_name
+
+        # see CompiledQuery
+        self.options = _field_options(options)
+        self.renders = {}
+
+        if self.options is not None:
+            skeleton = query.compose(field_name, **self.options)
+        else:
+            skeleton = query.compose(_FIELD_SLOT, **options)
+
+        names = set()
+        self.source, consts = _render_source(skeleton, params=names)
+        self.params = frozenset(names)
+
+        self._render = _exec_render(self.source, consts)
+
+        if self.options is not None:
+            self.renders[field_name] = self._render
+
+    def render(self, field_name, **params):
+        """
+        bind() for another default field
+        """
+        if params.keys() != self.params:
+            missing    = sorted(self.params - params.keys())
+            unexpected = sorted(params.keys() - self.params)
+            if missing:
+                raise TypeError("Missing query parameters: %s" % (', '.join([ '$' + n for n in missing ])))
+            raise TypeError("Unexpected query parameters: %s" % (', '.join([ '$' + n for n in unexpected ])))
+
+        for name, v in params.items():
+            if not isinstance(v, PARAM_TYPES):
+                raise TypeError("Query parameter $%s: unsupported value %r" % (name, v))
+
+        if self.options is None:
+            return self._render(field_name, params)
+
+        render = self.renders.get(field_name)
+        if render is None:
+            try:
+                source, consts = _render_source(self.query.compose(field_name, **self.options), params=set())
+                render = self.renders[field_name] = _exec_render(source, consts)
+            except RecursionError:
+                raise _too_deep(self.query) from None
+        return render(field_name, params)
+
+    def bind(self, **params):
+        return self.render(self.field_name, **params)
+
+#----------------------------------------------------------------------#
+# TYPED VALUES                                                         #
+#----------------------------------------------------------------------#
+#
+# Unquoted values that are whole numbers, ISO 8601 dates or date math
+# expressions (`now-1d/d`, `2020-03-20||+1M`) are parsed as typed
+# literals; quoted values are always strings. The patterns are shared by
+# both engines and only match whole values: `10.0.0.1` and `2020-03-20x`
+# stay strings.
+#
+
+_END_OF_VALUE = r'(?![A-Za-z0-9.:\-+_/|])'
+
+_NUMBER_PATTERN = r'(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?' + _END_OF_VALUE
+
+_DATE_MATH = r'(?:[+-][0-9]+[yMwdhHms]|/[yMwdhHms])*'
+
+_ISO_DATE  = (
+    r'[0-9]{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])'
+    r'(?:T[0-9]{2}(?::[0-9]{2}(?::[0-9]{2}(?:\.[0-9]{1,9})?)?)?(?:Z|[+-][0-9]{2}(?::?[0-9]{2})?)?)?'
+)
+
+_DATE_PATTERN = r'(?:now' + _DATE_MATH + r'|' + _ISO_DATE + r'(?:\|\|' + _DATE_MATH + r')?)' + _END_OF_VALUE
+
+def _number(tok):
+    """
+    Value of a NUMBER token, None if it does not fit a 64 bit integer or
+    a finite double, or if its JSON number is not written as the token
+    (`1.10`, `1e3`: on a keyword field only the token itself matches)
+    """
+    if '.' in tok or 'e' in tok or 'E' in tok:
+        v = float(tok)
+        if not math.isfinite(v):
+            return None
+    else:
+        v = int(tok)
+        if not -2**63 <= v < 2**63:
+            return None
+    return v if repr(v) == tok.lstrip('+') else None
 
 #----------------------------------------------------------------------#
 
@@ -414,9 +1621,11 @@ def _create_parser(self):
     END   = pp.StringEnd().suppress()
 
     #
-    # NUMBER
+    # NUMBER, DATE (whole values only), signed NUMBER (in comparisons)
     #
-    #NUMBER = pp.Regex(r"[+-]?\d+(:?\.\d*)?(:?[eE][+-]?\d+)?")           .setParseAction( lambda s, loc, toks: [ self.create_NumberLiteral(int(toks[0])) ] ) 
+    NUMBER  = pp.Regex(_NUMBER_PATTERN)                   .setParseAction( self.create_NumberLiteral )
+    DATE    = pp.Regex(_DATE_PATTERN)                     .setParseAction( self.create_DateLiteral )
+    SIGNED  = pp.Regex(r'[+-]' + _NUMBER_PATTERN)         .setParseAction( self.create_NumberLiteral )
 
     #
     # -foo_bar:
@@ -434,13 +1643,24 @@ def _create_parser(self):
     # r'...'
     #
     REGEXP  = pp.Combine(pp.Suppress('r') + QUOTED)       .setParseAction( self.create_RegExLiteral )
+
+    #
+    # $name
+    #
+    PARAM   = pp.Combine(pp.Suppress('$') + pp.Word(pp.alphas+'_', pp.alphanums+'_'))  .setParseAction( self.create_Placeholder )
     
 
     STRINGS = (
                REGEXP                                               
                | 
+               PARAM
+               | 
                QUOTED                                               .setParseAction( self.create_StringLiteral ) 
                | 
+               DATE
+               | 
+               NUMBER
+               | 
                TERM                                                 .setParseAction( self.create_StringLiteral )
               )                                                     
 
@@ -513,7 +1733,7 @@ def _create_parser(self):
     compare_term = (
               (LTE | LT | GTE | GT)
               +
-              basic_value
+              (SIGNED | basic_value)
     )                                                                   .setParseAction( self.create_CompareValue ) 
 
     complex_value = (
@@ -598,22 +1818,176 @@ def _create_parser(self):
     return parser
 
 
-           
+#----------------------------------------------------------------------#
+# SHARED GRAMMAR                                                       #
+#----------------------------------------------------------------------#
+#
+# The pyparsing grammar is built once per process, on first use, and 
+# shared by every Parser. Its parse actions forward to the `create_*` 
+# factory methods of the Parser that is running on the current thread.
+#
+
+_active = threading.local()
+
+class _ActiveFactory(object):
+
+    def __getattr__(self, name):
+        def action(s, loc, toks):
+            return getattr(_active.factory, name)(s, loc, toks)
+        return action
+
+_grammar      = None
+_grammar_lock = threading.Lock()
+
+def _shared_grammar():
+    global _grammar
+    if _grammar is None:
+        with _grammar_lock:
+            if _grammar is None:
+                grammar = _create_parser(_ActiveFactory())
+                grammar.streamline()
+                _grammar = grammar
+    return _grammar
+
+class _GrammarEngine(object):
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def parseString(self, s):
+        grammar = _shared_grammar()
+
+        prev = getattr(_active, 'factory', None)
+        _active.factory = self.factory
+        try:
+            return grammar.parseString(s)
+        finally:
+            _active.factory = prev
+
 #----------------------------------------------------------------------#
 
 class Parser(object):
+    """
+    Query string parser.
+
+    AST nodes are built by the `create_*` factory methods: override them in
+    a subclass to build custom nodes.
+
+    A Parser holds no per-parse state: a single instance can be used from
+    many threads at once.
+
+    Regular expressions with a cheaper equivalent (`r"foo"`, `r"foo.*"`)
+    are composed as term, prefix or wildcard queries unless
+    `rewrite_regex` is false.
+
+    Unquoted numbers are composed as JSON numbers, unquoted ISO 8601 
+    dates and date math expressions as strings: range queries on dates
+    get the `date_format` and `time_zone` of the parser, if set.
+
+    `instrument` is a callable receiving an event (a dict) with timings
+    and counters for every parseString() and compose() call, e.g. a
+    yaesql.instrument.Metrics registry.
+
+    `max_length`, `max_depth` (of parentheses), `max_tokens` and `timeout`
+    (seconds) limit the accepted query strings: parseString() raises
+    yaesql.limits.QueryLimitError for a query over any of them. Queries
+    too deeply nested for the Python stack raise it as well.
+
+    With `cache_size` the parsed trees are kept in a LRU cache (with an
+    optional `cache_ttl` in seconds) keyed by the normalized query string.
+    Cached trees are shared between callers: they must be treated as read
+    only (`dump()` and `compose()` never modify them).
+
+    With `cache_dir` the parsed trees are also stored in a directory that
+    processes share (see yaesql.cache.DiskCache): a query string parsed
+    by any of them is loaded instead of parsed, until the grammar changes.
+    Subclasses building their nodes from state of their own must override
+    cache_salt().
+
+    With `share_nodes` structurally identical subtrees of the parsed 
+    queries are the same nodes (see yaesql.share.NodeTable), and their
+    terms compose once per default field: the composed DSL objects share
+    their sub-objects and must be treated as read only.
+    """
+
+    ENGINES = ('pyparsing', 'fast')
     
-    def __init__(self):
-        self.parser = _create_parser(self)
+    def __init__(self, engine='pyparsing', cache_size=None, cache_ttl=None, rewrite_regex=True, instrument=None,
+                 max_length=None, max_depth=None, max_tokens=None, timeout=None, date_format=None, time_zone=None,
+                 cache_dir=None, share_nodes=False):
+        factory = self
+        if instrument is not None:
+            from .instrument import InstrumentedFactory
+            factory = InstrumentedFactory(self)
+
+        self.limits = None
+        if max_length is not None or max_depth is not None or max_tokens is not None or timeout is not None:
+            from .limits import Limits, DeadlineFactory
+            self.limits = Limits(max_length, max_depth, max_tokens, timeout)
+            if timeout is not None:
+                factory = DeadlineFactory(factory, self.limits)
+
+        if engine == 'pyparsing':
+            self.parser = _GrammarEngine(factory)
+        elif engine == 'fast':
+            from .fastparser import FastParser
+            self.parser = FastParser(factory)
+        else:
+            raise ValueError("Unknown parser engine %r (expected one of %s)" % (engine, ', '.join(Parser.ENGINES)))
+
+        self.engine = engine
+
+        self.instrument = instrument
+
+        self.rewrite_regex = rewrite_regex
+
+        self.date_format = date_format
+        self.time_zone   = time_zone
+
+        self.cache = None
+        if cache_size:
+            from .cache import ParseCache
+            self.cache = ParseCache(cache_size, cache_ttl)
+
+        self.disk_cache = None
+        if cache_dir is not None:
+            from .cache import DiskCache
+            # trees depend on the factory and on its options
+            salt = repr((type(self).__module__, type(self).__qualname__, rewrite_regex, date_format, time_zone, self.cache_salt()))
+            self.disk_cache = DiskCache(cache_dir, salt)
+
+        self.nodes = None
+        if share_nodes:
+            from .share import NodeTable
+            self.nodes = NodeTable()
+
+    def cache_salt(self):
+        """
+        A string added to the keys of the disk cache, None by default. The
+        keys cover the class of the parser and its options: a subclass 
+        whose `create_*` methods depend on state of its own must override
+        this method to return that state (set before calling 
+        `Parser.__init__()`), or its parsers would load each other's trees
+        """
+        return None
 
     def create_RegExLiteral(self, s, loc, toks):
-        return RegExLiteral( toks[0] )
+        return RegExLiteral( toks[0], self.rewrite_regex )
 
     def create_StringLiteral(self, s, loc, toks):
         return StringLiteral( toks[0] )
 
     def create_NumberLiteral(self, s, loc, toks):
-        return NumberLiteral( toks[0] )
+        val = _number(toks[0])
+        if val is None:
+            return self.create_StringLiteral(s, loc, toks)
+        return NumberLiteral( val )
+
+    def create_DateLiteral(self, s, loc, toks):
+        return DateLiteral( toks[0], self.date_format, self.time_zone )
+
+    def create_Placeholder(self, s, loc, toks):
+        return Placeholder( toks[0] )
 
     def create_SimpleTerm(self, s, loc, toks):
         return SimpleTerm( toks[0] )
@@ -652,57 +2026,170 @@ class Parser(object):
     #--------------------------------------------------------------#
 
     def parseString(self, s):
-        return self.parser.parseString(s)[0]
+        if self.limits is not None:
+            self.limits.check(s)
 
-#----------------------------------------------------------------------#
-#                                                                      #
-#----------------------------------------------------------------------#
+        try:
+            if self.instrument is not None:
+                from .instrument import parse
+                return parse(self, s)
 
-def prettyformat(o, l=0, ind='    '):
-    s = ''
-    if isinstance(o, dict):
-        s += "{\n"
-        for k,v in o.items():
-            s += ind * (l+1)
-            s += '"%s" : %s' % (k, prettyformat(v, l+1, ind))
-        s += ind * l
-        s += "}\n"
-    elif isinstance(o, list):
-        s += "[\n"
-        for o2 in o:
-            s += ind * (l+1) + prettyformat(o2, l+1, ind) 
-            s += ind * (l+1) + ',\n'
-        s += ind * l
-        s +="]\n"
-    else:
-        s = repr(o) + '\n'
-    return s
+            if self.cache is None and self.disk_cache is None and self.nodes is None:
+                return self.parser.parseString(s)[0]
+
+            from .cache import normalize_query
+
+            key = normalize_query(s)
+
+            if self.cache is None:
+                return self._parse_key(s, key)
+
+            q = self.cache.get(key)
+            if q is None:
+                q = self._parse_key(s, key)
+                self.cache.put(key, q)
+            return q
+
+        except RecursionError:
+            from .limits import QueryLimitError, scan
+            depth = scan(s)[1]
+            raise QueryLimitError('max_depth', depth, None, "Query too deeply nested: depth %d" % (depth,)) from None
+
+    def _parse_key(self, s, key):
+        """
+        Parse the query string `s` (`key` is its normalized form), through
+        the disk cache if any, sharing the subtrees of the result with the
+        node table if any
+        """
+        disk_cache = self.disk_cache
+        if disk_cache is None:
+            q = self.parser.parseString(s)[0]
+        else:
+            q = disk_cache.get(key)
+            if q is None:
+                q = self.parser.parseString(s)[0]
+                disk_cache.put(key, q)
+
+        if self.nodes is not None:
+            q = self.nodes.intern(q)
+        return q
+
+    def compose(self, query, field_name, **options):
+        """
+        Compose `query` (a Query or a query string to parse): like 
+        `query.compose(field_name, **options)`, timed by the instrument of
+        the parser if any.
+        """
+        if isinstance(query, str):
+            query = self.parseString(query)
+
+        if self.instrument is None:
+            return query.compose(field_name, **options)
+
+        from .instrument import compose
+        return compose(self, query, field_name, **options)
+
+    def prepare(self, s, field_name, **options):
+        """
+        Parse the query string `s`, with `$name` parameters, once: return
+        a PreparedQuery whose `bind(**params)` composes the query with the
+        given parameter values (see Query.compose() for the options)
+        """
+        return self.parseString(s).prepare(field_name, **options)
+
+    def parse_many(self, items, backend='serial', workers=None, chunksize=256):
+        """
+        Parse every query string of `items`. 
+        
+        Return an iterator of results in input order: a result is the parsed
+        query or the exception raised parsing it. `backend` is one of 
+        'serial', 'thread' or 'process'; items are sent to `workers` 
+        threads/processes in chunks of `chunksize` items.
+        """
+        from .batch import run_batch
+        return run_batch(self, items, backend=backend, workers=workers, chunksize=chunksize)
+
+    def compose_many(self, items, field_name, as_json=False, backend='serial', workers=None, chunksize=256, **options):
+        """
+        Like `parse_many()` but results are the composed DSL objects (or
+        their JSON bytes if `as_json` is true), see Query.compose() for
+        the options.
+        """
+        from .batch import run_batch
+        options = _mapping_options(options) or options
+        return run_batch(self, items, field_name, as_json, compose=True, backend=backend, workers=workers, chunksize=chunksize, options=options)
+
+    def cache_info(self):
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def cache_clear(self):
+        if self.cache is not None:
+            self.cache.clear()
 
 #----------------------------------------------------------------------#
 #                                                                      #
 #----------------------------------------------------------------------#
 
-if __name__ == "__main__":
+_END = object()
+
+def iterprettyformat(o, l=0, ind='    '):
+    """
+    Generate the chunks of the pretty printed form of `o`. 
+
+    The structure is walked with an explicit stack: time is linear in the 
+    size of the output and no chunk is kept after being yielded.
+    """
+    stack = []
+    while True:
+        #
+        # Open the current value
+        #
+        if isinstance(o, dict):
+            yield "{\n"
+            stack.append( (True, iter(o.items()), l) )
+        elif isinstance(o, list):
+            yield "[\n"
+            stack.append( (False, iter(o), l) )
+        else:
+            yield repr(o) + '\n'
+            if stack and not stack[-1][0]:
+                yield ind * (stack[-1][2]+1) + ',\n'
+
+        #
+        # Move to the next value, closing the finished containers
+        #
+        while stack:
+            is_dict, items, l = stack[-1]
+
+            item = next(items, _END)
+            if item is _END:
+                stack.pop()
+                yield ind * l + ("}\n" if is_dict else "]\n")
+                if stack and not stack[-1][0]:
+                    yield ind * (stack[-1][2]+1) + ',\n'
+                continue
+
+            if is_dict:
+                k, o = item
+                yield ind * (l+1) + '"%s" : ' % (k,)
+            else:
+                o = item
+                yield ind * (l+1)
 
-    import sys
-    import json
-    
-    parser = Parser()
-    
-    index_name    = sys.argv[1]
-    default_field = sys.argv[2]
-    string_query  = sys.argv[3]
-    
-    print(string_query)
-    
-    query_generator = parser.parseString(string_query)
-    
-    print(query_generator.dump())
-    
-    es_dsl_query = query_generator.compose(default_field)
-    
-    print("-----JSON STRING---")
-    print( repr(json.dumps(es_dsl_query)) )
-    
-    print("----- ES DSL -----")
-    print( prettyformat(es_dsl_query) )
+            l += 1
+            break
+        else:
+            return
+
+def prettywrite(o, fp, l=0, ind='    '):
+    """
+    Write the pretty printed form of `o` to the file-like object `fp`
+    """
+    write = fp.write
+    for chunk in iterprettyformat(o, l, ind):
+        write(chunk)
+
+def prettyformat(o, l=0, ind='    '):
+    return ''.join(iterprettyformat(o, l, ind))
@@ -0,0 +1,178 @@
+import collections
+
+#----------------------------------------------------------------------#
+# COST MODEL                                                           #
+#----------------------------------------------------------------------#
+#
+# A static estimate of the work a query asks to Elasticsearch, computed
+# on the parsed tree before anything is composed:
+#
+#   clauses             leaf queries (term, range, prefix, ...): what
+#                       counts against `indices.query.bool.max_clause_count`
+#   depth               nesting depth of the boolean operators
+#   regexes             regular expressions by composed query type
+#                       (see yaesql.regex)
+#   leading_wildcards   prefix-less wildcard/regexp queries, that have to
+#                       scan every term of the field
+#   cost                sum of the weights of the leaf queries, each one
+#                       multiplied by the weight of its field
+#
+
+WEIGHTS = {
+    'term'            :   1.0,
+    'range'           :   2.0,
+    'prefix'          :   5.0,
+    'wildcard'        :  10.0,
+    'regexp'          :  25.0,
+    'leading_wildcard': 100.0,
+}
+
+#
+# Limits accepted by validate(), compared with the attributes of Cost.
+# `regexes` limits the number of wildcard and regexp queries.
+#
+LIMITS = ('clauses', 'depth', 'regexes', 'leading_wildcards', 'cost')
+
+#
+# First characters of a regular expression that does not start with a
+# literal prefix
+#
+_LEADING = frozenset('.?+*|{}[]()"#@&<>~')
+
+class Cost(collections.namedtuple('Cost', 'clauses depth regexes leading_wildcards cost')):
+
+    __slots__ = ()
+
+    def violations(self, limits):
+        """
+        Return the list of (name, value, limit) for every limit of the dict
+        `limits` that is exceeded
+        """
+        result = []
+        for name, limit in limits.items():
+            if name not in LIMITS:
+                raise ValueError("Unknown query limit %r (expected one of %s)" % (name, ', '.join(LIMITS)))
+            if limit is None:
+                continue
+
+            if name == 'regexes':
+                value = self.regexes.get('wildcard', 0) + self.regexes.get('regexp', 0)
+            else:
+                value = getattr(self, name)
+
+            if value > limit:
+                result.append( (name, value, limit) )
+        return result
+
+class QueryBudgetError(ValueError):
+    """
+    Raised by validate() for a query over one of its limits
+    """
+
+    def __init__(self, cost, violations):
+        super().__init__("Query over budget: %s" % (', '.join([ '%s %s > %s' % v for v in violations ])))
+        self.cost       = cost
+        self.violations = violations
+
+    def __reduce__(self):
+        # sent back by the workers of a process pool
+        return (type(self), (self.cost, self.violations))
+
+def _is_leading_wildcard(kind, value):
+    if kind == 'wildcard':
+        return value[:1] in ('*', '?')
+    if kind == 'regexp':
+        return value[:1] in _LEADING
+    return False
+
+def cost(node, field_name=None, weights=None, field_weights=None):
+    """
+    Return the Cost of the tree rooted at `node`. `weights` overrides the
+    WEIGHTS of the query types, `field_weights` maps field names to a
+    weight (default 1). `field_name` is the default field.
+    """
+    from . import (
+        Literal, RegExLiteral, SimpleTerm, ComplexTerm, CompareValue, MultiValue,
+        BoolMust, BoolMustNot, NotExpr, AndExpr, OrExpr, Query
+    )
+
+    if weights:
+        weights = dict(WEIGHTS, **weights)
+    else:
+        weights = WEIGHTS
+
+    field_weights = field_weights or {}
+
+    clauses = 0
+    depth   = 0
+    regexes = {}
+    leading = 0
+    total   = 0.0
+
+    #
+    # Deeply nested queries are walked with an explicit stack
+    #
+    stack = [ (node, field_name, 0) ]
+    while stack:
+        e, field, level = stack.pop()
+
+        if isinstance(e, SimpleTerm):
+            e = e.expr
+
+        if isinstance(e, Literal):
+            kind = 'term'
+            if isinstance(e, RegExLiteral):
+                kind, value = e.query
+                regexes[kind] = regexes.get(kind, 0) + 1
+                if _is_leading_wildcard(kind, value):
+                    leading += 1
+                    kind = 'leading_wildcard'
+
+            clauses += 1
+            total   += weights[kind] * field_weights.get(field, 1.0)
+            continue
+
+        if isinstance(e, CompareValue):
+            clauses += 1
+            total   += weights['range'] * field_weights.get(field, 1.0)
+            continue
+
+        if isinstance(e, ComplexTerm):
+            stack.append( (e.value_expr, e.field_expr, level) )
+            continue
+
+        if isinstance(e, (Query, MultiValue)) and len(e.exprs) == 1 and not isinstance(e.exprs[0], (BoolMust, BoolMustNot)):
+            stack.append( (e.exprs[0], field, level) )
+            continue
+
+        #
+        # Boolean nodes
+        #
+        level += 1
+        if level > depth:
+            depth = level
+
+        if isinstance(e, (BoolMust, BoolMustNot, NotExpr)):
+            stack.append( (e.expr, field, level) )
+        elif isinstance(e, (MultiValue, Query)):
+            # their +/- clauses go straight in their own bool
+            stack.extend([ (c.expr if isinstance(c, (BoolMust, BoolMustNot)) else c, field, level) for c in e.exprs ])
+        elif isinstance(e, (AndExpr, OrExpr)):
+            stack.extend([ (c, field, level) for c in e.exprs ])
+        else:
+            raise TypeError("Unexpected query node %r" % (e,))
+
+    return Cost(clauses, depth, regexes, leading, total)
+
+def validate(node, limits, field_name=None, weights=None, field_weights=None):
+    """
+    Return the Cost of the tree rooted at `node` or raise QueryBudgetError
+    if it exceeds any of the `limits` (a dict keyed by LIMITS)
+    """
+    c = cost(node, field_name, weights, field_weights)
+
+    violations = c.violations(limits)
+    if violations:
+        raise QueryBudgetError(c, violations)
+
+    return c
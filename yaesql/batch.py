@@ -0,0 +1,121 @@
+import collections
+import itertools
+import os
+
+#----------------------------------------------------------------------#
+# BATCH PROCESSING                                                     #
+#----------------------------------------------------------------------#
+#
+# Items are processed in chunks. Each chunk returns one result per item:
+# the parsed/composed query or the exception raised for that item, so a
+# bad query never aborts the batch.
+#
+
+BACKENDS = ('serial', 'thread', 'process')
+
+def _parse_chunk(parser, chunk):
+    results = []
+    for s in chunk:
+        try:
+            results.append( parser.parseString(s) )
+        except Exception as e:
+            results.append( e )
+    return results
+
+def _compose_chunk(parser, chunk, field_name, as_json, options):
+    results = []
+    for s in chunk:
+        try:
+            q = parser.parseString(s)
+            results.append( q.compose_json(field_name, **options) if as_json else q.compose(field_name, **options) )
+        except Exception as e:
+            results.append( e )
+    return results
+
+#
+# Process pool workers receive a copy of the parser once, when they start
+#
+
+_worker_parser = None
+
+def _init_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+def _worker_parse_chunk(chunk):
+    return _parse_chunk(_worker_parser, chunk)
+
+def _worker_compose_chunk(chunk, field_name, as_json, options):
+    return _compose_chunk(_worker_parser, chunk, field_name, as_json, options)
+
+#----------------------------------------------------------------------#
+
+def _chunks(iterable, chunksize):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def _ordered_map(executor, fn, chunks, inflight):
+    """
+    Like executor.map() but with at most `inflight` pending chunks, so long
+    inputs are consumed lazily.
+    """
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append( executor.submit(fn, chunk) )
+        if len(pending) >= inflight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def run_batch(parser, items, field_name=None, as_json=False, compose=False, backend='serial', workers=None, chunksize=256, options=None):
+    """
+    Parse (and compose with the compose `options` when `compose` is true)
+    every query string of `items`. Return an iterator of results in input
+    order.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown batch backend %r (expected one of %s)" % (backend, ', '.join(BACKENDS)))
+    if chunksize <= 0:
+        raise ValueError("Chunk size must be positive: %r" % (chunksize,))
+
+    return _run_batch(parser, _chunks(items, chunksize), field_name, as_json, compose, backend, workers, options or {})
+
+def _run_batch(parser, chunks, field_name, as_json, compose, backend, workers, options):
+
+    if backend == 'serial':
+        for chunk in chunks:
+            if compose:
+                yield from _compose_chunk(parser, chunk, field_name, as_json, options)
+            else:
+                yield from _parse_chunk(parser, chunk)
+        return
+
+    workers = workers or os.cpu_count() or 1
+
+    if backend == 'thread':
+        from concurrent.futures import ThreadPoolExecutor
+
+        if compose:
+            fn = lambda chunk: _compose_chunk(parser, chunk, field_name, as_json, options)
+        else:
+            fn = lambda chunk: _parse_chunk(parser, chunk)
+
+        executor = ThreadPoolExecutor(workers)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        from functools import partial
+
+        if compose:
+            fn = partial(_worker_compose_chunk, field_name=field_name, as_json=as_json, options=options)
+        else:
+            fn = _worker_parse_chunk
+
+        executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(parser,))
+
+    with executor:
+        for results in _ordered_map(executor, fn, chunks, workers * 2):
+            yield from results
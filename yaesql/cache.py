@@ -0,0 +1,261 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+
+#----------------------------------------------------------------------#
+# KEYS                                                                 #
+#----------------------------------------------------------------------#
+
+#
+# Quoted strings are kept as they are, runs of white spaces outside them
+# are not significant for the grammar.
+#
+_NORMALIZE = re.compile(r'''("(?:\\.|[^"\n\r\\])*"|'(?:\\.|[^'\n\r\\])*')|[ \r\n]+''')
+
+def _normalize_sub(m):
+    return m.group(1) or ' '
+
+_STRAY_QUOTE = re.compile(r'''"(?:\\.|[^"\n\r\\])*"|'(?:\\.|[^'\n\r\\])*'|(["'])''')
+
+def normalize_query(s):
+    """
+    Return the cache key of a query string: strings that only differ for
+    white spaces outside quoted values have the same key. A string with
+    an unterminated quote is its own key (white spaces after the quote 
+    could be anywhere in a value).
+    """
+    if '\t' in s:
+        # pyparsing expands tabs everywhere before parsing
+        s = s.expandtabs()
+    if ('"' in s or "'" in s) and any([ m.group(1) for m in _STRAY_QUOTE.finditer(s) ]):
+        return s
+    return _NORMALIZE.sub(_normalize_sub, s).strip()
+
+#----------------------------------------------------------------------#
+# LRU CACHE                                                            #
+#----------------------------------------------------------------------#
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses evictions expirations currsize maxsize')
+
+class ParseCache(object):
+    """
+    Thread safe, size bounded LRU cache with an optional time to live
+    (in seconds) for the entries.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        if maxsize <= 0:
+            raise ValueError("Cache size must be positive: %r" % (maxsize,))
+
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.timer   = timer
+
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires = entry
+            if expires is not None and expires <= self.timer():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = self.timer() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits        = 0
+            self.misses      = 0
+            self.evictions   = 0
+            self.expirations = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.expirations, len(self._data), self.maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __reduce__(self):
+        # a copy (e.g. sent to a worker process) starts empty
+        return (ParseCache, (self.maxsize, self.ttl, self.timer))
+
+#----------------------------------------------------------------------#
+# DISK CACHE                                                           #
+#----------------------------------------------------------------------#
+#
+# Parsed trees shared by the processes using the same cache directory.
+# The trees of a grammar version (see yaesql.serialize) are appended to
+# the log file of that version, one line per tree:
+#
+#   <key hash> <serialized tree>\n
+#
+# Every line is written by a single write() (more on a short write) on a
+# file opened in append mode: processes appending at the same time never
+# overwrite each other, and readers only take complete lines, skipping
+# the ones they can not load. A process reads the log once, then only the lines appended since
+# its last read when it misses a key. A change of the grammar changes the
+# version, and so the log: the old trees are never loaded again.
+#
+
+DiskCacheInfo = collections.namedtuple('DiskCacheInfo', 'hits misses writes currsize')
+
+class DiskCache(object):
+    """
+    Persistent cache of parsed trees in the directory `directory`, safe
+    to share between threads and processes. Keys are hashed with `salt`
+    (the options of the parser building the trees).
+    """
+
+    def __init__(self, directory, salt='', version=None):
+        if version is None:
+            from .serialize import grammar_version
+            version = grammar_version()
+
+        self.directory = directory
+        self.salt      = salt
+        self.version   = version
+
+        self.path = os.path.join(directory, 'queries-%s.log' % (version,))
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._entries = {}
+        self._offset  = 0
+        self._lock    = threading.Lock()
+
+        self.hits   = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _hash(self, key):
+        return hashlib.blake2b((self.salt + '\0' + key).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _refresh(self):
+        """
+        Read the lines appended to the log since the last read
+        """
+        try:
+            with open(self.path, 'rb') as fp:
+                fp.seek(self._offset)
+                data = fp.read()
+        except FileNotFoundError:
+            return
+
+        # a line still being written is read next time
+        end = data.rfind(b'\n') + 1
+
+        entries = self._entries
+        for line in data[:end].split(b'\n'):
+            h, sep, text = line.partition(b' ')
+            if sep and len(h) == 32:
+                entries[h.decode('ascii', 'replace')] = text
+
+        self._offset += end
+
+    def get(self, key):
+        from .serialize import loads
+
+        h = self._hash(key)
+
+        with self._lock:
+            text = self._entries.get(h)
+            if text is None:
+                self._refresh()
+                text = self._entries.get(h)
+            if text is None:
+                self.misses += 1
+                return None
+
+        try:
+            q = loads(text)
+        except ValueError:
+            # torn or foreign line
+            with self._lock:
+                self._entries.pop(h, None)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return q
+
+    def put(self, key, query):
+        """
+        Store `query`, return False if its nodes can not be serialized
+        """
+        from .serialize import dumps
+
+        try:
+            text = dumps(query)
+        except TypeError:
+            return False
+
+        h = self._hash(key)
+
+        data = memoryview(('%s %s\n' % (h, text)).encode('ascii'))
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            self._entries[h] = text
+            self.writes += 1
+        return True
+
+    def prune(self):
+        """
+        Remove the logs of the other grammar versions from the directory
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('queries-') and name.endswith('.log') and path != self.path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def info(self):
+        with self._lock:
+            return DiskCacheInfo(self.hits, self.misses, self.writes, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __reduce__(self):
+        # a copy (e.g. sent to a worker process) reads the log again
+        return (DiskCache, (self.directory, self.salt, self.version))
@@ -0,0 +1,181 @@
+import argparse
+import collections
+import json
+import sys
+
+from . import Parser, prettywrite
+
+#----------------------------------------------------------------------#
+# COMMAND LINE                                                         #
+#----------------------------------------------------------------------#
+#
+#   python -m yaesql <index> <default field> <query>
+#
+#       print the parsed query and its DSL
+#
+#   python -m yaesql --msearch <index> <default field> [ <file> ]
+#
+#       read one query per line (or one JSON record per line with
+#       --json-input) from <file> or stdin and write the _msearch NDJSON
+#       body (header line + query line) to stdout
+#
+
+FLUSH_SIZE = 1 << 20
+
+def _create_argparser():
+    ap = argparse.ArgumentParser(prog="python -m yaesql", description="Yet Another ElasticSearch Query Language")
+
+    ap.add_argument("index"        , help="index name ('-' for no index in _msearch headers)")
+    ap.add_argument("default_field", help="default field")
+    ap.add_argument("query"        , nargs='?', help="query string, or the input file with --msearch (default: stdin)")
+
+    ap.add_argument("--engine"     , choices=Parser.ENGINES, default='fast', help="parser engine (default: fast)")
+    ap.add_argument("--date-format", help="format of the dates in range queries")
+    ap.add_argument("--time-zone"  , help="time zone of the dates in range queries")
+    ap.add_argument("--mapping"    , help="index mapping JSON file: queries are chosen for the field types")
+    ap.add_argument("--cache-dir"  , help="directory of the parsed queries shared between runs")
+
+    ap.add_argument("--msearch"    , action='store_true', help="stream queries to _msearch NDJSON")
+    ap.add_argument("--json-input" , action='store_true', help='input lines are JSON records: {"query": ..., "index": ...}')
+    ap.add_argument("--workers"    , type=int, default=0, help="compose with a pool of worker processes")
+    ap.add_argument("--chunksize"  , type=int, default=256, help="queries sent to a worker at once")
+    ap.add_argument("-o", "--output", help="output file (default: stdout)")
+
+    return ap
+
+def _compose_options(args):
+    if not args.mapping:
+        return {}
+    from .mapping import load_mapping
+    return { 'mapping': load_mapping(args.mapping) }
+
+def _header(index):
+    if not index or index == '-':
+        return b'{}\n'
+    return json.dumps({ 'index': index }).encode('utf-8') + b'\n'
+
+def _read_queries(lines, args, pending):
+    """
+    Yield the query strings of the input lines, appending to `pending` the
+    (line number, header, error) of every query yielded
+    """
+    default_header = _header(args.index)
+
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+
+        if not args.json_input:
+            pending.append( (lineno, default_header, None) )
+            yield line
+            continue
+
+        try:
+            record = json.loads(line)
+            query  = record['query']
+            header = _header(record['index']) if 'index' in record else default_header
+        except (ValueError, TypeError, KeyError) as e:
+            pending.append( (lineno, None, e) )
+            yield ''
+            continue
+
+        pending.append( (lineno, header, None) )
+        yield query
+
+def msearch(parser, lines, out, err, args):
+    """
+    Write the _msearch body for the queries in `lines` to the binary stream
+    `out`. Return the number of failed lines, reported on `err`.
+    """
+    pending = collections.deque()
+
+    queries = _read_queries(lines, args, pending)
+
+    options = _compose_options(args)
+
+    if args.workers:
+        results = parser.compose_many(queries, args.default_field, as_json=True, backend='process', workers=args.workers, chunksize=args.chunksize, **options)
+    else:
+        results = parser.compose_many(queries, args.default_field, as_json=True, chunksize=args.chunksize, **options)
+
+    failures = 0
+    buf = bytearray()
+
+    for r in results:
+        lineno, header, error = pending.popleft()
+
+        if error is None and isinstance(r, Exception):
+            error = r
+
+        if error is not None:
+            failures += 1
+            err.write("line %d: %s: %s\n" % (lineno, type(error).__name__, error))
+            continue
+
+        buf += header
+        buf += r
+        buf += b'\n'
+
+        if len(buf) >= FLUSH_SIZE:
+            out.write(buf)
+            buf.clear()
+
+    out.write(buf)
+    out.flush()
+
+    return failures
+
+def show(parser, args, out):
+    string_query = args.query
+
+    print(string_query, file=out)
+
+    query_generator = parser.parseString(string_query)
+
+    print(query_generator.dump(), file=out)
+
+    es_dsl_query = query_generator.compose(args.default_field, **_compose_options(args))
+
+    print("-----JSON STRING---", file=out)
+    print( repr(json.dumps(es_dsl_query)), file=out )
+
+    print("----- ES DSL -----", file=out)
+    prettywrite(es_dsl_query, out)
+    print(file=out)
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    stdin  = stdin  or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    ap = _create_argparser()
+    args = ap.parse_args(argv)
+
+    parser = Parser(engine=args.engine, date_format=args.date_format, time_zone=args.time_zone, cache_dir=args.cache_dir)
+
+    if not args.msearch:
+        if args.query is None:
+            ap.error("the query string is required")
+        show(parser, args, stdout)
+        return 0
+
+    if args.query and args.query != '-':
+        lines = open(args.query, encoding='utf-8')
+    else:
+        lines = stdin
+
+    if args.output:
+        out = open(args.output, 'wb')
+    else:
+        out = stdout.buffer
+
+    try:
+        failures = msearch(parser, lines, out, stderr, args)
+    finally:
+        if lines is not stdin:
+            lines.close()
+        if args.output:
+            out.close()
+
+    return 1 if failures else 0
@@ -0,0 +1,439 @@
+import collections
+import operator
+import re
+
+from . import (
+    Query, SimpleTerm, ComplexTerm, CompareValue, MultiValue, BoolMust, BoolMustNot, NotExpr, AndExpr, OrExpr,
+    Literal, RegExLiteral, DateLiteral, Placeholder,
+)
+
+from .mapping import _as_number
+
+#----------------------------------------------------------------------#
+# LOCAL EVALUATION                                                     #
+#----------------------------------------------------------------------#
+#
+# Runs a parsed query against in-memory documents, matching the same
+# documents as the DSL composed by Query.compose() on keyword fields, 
+# except for ranges with a number bound: they assume a numeric mapping
+# (f:>10 does not match "9", that a keyword field compares as a string
+# with "10"):
+#
+#   term        equal values (exact, case sensitive); a number and its
+#               string form are equal: 200 matches "200" and the other
+#               way round
+#   prefix, wildcard, regexp
+#               string values (regular expressions in the Lucene syntax
+#               of Elasticsearch, anchored at both ends)
+#   range       numbers (and numeric strings) with a number bound,
+#               strings with a string bound: ISO 8601 dates compare as
+#               strings. Date math can not be evaluated locally (a term
+#               query on it matches the string itself)
+#
+# A field of a document is missing, None or a value; a list or a tuple
+# is a multi-valued field, matching if any of its values does.
+#
+# Batches are columnar: a dict of field name -> sequence of the values
+# of the rows (lists, tuples or NumPy arrays). Each column is indexed
+# once per batch into { value: rows }, so a leaf query costs a dict
+# lookup (term) or a test of every distinct value of its column (the
+# others) instead of a test per row, and the boolean logic runs on
+# bitsets: Python ints with one bit per row.
+#
+
+_TERM, _TEST, _BOOL = range(3)
+
+_OPS = {
+    '<' : operator.lt,
+    '<=': operator.le,
+    '>' : operator.gt,
+    '>=': operator.ge,
+}
+
+#
+# Lucene operators without a Python equivalent (see yaesql.regex)
+#
+_UNSUPPORTED = frozenset('&~<>')
+
+#
+# Escaped character classes (Elasticsearch 7.9+), ASCII only like the
+# Python ones with re.ASCII
+#
+_CLASSES = frozenset('dswDSW')
+
+def _lucene_regex(pattern):
+    """
+    Translate a Lucene regular expression into a Python one
+    """
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n:
+            if pattern[i+1] in _CLASSES:
+                out.append(pattern[i:i+2])
+            else:
+                out.append(re.escape(pattern[i+1]))
+            i += 2
+            continue
+        if c == '"':
+            j = pattern.find('"', i+1)
+            if j < 0:
+                raise ValueError("Unterminated quoted string in regular expression %r" % (pattern,))
+            out.append(re.escape(pattern[i+1:j]))
+            i = j + 1
+            continue
+        if c == '[':
+            # classes are copied up to the closing bracket
+            j = i + 1
+            if pattern.startswith('^', j):
+                j += 1
+            if pattern.startswith(']', j):
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            out.append(pattern[i:j+1])
+            i = j + 1
+            continue
+        if c == '@':
+            out.append('.*')
+        elif c == '#':
+            out.append('(?!)')
+        elif c in _UNSUPPORTED:
+            raise ValueError("Regular expression operator %r can not be evaluated locally: %r" % (c, pattern))
+        elif c == '^' or c == '$':
+            # no anchors in Lucene: ordinary characters
+            out.append('\\' + c)
+        else:
+            out.append(c)
+        i += 1
+    return re.compile(''.join(out), re.DOTALL | re.ASCII)
+
+def _wildcard_regex(pattern):
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i+1]))
+            i += 1
+        elif c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(out), re.DOTALL)
+
+def _string_test(match):
+    return lambda v: type(v) is str and match(v) is not None
+
+def _value(literal):
+    if isinstance(literal, Placeholder):
+        raise ValueError("Unbound query parameter $%s" % (literal.val,))
+    return literal.val
+
+def _keys(v):
+    """
+    The values a term query on `v` matches
+    """
+    if type(v) is str:
+        n = _as_number(v)
+        return (v,) if n is None else (v, n)
+    return (v, str(v))
+
+def _leaf(literal, field):
+    if isinstance(literal, RegExLiteral):
+        kind, value = literal.query
+        if kind == 'term':
+            return (_TERM, field, (value,))
+        if kind == 'prefix':
+            return (_TEST, field, lambda v: type(v) is str and v.startswith(value))
+        if kind == 'wildcard':
+            return (_TEST, field, _string_test(_wildcard_regex(value).fullmatch))
+        return (_TEST, field, _string_test(_lucene_regex(value).fullmatch))
+
+    return (_TERM, field, _keys(_value(literal)))
+
+def _range(op, bound, field):
+    # a term query matches date math as a string, a range query resolves it
+    if isinstance(bound, DateLiteral) and (bound.val.startswith('now') or '||' in bound.val):
+        raise ValueError("Date math can not be evaluated locally: %r" % (bound.val,))
+
+    op    = _OPS[op]
+    bound = _value(bound)
+
+    if type(bound) is str:
+        return (_TEST, field, lambda v: type(v) is str and op(v, bound))
+
+    def test(v):
+        t = type(v)
+        if t is str:
+            v = _as_number(v)
+            if v is None:
+                return False
+        elif t is not int and t is not float:
+            return False
+        return op(v, bound)
+
+    return (_TEST, field, test)
+
+def _bool(must=(), must_not=(), should=()):
+    return (_BOOL, tuple(must), tuple(must_not), tuple(should))
+
+def _clauses(exprs, field):
+    """
+    (must, must_not, should) plans of the clauses `exprs` of a Query or
+    a MultiValue
+    """
+    must     = []
+    must_not = []
+    should   = []
+    for e in exprs:
+        if isinstance(e, BoolMust):
+            must.append( _plan(e.expr, field) )
+        elif isinstance(e, BoolMustNot):
+            must_not.append( _plan(e.expr, field) )
+        else:
+            should.append( _plan(e, field) )
+    return must, must_not, should
+
+def _plan(e, field):
+    """
+    The evaluation plan of the node `e` on the default field `field`: a
+    tree of (_TERM, field, values), (_TEST, field, test) and
+    (_BOOL, must, must_not, should) tuples
+    """
+    if isinstance(e, Literal):
+        return _leaf(e, field)
+
+    if isinstance(e, SimpleTerm):
+        return _leaf(e.expr, field)
+
+    if isinstance(e, ComplexTerm):
+        return _plan(e.value_expr, e.field_expr)
+
+    if isinstance(e, CompareValue):
+        return _range(e.type, e.expr, field)
+
+    if isinstance(e, (Query, MultiValue)):
+        if isinstance(e, Query) and len(e.exprs) == 1:
+            return _plan(e.exprs[0], field)
+        must, must_not, should = _clauses(e.exprs, field)
+        if isinstance(e, Query) and not must and not must_not:
+            return _bool(must=should)
+        return _bool(must, must_not, should)
+
+    if isinstance(e, BoolMust):
+        return _plan(e.expr, field)
+
+    if isinstance(e, (BoolMustNot, NotExpr)):
+        return _bool(must_not=[ _plan(e.expr, field) ])
+
+    if isinstance(e, AndExpr):
+        return _bool(must=[ _plan(c, field) for c in e.exprs ])
+
+    if isinstance(e, OrExpr):
+        if len(e.exprs) == 1:
+            return _plan(e.exprs[0], field)
+        return _bool(should=[ _plan(c, field) for c in e.exprs ])
+
+    raise TypeError("Can not evaluate %s nodes" % (type(e).__name__,))
+
+#----------------------------------------------------------------------#
+# ROWS                                                                 #
+#----------------------------------------------------------------------#
+
+def _match(node, row):
+    op = node[0]
+
+    if op == _BOOL:
+        must, must_not, should = node[1:]
+        for c in must:
+            if not _match(c, row):
+                return False
+        for c in must_not:
+            if _match(c, row):
+                return False
+        if should and not must:
+            for c in should:
+                if _match(c, row):
+                    return True
+            return False
+        return True
+
+    v = row.get(node[1])
+    if v is None:
+        return False
+    values = v if isinstance(v, (list, tuple)) else (v,)
+
+    if op == _TERM:
+        keys = node[2]
+        for v in values:
+            if v in keys:
+                return True
+        return False
+
+    test = node[2]
+    for v in values:
+        if test(v):
+            return True
+    return False
+
+#----------------------------------------------------------------------#
+# BATCHES                                                              #
+#----------------------------------------------------------------------#
+
+#
+# bit of a row in the byte of a bitset
+#
+_BIT = [ 1 << i for i in range(8) ]
+
+class _Column(object):
+
+    def __init__(self, values, n):
+        if hasattr(values, 'tolist'):
+            # NumPy array: Python values
+            values = values.tolist()
+
+        rows = collections.defaultdict(list)
+        for i, v in enumerate(values):
+            if isinstance(v, (list, tuple)):
+                # multi-valued
+                for x in v:
+                    rows[x].append(i)
+            else:
+                rows[v].append(i)
+
+        rows.pop(None, None)
+
+        self.rows = rows
+        self.n    = n
+        self.bits = {}
+
+    def _bitset(self, lists):
+        ba = bytearray((self.n + 7) >> 3)
+        for rows in lists:
+            for i in rows:
+                ba[i >> 3] |= _BIT[i & 7]
+        return int.from_bytes(ba, 'little')
+
+    def term(self, keys):
+        bits = self.bits.get(keys)
+        if bits is None:
+            rows = self.rows
+            bits = self.bits[keys] = self._bitset([ rows[k] for k in keys if k in rows ])
+        return bits
+
+    def test(self, test):
+        return self._bitset([ rows for v, rows in self.rows.items() if test(v) ])
+
+class Batch(object):
+    """
+    A columnar batch of documents, { field: values }, indexed for the
+    evaluators: pass the same Batch to several evaluators to index its
+    columns once
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+        self.n = 0
+        for values in columns.values():
+            self.n = len(values)
+            break
+        for name, values in columns.items():
+            if len(values) != self.n:
+                raise ValueError("Column %r has %d rows, expected %d" % (name, len(values), self.n))
+
+        self.all     = (1 << self.n) - 1
+        self.indexes = {}
+
+    def column(self, field):
+        c = self.indexes.get(field)
+        if c is None:
+            values = self.columns.get(field)
+            if values is None:
+                return None
+            c = self.indexes[field] = _Column(values, self.n)
+        return c
+
+    def run(self, node):
+        op = node[0]
+
+        if op == _BOOL:
+            must, must_not, should = node[1:]
+            m = self.all
+            for c in must:
+                m &= self.run(c)
+                if not m:
+                    return 0
+            for c in must_not:
+                m &= ~self.run(c)
+                if not m:
+                    return 0
+            if should and not must:
+                s = 0
+                for c in should:
+                    s |= self.run(c)
+                m &= s
+            return m
+
+        column = self.column(node[1])
+        if column is None:
+            return 0
+        if op == _TERM:
+            return column.term(node[2])
+        return column.test(node[2])
+
+def _is_numpy(values):
+    return type(values).__module__ == 'numpy'
+
+def _batch(batch):
+    return batch if isinstance(batch, Batch) else Batch(batch)
+
+class Evaluator(object):
+    """
+    A query compiled for local evaluation on the default field
+    `field_name` (see Query.evaluator()).
+
+    `evaluate(batch)` returns the boolean mask of the rows of a columnar
+    batch (a dict or a Batch) matching the query: a NumPy array if the 
+    columns are NumPy arrays, a list otherwise. `match(row)` evaluates a
+    single document (a dict) instead.
+    """
+
+    def __init__(self, query, field_name):
+        self.query      = query
+        self.field_name = field_name
+
+        self.plan = _plan(query, field_name)
+
+    def bits(self, batch):
+        """
+        The mask of `batch` as a bitset: bit i is set if row i matches
+        """
+        return _batch(batch).run(self.plan)
+
+    def evaluate(self, batch):
+        b = _batch(batch)
+        mask = b.run(self.plan)
+
+        if any([ _is_numpy(values) for values in b.columns.values() ]):
+            import numpy
+            data = numpy.frombuffer(mask.to_bytes((b.n + 7) >> 3, 'little'), dtype=numpy.uint8)
+            return numpy.unpackbits(data, count=b.n, bitorder='little').astype(bool)
+
+        return [ c == '1' for c in reversed(format(mask, 'b').zfill(b.n)) ] if b.n else []
+
+    def count(self, batch):
+        """
+        Number of rows of `batch` matching the query
+        """
+        return bin(self.bits(batch)).count('1')
+
+    def match(self, row):
+        return _match(self.plan, row)
@@ -0,0 +1,391 @@
+import re
+
+import pyparsing as pp
+
+from . import _NUMBER_PATTERN, _DATE_PATTERN
+
+#----------------------------------------------------------------------#
+# TOKENS                                                               #
+#----------------------------------------------------------------------#
+#
+# The lexical rules mirror the pyparsing grammar in `_create_parser`.
+# They are context dependent (`field1:foo` is a single TERM in value
+# position but FIELD ':' TERM at the start of an expression), so tokens
+# are recognized on demand at the cursor by anchored regular expressions
+# instead of being split up front. Every character is scanned a bounded
+# number of times and the parser never backtracks more than one token.
+#
+
+_WS     = re.compile(r'[ \t\r\n]*')
+
+_TERM   = re.compile(r'[A-Za-z0-9][A-Za-z0-9.:\-+_/]*')
+
+_FIELD  = re.compile(r'[A-Za-z][A-Za-z0-9.]*')
+
+_PARAM  = re.compile(r'\$([A-Za-z_][A-Za-z0-9_]*)')
+
+_NUMBER = re.compile(_NUMBER_PATTERN)
+
+_DATE   = re.compile(_DATE_PATTERN)
+
+_SIGNED = re.compile(r'[+-]' + _NUMBER_PATTERN)
+
+_QUOTED = re.compile(r'"(?:\\.|[^"\n\r\\])*"' r"|'(?:\\.|[^'\n\r\\])*'")
+
+#
+# ~(TOKENS): a value can not start with one of these
+#
+_TOKENS = (':', '(', ')', 'NOT', 'AND', 'OR', '+', '-')
+
+_COMPARE = ('<=', '<', '>=', '>')
+
+#
+# Escape sequences are rare: they are delegated to the same
+# QuotedString elements used by the grammar so both engines agree on
+# their meaning whatever the pyparsing version.
+#
+_UNQUOTE = {
+    '"': pp.QuotedString('"', escChar='\\'),
+    "'": pp.QuotedString("'", escChar='\\'),
+}
+
+#
+# Binary operators ordered by increasing precedence
+#
+_BINARY = (
+    ('OR' , 'create_OrExpr' ),
+    ('AND', 'create_AndExpr'),
+)
+
+def _unquote(tok):
+    val = tok[1:-1]
+    if '\\' in val:
+        val = _UNQUOTE[tok[0]].parseString(tok)[0]
+    return val
+
+#----------------------------------------------------------------------#
+
+class _Parse(object):
+
+    def __init__(self, factory, s):
+        self.factory = factory
+        self.s       = s
+        self.n       = len(s)
+        self.err     = 0
+
+    def fail(self, pos):
+        if pos > self.err:
+            self.err = pos
+        return None
+
+    #--------------------------------------------------------------#
+    # VALUES                                                       #
+    #--------------------------------------------------------------#
+
+    def basic_value(self, pos):
+        s = self.s
+        pos = _WS.match(s, pos).end()
+
+        if s.startswith(_TOKENS, pos):
+            return self.fail(pos)
+
+        c = s[pos:pos+1]
+
+        if c == 'r':
+            m = _QUOTED.match(s, pos+1)
+            if m:
+                node = self.factory.create_RegExLiteral(s, pos, [ _unquote(m.group()) ])
+                return node, m.end()
+
+        if c == '"' or c == "'":
+            m = _QUOTED.match(s, pos)
+            if m:
+                node = self.factory.create_StringLiteral(s, pos, [ _unquote(m.group()) ])
+                return node, m.end()
+            return self.fail(pos)
+
+        if c == '$':
+            m = _PARAM.match(s, pos)
+            if m:
+                node = self.factory.create_Placeholder(s, pos, [ m.group(1) ])
+                return node, m.end()
+            return self.fail(pos)
+
+        if '0' <= c <= '9' or c == 'n':
+            m = _DATE.match(s, pos)
+            if m:
+                node = self.factory.create_DateLiteral(s, pos, [ m.group() ])
+                return node, m.end()
+
+            m = _NUMBER.match(s, pos)
+            if m:
+                node = self.factory.create_NumberLiteral(s, pos, [ m.group() ])
+                return node, m.end()
+
+        m = _TERM.match(s, pos)
+        if m:
+            node = self.factory.create_StringLiteral(s, pos, [ m.group() ])
+            return node, m.end()
+
+        return self.fail(pos)
+
+    def simple_term(self, pos):
+        r = self.basic_value(pos)
+        if r is None:
+            return None
+        node, end = r
+        return self.factory.create_SimpleTerm(self.s, pos, [ node ]), end
+
+    def multi_term_expr(self, pos):
+        s = self.s
+        pos = _WS.match(s, pos).end()
+
+        c = s[pos:pos+1]
+        if c == '+' or c == '-':
+            r = self.basic_value(pos+1)
+            if r is not None:
+                node, end = r
+                if c == '+':
+                    return self.factory.create_BoolMust(s, pos, [ node ]), end
+                return self.factory.create_BoolMustNot(s, pos, [ node ]), end
+
+        return self.basic_value(pos)
+
+    def multi_term_sequence(self, pos):
+        s = self.s
+        pos = _WS.match(s, pos).end()
+
+        if not s.startswith('(', pos):
+            return self.fail(pos)
+
+        start = _WS.match(s, pos+1).end()
+
+        toks = []
+        end  = pos+1
+        while True:
+            r = self.multi_term_expr(end)
+            if r is None:
+                break
+            node, end = r
+            toks.append(node)
+
+        if not toks:
+            return None
+
+        node = self.factory.create_MultiValue(s, start, toks)
+
+        end = _WS.match(s, end).end()
+        if not s.startswith(')', end):
+            return self.fail(end)
+
+        return node, end+1
+
+    def compare_term(self, pos):
+        s = self.s
+        pos = _WS.match(s, pos).end()
+
+        for op in _COMPARE:
+            if s.startswith(op, pos):
+                break
+        else:
+            return self.fail(pos)
+
+        start = _WS.match(s, pos+len(op)).end()
+        m = _SIGNED.match(s, start)
+        if m:
+            node = self.factory.create_NumberLiteral(s, start, [ m.group() ])
+            return self.factory.create_CompareValue(s, pos, [ op, node ]), m.end()
+
+        r = self.basic_value(start)
+        if r is None:
+            return None
+        node, end = r
+
+        return self.factory.create_CompareValue(s, pos, [ op, node ]), end
+
+    def complex_term(self, pos):
+        s = self.s
+        pos = _WS.match(s, pos).end()
+
+        m = _FIELD.match(s, pos)
+        if not m:
+            return self.fail(pos)
+
+        sep = _WS.match(s, m.end()).end()
+        if not s.startswith((':', '='), sep):
+            return self.fail(sep)
+
+        r = (
+              self.simple_term(sep+1)
+              or
+              self.multi_term_sequence(sep+1)
+              or
+              self.compare_term(sep+1)
+            )
+        if r is None:
+            return None
+        value, end = r
+
+        return self.factory.create_ComplexTerm(s, pos, [ m.group(), value ]), end
+
+    #--------------------------------------------------------------#
+    # EXPRESSIONS                                                  #
+    #--------------------------------------------------------------#
+    #
+    #   query  := binary+
+    #   binary := the operators of _BINARY by increasing precedence
+    #   unary  := ( 'NOT' | '+' | '-' ) base | base
+    #   base   := complex_term | simple_term | '(' query ')'
+    #
+    # A group in parentheses is a query again: the groups being parsed are
+    # kept on an explicit stack instead of the interpreter one, so their
+    # nesting is not bounded by the recursion limit. In a group `toks[i]`
+    # and `starts[i]` are the operands and the start of the expression
+    # open at level i of _BINARY, `pending` the level of the operator just
+    # read (-1 before a new clause of the query).
+    #
+
+    def query(self, pos):
+        s       = self.s
+        factory = self.factory
+        levels  = len(_BINARY)
+
+        stack   = []
+
+        qstart  = _WS.match(s, pos).end()
+        qtoks   = []
+        toks    = [ None ] * levels
+        starts  = [ None ] * levels
+        end     = pos
+        pending = -1
+
+        while True:
+            #
+            # The unary expression at `pos`
+            #
+            upos = _WS.match(s, pos).end()
+
+            c = s[upos:upos+1]
+            if c == '+':
+                action, vpos = 'create_BoolMust', upos+1
+            elif c == '-':
+                action, vpos = 'create_BoolMustNot', upos+1
+            elif c == 'N' and s.startswith('NOT', upos):
+                action, vpos = 'create_NotExpr', upos+3
+            else:
+                action, vpos = None, upos
+
+            r = self.complex_term(vpos) or self.simple_term(vpos)
+            if r is None:
+                b = _WS.match(s, vpos).end()
+                if s.startswith('(', b):
+                    stack.append( (qstart, qtoks, toks, starts, end, pending, action, upos) )
+                    qstart  = _WS.match(s, b+1).end()
+                    qtoks   = []
+                    toks    = [ None ] * levels
+                    starts  = [ None ] * levels
+                    end     = pos = b+1
+                    pending = -1
+                    continue
+                self.fail(b)
+
+            while True:
+                if r is not None and action is not None:
+                    node, e = r
+                    r = getattr(factory, action)(s, upos, [ node ]), e
+                elif r is None and action is not None:
+                    # the operator is not one: `NOT:foo`
+                    r = self.complex_term(upos) or self.simple_term(upos) or self.fail(upos)
+
+                if r is not None:
+                    node, end = r
+                    for i in range(pending+1, levels):
+                        toks[i]   = []
+                        starts[i] = upos
+                    toks[-1].append(node)
+                    i = levels - 1
+
+                elif pending >= 0:
+                    # no operand after the operator: the expression ends before it
+                    i = pending
+
+                else:
+                    #
+                    # End of the query: back to the group it is in
+                    #
+                    q = None
+                    if qtoks:
+                        q = factory.create_Query(s, qstart, qtoks), end
+                    if not stack:
+                        return q
+
+                    qstart, qtoks, toks, starts, end, pending, action, upos = stack.pop()
+
+                    r = None
+                    if q is not None:
+                        node, e = q
+                        e = _WS.match(s, e).end()
+                        if s.startswith(')', e):
+                            r = node, e+1
+                        else:
+                            self.fail(e)
+                    continue
+
+                #
+                # Close the expressions from level `i` down until one of
+                # them goes on with its operator (without an operand, `r`
+                # is None, the one at level `i` is closed as it is)
+                #
+                while i >= 0:
+                    keyword, method = _BINARY[i]
+                    if r is not None:
+                        p = _WS.match(s, end).end()
+                        if s.startswith(keyword, p):
+                            break
+                    node = getattr(factory, method)(s, starts[i], toks[i])
+                    if i:
+                        toks[i-1].append(node)
+                    else:
+                        qtoks.append(node)
+                    r = node
+                    i -= 1
+
+                if i >= 0:
+                    pending = i
+                    pos     = p + len(keyword)
+                else:
+                    pending = -1
+                    pos     = end
+                break
+
+    def parse(self):
+        r = self.query(0)
+        if r is not None:
+            node, end = r
+            end = _WS.match(self.s, end).end()
+            if end == self.n:
+                return node
+            self.fail(end)
+
+        raise pp.ParseException(self.s, self.err, "Invalid query syntax")
+
+#----------------------------------------------------------------------#
+
+class FastParser(object):
+    """
+    Single pass recursive-descent engine (the groups in parentheses are
+    parsed on an explicit stack).
+
+    It accepts the same language as the pyparsing grammar and builds the
+    AST through the same `create_*` factory methods, so both engines
+    return identical trees.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def parseString(self, s):
+        #
+        # pyparsing expands tabs before matching (even inside quotes)
+        #
+        return [ _Parse(self.factory, s.expandtabs()).parse() ]
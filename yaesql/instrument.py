@@ -0,0 +1,251 @@
+import heapq
+import threading
+import time
+
+#----------------------------------------------------------------------#
+# INSTRUMENTATION                                                      #
+#----------------------------------------------------------------------#
+#
+# A Parser created with `instrument=callback` calls `callback(event)`
+# after every parseString() and Parser.compose() call. An event is a dict:
+#
+#   parse events
+#
+#       phase            'parse'
+#       engine           parser engine
+#       query            the query string
+#       length           its length
+#       seconds          time spent in parseString()
+#       actions_seconds  time spent in the create_* factory methods
+#       match_seconds    the rest: matching the grammar
+#       nodes            {AST class name: count} of the nodes created
+#                        (pyparsing also counts the ones discarded when it
+#                        backtracks)
+#       cache            'hit', 'miss' or None without a cache
+#       error            exception class name or None
+#
+#   compose events
+#
+#       phase            'compose'
+#       field            the default field
+#       seconds          total time
+#       compose_seconds  time spent composing the DSL (and applying the
+#                        mapping)
+#       optimize_seconds time spent in the optimizer/filter context passes
+#       options          the compose options
+#       error            exception class name or None
+#
+# Nothing of this runs without `instrument`: the engines of the parser
+# call its create_* methods directly.
+#
+
+_clock = time.perf_counter
+
+class InstrumentedFactory(object):
+    """
+    Stands for a Parser as the factory of its parser engine: its create_*
+    methods are timed and the created nodes counted, for the parse running
+    on the current thread.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.local  = threading.local()
+
+    def __getattr__(self, name):
+        create = getattr(self.parser, name)
+        if not name.startswith('create_'):
+            return create
+
+        local = self.local
+
+        def action(s, loc, toks):
+            t = _clock()
+            node = create(s, loc, toks)
+            stats = getattr(local, 'stats', None)
+            if stats is not None:
+                stats[0] += _clock() - t
+                # create_AndExpr/create_OrExpr pass single operands through
+                if not (len(toks) == 1 and node is toks[0]):
+                    nodes = stats[1]
+                    n = type(node).__name__
+                    nodes[n] = nodes.get(n, 0) + 1
+            return node
+
+        # resolved once per name
+        setattr(self, name, action)
+        return action
+
+    def begin(self):
+        self.local.stats = [ 0.0, {} ]
+
+    def end(self):
+        stats = self.local.stats
+        self.local.stats = None
+        return stats
+
+    def __reduce__(self):
+        return (InstrumentedFactory, (self.parser,))
+
+def parse(parser, s):
+    """
+    parser.parseString(s) reporting a parse event to the instrument of
+    `parser`
+    """
+    engine  = parser.parser
+    factory = engine.factory
+    cache   = parser.cache
+
+    cached = None
+    error  = None
+    factory.begin()
+    t = _clock()
+    try:
+        if cache is None and parser.disk_cache is None and parser.nodes is None:
+            return engine.parseString(s)[0]
+
+        from .cache import normalize_query
+
+        key = normalize_query(s)
+
+        if cache is None:
+            return parser._parse_key(s, key)
+
+        q = cache.get(key)
+        if q is None:
+            cached = 'miss'
+            q = parser._parse_key(s, key)
+            cache.put(key, q)
+        else:
+            cached = 'hit'
+        return q
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = _clock() - t
+        actions, nodes = factory.end()
+
+        parser.instrument({
+            'phase'          : 'parse',
+            'engine'         : parser.engine,
+            'query'          : s,
+            'length'         : len(s),
+            'seconds'        : seconds,
+            'actions_seconds': actions,
+            'match_seconds'  : seconds - actions,
+            'nodes'          : nodes,
+            'cache'          : cached,
+            'error'          : error,
+        })
+
+def compose(parser, query, field_name, optimize=False, mode='query', mapping=None):
+    """
+    Query.compose() reporting a compose event to the instrument of
+    `parser`
+    """
+    from .optimizer import optimize as optimize_dsl, set_context
+
+    error = None
+    t0 = _clock()
+    t1 = None
+    try:
+        q = query.compose(field_name, mapping=mapping)
+        t1 = _clock()
+        if optimize:
+            q = optimize_dsl(q)
+        if mode != 'query':
+            q = set_context(q, mode, field_name)
+        return q
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        t2 = _clock()
+        if t1 is None:
+            t1 = t2
+
+        parser.instrument({
+            'phase'           : 'compose',
+            'field'           : field_name,
+            'seconds'         : t2 - t0,
+            'compose_seconds' : t1 - t0,
+            'optimize_seconds': t2 - t1,
+            'options'         : { 'optimize': optimize, 'mode': mode, 'mapping': mapping is not None },
+            'error'           : error,
+        })
+
+#----------------------------------------------------------------------#
+# METRICS REGISTRY                                                     #
+#----------------------------------------------------------------------#
+
+class Metrics(object):
+    """
+    Simple in-process registry of instrumentation events: pass it as the
+    `instrument` of a Parser. Thread safe.
+
+    It keeps per-phase counters and timings, the created nodes per AST
+    class, the cache hits/misses and the `keep` slowest queries.
+    """
+
+    def __init__(self, keep=10):
+        self.keep  = keep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phases  = {}
+            self.nodes   = {}
+            self.cache   = { 'hit': 0, 'miss': 0 }
+            self.slowest = []
+
+    def __call__(self, event):
+        phase   = event['phase']
+        seconds = event['seconds']
+
+        with self._lock:
+            p = self.phases.get(phase)
+            if p is None:
+                p = self.phases[phase] = { 'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0 }
+
+            p['count']   += 1
+            p['seconds'] += seconds
+            if seconds > p['max_seconds']:
+                p['max_seconds'] = seconds
+            if event['error'] is not None:
+                p['errors'] += 1
+
+            for key in ('actions_seconds', 'match_seconds', 'compose_seconds', 'optimize_seconds'):
+                if key in event:
+                    p[key] = p.get(key, 0.0) + event[key]
+
+            if phase == 'parse':
+                p['length'] = p.get('length', 0) + event['length']
+                for name, n in event['nodes'].items():
+                    self.nodes[name] = self.nodes.get(name, 0) + n
+                if event['cache'] is not None:
+                    self.cache[event['cache']] += 1
+
+                if self.keep:
+                    item = (seconds, event['query'])
+                    if len(self.slowest) < self.keep:
+                        heapq.heappush(self.slowest, item)
+                    elif item > self.slowest[0]:
+                        heapq.heapreplace(self.slowest, item)
+
+    def __reduce__(self):
+        # a copy (e.g. sent to a worker process) starts empty
+        return (Metrics, (self.keep,))
+
+    def snapshot(self):
+        """
+        Return a copy of the collected metrics
+        """
+        with self._lock:
+            return {
+                'phases' : dict([ (k, dict(v)) for k, v in self.phases.items() ]),
+                'nodes'  : dict(self.nodes),
+                'cache'  : dict(self.cache),
+                'slowest': sorted(self.slowest, reverse=True),
+            }
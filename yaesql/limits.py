@@ -0,0 +1,121 @@
+import re
+import threading
+import time
+
+#----------------------------------------------------------------------#
+# INPUT LIMITS                                                         #
+#----------------------------------------------------------------------#
+#
+# Hard limits on the query strings accepted by a Parser, checked before
+# parsing with a single linear scan of the input:
+#
+#   max_length  characters
+#   max_depth   nesting depth of the parentheses
+#   max_tokens  tokens (values, quoted strings, operators, parentheses)
+#
+# and a wall-clock budget for the parse (`timeout`, in seconds) checked
+# every time a node is created.
+#
+
+_clock = time.monotonic
+
+#
+# Quoted strings (even unterminated ones) are single tokens: the
+# parentheses in them do not count
+#
+_TOKEN = re.compile(r'''"(?:\\.|[^"\\])*"?|'(?:\\.|[^'\\])*'?|[A-Za-z0-9][A-Za-z0-9.:\-+_/|]*|\$[A-Za-z_][A-Za-z0-9_]*|<=|>=|\S''')
+
+class QueryLimitError(ValueError):
+    """
+    Raised for a query string over one of the limits of the Parser
+    """
+
+    def __init__(self, limit, value, maximum, message=None):
+        super().__init__(message or "Query exceeds %s: %s > %s" % (limit, value, maximum))
+        self.limit   = limit
+        self.value   = value
+        self.maximum = maximum
+
+    def __reduce__(self):
+        # sent back by the workers of a process pool
+        return (type(self), (self.limit, self.value, self.maximum, str(self)))
+
+def scan(s):
+    """
+    Return (tokens, nesting depth) of the query string `s`
+    """
+    tokens = 0
+    depth  = 0
+    level  = 0
+    for tok in _TOKEN.findall(s):
+        tokens += 1
+        if tok == '(':
+            level += 1
+            if level > depth:
+                depth = level
+        elif tok == ')' and level:
+            level -= 1
+    return tokens, depth
+
+class Limits(object):
+
+    def __init__(self, max_length=None, max_depth=None, max_tokens=None, timeout=None):
+        self.max_length = max_length
+        self.max_depth  = max_depth
+        self.max_tokens = max_tokens
+        self.timeout    = timeout
+
+        self.local = threading.local()
+
+    def check(self, s):
+        """
+        Raise QueryLimitError if `s` is over the limits, start the clock of
+        its parse otherwise
+        """
+        if self.max_length is not None and len(s) > self.max_length:
+            raise QueryLimitError('max_length', len(s), self.max_length)
+
+        if self.max_depth is not None or self.max_tokens is not None:
+            tokens, depth = scan(s)
+            if self.max_depth is not None and depth > self.max_depth:
+                raise QueryLimitError('max_depth', depth, self.max_depth)
+            if self.max_tokens is not None and tokens > self.max_tokens:
+                raise QueryLimitError('max_tokens', tokens, self.max_tokens)
+
+        if self.timeout is not None:
+            self.local.start = _clock()
+
+    def __reduce__(self):
+        return (Limits, (self.max_length, self.max_depth, self.max_tokens, self.timeout))
+
+class DeadlineFactory(object):
+    """
+    Stands for the factory of a parser engine, raising QueryLimitError
+    from its create_* methods once the parse is over the timeout of
+    `limits`
+    """
+
+    def __init__(self, factory, limits):
+        self.factory = factory
+        self.limits  = limits
+
+    def __getattr__(self, name):
+        create = getattr(self.factory, name)
+        if not name.startswith('create_'):
+            return create
+
+        local   = self.limits.local
+        timeout = self.limits.timeout
+
+        def action(s, loc, toks):
+            elapsed = _clock() - local.start
+            if elapsed > timeout:
+                raise QueryLimitError('timeout', elapsed, timeout, "Query exceeds timeout: parsing for more than %gs" % (timeout,))
+            return create(s, loc, toks)
+
+        # resolved once per name
+        setattr(self, name, action)
+        return action
+
+    def __reduce__(self):
+        return (DeadlineFactory, (self.factory, self.limits))
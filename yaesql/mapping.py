@@ -0,0 +1,203 @@
+import json
+import math
+import re
+
+#----------------------------------------------------------------------#
+# INDEX MAPPING                                                        #
+#----------------------------------------------------------------------#
+#
+# Rewrites the leaf queries of a composed DSL object for the types of
+# their fields in an index mapping:
+#
+#   text               term      -> match (match_phrase for values with
+#                                   white spaces)
+#                      prefix, wildcard, regexp, range
+#                                -> on the keyword sub-field, if any
+#
+#   numeric            term, range
+#                                -> string values become numbers
+#
+#   numeric, date,     prefix, wildcard, regexp
+#   boolean                      -> match_none
+#
+# A term or range with a string value that is not a number can not
+# match a numeric field either: it becomes match_none. Fields missing
+# from the mapping (and the other types) are left as they are.
+#
+# The mapping is flattened once into a dict of the field paths (object
+# and multi-fields included, aliases resolved), so the rewrite is a
+# dict lookup per leaf query.
+#
+
+TEXT_TYPES    = ('text', 'match_only_text', 'search_as_you_type')
+
+NUMERIC_TYPES = ('long', 'integer', 'short', 'byte', 'double', 'float', 'half_float', 'scaled_float', 'unsigned_long')
+
+DATE_TYPES    = ('date', 'date_nanos')
+
+_TEXT, _NUMERIC, _NOT_PATTERN, _OTHER = range(4)
+
+_PATTERNS = ('prefix', 'wildcard', 'regexp')
+
+_NUMBER = re.compile(r'[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+
+def _kind(field_type):
+    if field_type in TEXT_TYPES:
+        return _TEXT
+    if field_type in NUMERIC_TYPES:
+        return _NUMERIC
+    if field_type in DATE_TYPES or field_type == 'boolean':
+        return _NOT_PATTERN
+    return _OTHER
+
+def _properties(mapping):
+    """
+    The root `properties` of a mapping: the body of a GET <index>/_mapping
+    response, of an index creation request or the `mappings` object
+    itself
+    """
+    m = mapping
+    while isinstance(m, dict):
+        if 'properties' in m:
+            return m['properties']
+        if 'mappings' in m:
+            m = m['mappings']
+        elif len(m) == 1:
+            # index name or (before Elasticsearch 7) mapping type
+            (m,) = m.values()
+        else:
+            break
+    raise ValueError("Not an index mapping: no properties found")
+
+def _as_number(v):
+    """
+    The number in the string `v`, None if there is none
+    """
+    if _NUMBER.fullmatch(v) is None:
+        return None
+    if '.' in v or 'e' in v or 'E' in v:
+        n = float(v)
+        return n if math.isfinite(n) else None
+    return int(v)
+
+class Mapping(object):
+    """
+    The field types of an index mapping (a dict, see load_mapping()), for
+    `compose(field_name, mapping=...)`.
+
+    `fields` maps the path of every field to its (type, keyword sub-field
+    path or None).
+    """
+
+    def __init__(self, mapping):
+        self.fields = {}
+
+        aliases = []
+        self._add(_properties(mapping), '', aliases)
+
+        for path, target in aliases:
+            if target in self.fields:
+                self.fields[path] = self.fields[target]
+
+        self._kinds = dict([ (path, (_kind(t), keyword)) for path, (t, keyword) in self.fields.items() ])
+
+    def _add(self, properties, prefix, aliases):
+        for name, spec in properties.items():
+            path = prefix + name
+            field_type = spec.get('type', 'object')
+
+            if field_type == 'alias':
+                aliases.append( (path, spec.get('path')) )
+                continue
+
+            if 'properties' in spec:
+                self._add(spec['properties'], path + '.', aliases)
+                continue
+
+            keyword = None
+            for sub, sub_spec in spec.get('fields', {}).items():
+                sub_type = sub_spec.get('type')
+                self.fields[path + '.' + sub] = (sub_type, None)
+                if sub_type == 'keyword' and (keyword is None or sub == 'keyword'):
+                    keyword = path + '.' + sub
+
+            self.fields[path] = (field_type, keyword)
+
+    def field_type(self, path):
+        """
+        Type of the field `path`, None if it is not mapped
+        """
+        info = self.fields.get(path)
+        return info[0] if info is not None else None
+
+    def rewrite(self, dsl):
+        """
+        Return the composed DSL object `dsl` (a query clause or a search
+        body with a "query" key) with its leaf queries rewritten for the
+        field types. The input is never modified.
+        """
+        if isinstance(dsl, dict) and 'query' in dsl and len(dsl) == 1:
+            return { 'query': self._rewrite(dsl['query']) }
+        return self._rewrite(dsl)
+
+    def _rewrite(self, q):
+        if not isinstance(q, dict) or len(q) != 1:
+            return q
+
+        (kind, body), = q.items()
+
+        if kind == 'bool':
+            return { 'bool': dict([ (occur, [ self._rewrite(c) for c in v ] if isinstance(v, list) else self._rewrite(v)) for occur, v in body.items() ]) }
+
+        if not isinstance(body, dict) or len(body) != 1:
+            return q
+
+        (field, spec), = body.items()
+
+        info = self._kinds.get(field)
+        if info is None:
+            return q
+        field_kind, keyword = info
+
+        if field_kind == _TEXT:
+            if kind == 'term':
+                v = spec['value']
+                if isinstance(v, str) and len(v.split(None, 1)) > 1:
+                    return { 'match_phrase': { field: { 'query': v } } }
+                return { 'match': { field: { 'query': v } } }
+            if keyword is not None and (kind == 'range' or kind in _PATTERNS):
+                return { kind: { keyword: spec } }
+
+        elif field_kind == _NUMERIC:
+            if kind in _PATTERNS:
+                return { 'match_none': {} }
+            if kind == 'term' or kind == 'range':
+                return self._numbers(kind, field, spec)
+
+        elif field_kind == _NOT_PATTERN:
+            if kind in _PATTERNS:
+                return { 'match_none': {} }
+
+        return q
+
+    def _numbers(self, kind, field, spec):
+        """
+        The query with the string values of `spec` converted to numbers
+        """
+        spec = dict(spec)
+        for key, v in spec.items():
+            if key in ('value', 'lt', 'lte', 'gt', 'gte') and isinstance(v, str):
+                n = _as_number(v)
+                if n is None:
+                    return { 'match_none': {} }
+                spec[key] = n
+        return { kind: { field: spec } }
+
+def load_mapping(mapping):
+    """
+    Return the Mapping of `mapping`: a dict or the path of a JSON file
+    """
+    if isinstance(mapping, dict):
+        return Mapping(mapping)
+    with open(mapping, encoding='utf-8') as fp:
+        return Mapping(json.load(fp))
@@ -0,0 +1,281 @@
+#----------------------------------------------------------------------#
+# BOOL TREE OPTIMIZER                                                  #
+#----------------------------------------------------------------------#
+#
+# Rewrites a composed DSL object into an equivalent one (same matching
+# documents) with fewer bool levels and clauses:
+#
+#   - a bool clause is lifted into its parent when it only has clauses
+#     of the same kind: must in must, filter in filter, should in should,
+#     and should in must_not (NOT (a OR b) == NOT a AND NOT b)
+#
+#   - sibling `term` (and `terms`) clauses on the same field are merged
+#     into a single `terms` query in should and must_not lists
+#
+#   - a bool with a single must (or should) clause is replaced by the
+#     clause itself
+#
+# The input is never modified: unchanged subtrees are shared with it.
+#
+
+OCCURS = ('must', 'filter', 'should', 'must_not')
+
+#
+# Clauses of a child bool that can be lifted in each occurrence of its
+# parent
+#
+_LIFT = {
+    'must'    : 'must',
+    'filter'  : 'filter',
+    'should'  : 'should',
+    'must_not': 'should',
+}
+
+def _as_list(v):
+    return v if isinstance(v, list) else [ v ]
+
+def _only(q, occur):
+    """
+    The clauses of `q` if it is a bool with `occur` clauses only
+    """
+    if len(q) == 1 and 'bool' in q:
+        b = q['bool']
+        if len(b) == 1 and occur in b:
+            return _as_list(b[occur])
+    return None
+
+def _term(q):
+    """
+    (field, values) of a plain term or terms query
+    """
+    if len(q) != 1:
+        return None
+
+    if 'term' in q:
+        t = q['term']
+        if len(t) == 1:
+            (field, spec), = t.items()
+            if isinstance(spec, dict) and len(spec) == 1 and 'value' in spec:
+                return field, [ spec['value'] ]
+
+    elif 'terms' in q:
+        t = q['terms']
+        if len(t) == 1:
+            (field, values), = t.items()
+            if isinstance(values, list):
+                return field, values
+
+    return None
+
+def _merge_terms(clauses):
+    """
+    Merge term(s) clauses on the same field into terms queries, at the
+    place of the first one
+    """
+    by_field = {}
+    for q in clauses:
+        t = _term(q)
+        if t is not None:
+            by_field.setdefault(t[0], []).append(t[1])
+
+    if all([ len(values) == 1 for values in by_field.values() ]):
+        return clauses
+
+    merged = []
+    done = set()
+    for q in clauses:
+        t = _term(q)
+        if t is None:
+            merged.append(q)
+            continue
+
+        field = t[0]
+        values = by_field[field]
+        if len(values) == 1:
+            merged.append(q)
+        elif field not in done:
+            done.add(field)
+            merged.append({ 'terms': { field: [ v for vs in values for v in vs ] } })
+
+    return merged
+
+def _optimize_bool(b):
+
+    if any([ k not in OCCURS for k in b ]):
+        #
+        # minimum_should_match, boost...: only the children are optimized
+        #
+        return { 'bool': dict([ (k, [ _optimize(c) for c in _as_list(v) ] if k in OCCURS else v) for k, v in b.items() ]) }
+
+    occurs = {}
+    for occur, v in b.items():
+        lift = _LIFT[occur]
+
+        clauses = []
+        for c in _as_list(v):
+            c = _optimize(c)
+            inner = _only(c, lift)
+            if inner is not None:
+                clauses.extend(inner)
+            else:
+                clauses.append(c)
+
+        if occur in ('should', 'must_not'):
+            clauses = _merge_terms(clauses)
+
+        occurs[occur] = clauses
+
+    if len(occurs) == 1:
+        (occur, clauses), = occurs.items()
+        if len(clauses) == 1 and occur in ('must', 'should'):
+            return clauses[0]
+
+    return {
+        'bool': dict([ (occur, clauses if len(clauses) > 1 else clauses[0]) for occur, clauses in occurs.items() ])
+    }
+
+def _optimize(q):
+    if isinstance(q, dict) and len(q) == 1 and isinstance(q.get('bool'), dict):
+        return _optimize_bool(q['bool'])
+    return q
+
+def optimize(dsl):
+    """
+    Return the optimized form of a composed DSL object: either a query
+    clause or a search body with a "query" key
+    """
+    if isinstance(dsl, dict) and 'query' in dsl and len(dsl) == 1:
+        return { 'query': _optimize(dsl['query']) }
+    return _optimize(dsl)
+
+#----------------------------------------------------------------------#
+# FILTER CONTEXT                                                       #
+#----------------------------------------------------------------------#
+#
+# Clauses in filter context are not scored and Elasticsearch can cache
+# them in the node query cache. Compose modes:
+#
+#   query   everything is in query context (the default)
+#
+#   filter  nothing is scored: every `must` clause becomes a `filter`
+#           clause and the query is wrapped in `constant_score`
+#
+#   auto    only matches on the default field are scored: the other
+#           `must` clauses (field matches, ranges) are moved to `filter`,
+#           and when nothing is left to score the query is wrapped in
+#           `constant_score`
+#
+# `must_not` clauses are always in filter context, `should` clauses stay
+# where they are (a `filter` clause is required, a `should` one is not).
+#
+
+MODES = ('query', 'filter', 'auto')
+
+_LEAF_QUERIES = ('term', 'terms', 'prefix', 'wildcard', 'regexp', 'match', 'match_phrase')
+
+def _scores(q, field_name):
+    """
+    True when `q` has a clause to score: a match on the default field out
+    of a must_not clause
+    """
+    if len(q) == 1 and isinstance(q.get('bool'), dict):
+        b = q['bool']
+        return any([ _scores(c, field_name) for occur in ('must', 'should') for c in _as_list(b.get(occur, [])) ])
+
+    for kind in _LEAF_QUERIES:
+        if kind in q:
+            return any([ field is field_name or field == field_name for field in q[kind] ])
+
+    return False
+
+def _filter(q):
+    """
+    `q` in filter context: must clauses become filter clauses
+    """
+    if not (len(q) == 1 and isinstance(q.get('bool'), dict)):
+        return q
+
+    b = {}
+    for occur, v in q['bool'].items():
+        if occur not in OCCURS:
+            b[occur] = v
+            continue
+
+        clauses = [ _filter(c) for c in _as_list(v) ]
+        if occur == 'must':
+            occur = 'filter'
+            clauses = _as_list(b.get('filter', [])) + clauses
+        elif occur == 'filter' and 'filter' in b:
+            clauses = _as_list(b['filter']) + clauses
+
+        b[occur] = clauses if len(clauses) > 1 else clauses[0]
+
+    #
+    # Without must/filter clauses a single should clause is required
+    #
+    if 'filter' not in b and 'minimum_should_match' not in b and isinstance(b.get('should'), dict):
+        b['filter'] = b.pop('should')
+
+    return { 'bool': b }
+
+def _auto(q, field_name):
+    """
+    `q` in query context with the must clauses that do not score moved to
+    filter
+    """
+    if not (len(q) == 1 and isinstance(q.get('bool'), dict)):
+        return q
+
+    b = q['bool']
+
+    must    = []
+    filters = []
+    for c in _as_list(b.get('must', [])):
+        if _scores(c, field_name):
+            must.append( _auto(c, field_name) )
+        else:
+            filters.append( _filter(c) )
+    filters += [ _filter(c) for c in _as_list(b.get('filter', [])) ]
+
+    nb = {}
+    for occur, v in b.items():
+        if occur == 'should':
+            v = [ _auto(c, field_name) for c in _as_list(v) ]
+        elif occur == 'must_not':
+            v = [ _filter(c) for c in _as_list(v) ]
+        elif occur in ('must', 'filter'):
+            if must and 'must' not in nb:
+                nb['must'] = must if len(must) > 1 else must[0]
+            if filters and 'filter' not in nb:
+                nb['filter'] = filters if len(filters) > 1 else filters[0]
+            continue
+        else:
+            nb[occur] = v
+            continue
+        nb[occur] = v if len(v) > 1 else v[0]
+
+    return { 'bool': nb }
+
+def _constant_score(q):
+    return { 'constant_score': { 'filter': _filter(q) } }
+
+def set_context(dsl, mode, field_name):
+    """
+    Return the composed DSL object `dsl` with its clauses in the filter or
+    query context according to `mode` (see MODES)
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown compose mode %r (expected one of %s)" % (mode, ', '.join(MODES)))
+
+    if mode == 'query':
+        return dsl
+
+    body = isinstance(dsl, dict) and 'query' in dsl and len(dsl) == 1
+    q = dsl['query'] if body else dsl
+
+    if mode == 'filter' or not _scores(q, field_name):
+        q = _constant_score(q)
+    else:
+        q = _auto(q, field_name)
+
+    return { 'query': q } if body else q
@@ -0,0 +1,217 @@
+import collections
+import threading
+
+from . import Parser, Query
+
+from .evaluate import _TERM, _TEST, _plan, _match
+
+#----------------------------------------------------------------------#
+# PERCOLATOR                                                           #
+#----------------------------------------------------------------------#
+#
+# Matches documents against many stored queries. Every query is indexed
+# by the (field, value) terms a document must contain to match it: a
+# disjunction taken from the evaluation plan of the query (see
+# yaesql.evaluate),
+#
+#   term            its values
+#   must clauses    the requirement of one of them: the one with the
+#                   fewest candidates, counting the queries already
+#                   indexed by its terms
+#   should clauses  (when required) the union of the requirements of
+#                   all of them
+#
+# A query with no such requirement (only negations, regular expressions
+# or ranges somewhere on the way) can not be indexed: it is a candidate
+# for every document.
+#
+# The candidates of a document are the queries indexed by one of its
+# (field, value) pairs plus the not indexed ones; only those are
+# evaluated.
+#
+
+Percolation = collections.namedtuple('Percolation', 'ids candidates')
+
+QuerySetInfo = collections.namedtuple('QuerySetInfo', 'queries indexed scanned documents candidates matches')
+
+def _required(node, cost):
+    """
+    The (field, value) terms of which a document must contain one to
+    match the plan `node`, None if there are none. `cost(terms)` ranks
+    the alternatives of must clauses
+    """
+    op = node[0]
+
+    if op == _TERM:
+        field = node[1]
+        return [ (field, k) for k in node[2] ]
+
+    if op == _TEST:
+        return None
+
+    must, must_not, should = node[1:]
+
+    best = None
+    for c in must:
+        r = _required(c, cost)
+        if r is not None:
+            k = cost(r)
+            if best is None or k < best_cost:
+                best, best_cost = r, k
+    if best is not None or must or not should:
+        return best
+
+    terms = []
+    for c in should:
+        r = _required(c, cost)
+        if r is None:
+            return None
+        terms.extend(r)
+    return terms
+
+def _pairs(doc):
+    for field, v in doc.items():
+        if v is None:
+            continue
+        if isinstance(v, (list, tuple)):
+            for x in v:
+                yield field, x
+        else:
+            yield field, v
+
+class QuerySet(object):
+    """
+    A set of queries, by id, matched together against documents (dicts)
+    on the default field `field_name`.
+
+    Query strings are parsed with `parser` (a fast engine Parser by
+    default). Queries can be added and removed at any time; the methods
+    are thread safe.
+    """
+
+    def __init__(self, field_name, queries=None, parser=None):
+        self.field_name = field_name
+        self.parser     = parser or Parser(engine='fast')
+
+        self.queries = {}
+        self.index   = {}
+        self.scan    = set()
+
+        self.seq = 0
+
+        self.documents  = 0
+        self.candidates = 0
+        self.matches    = 0
+
+        self.lock = threading.Lock()
+
+        if queries is not None:
+            items = queries.items() if isinstance(queries, dict) else queries
+            for query_id, query in items:
+                self.add(query_id, query)
+
+    def add(self, query_id, query):
+        """
+        Add (or replace) the query `query_id`: a query string or a Query
+        """
+        if not isinstance(query, Query):
+            query = self.parser.parseString(query)
+
+        plan = _plan(query, self.field_name)
+
+        with self.lock:
+            self._remove(query_id)
+
+            terms = _required(plan, self._cost)
+            if terms is not None:
+                terms = list(dict.fromkeys(terms))
+
+            self.seq += 1
+            self.queries[query_id] = (self.seq, query, plan, terms)
+
+            if terms is None:
+                self.scan.add(query_id)
+            else:
+                for t in terms:
+                    ids = self.index.get(t)
+                    if ids is None:
+                        ids = self.index[t] = set()
+                    ids.add(query_id)
+
+    def _cost(self, terms):
+        # queries already indexed by the terms, one more per term
+        index = self.index
+        return sum([ len(index.get(t, ())) + 1 for t in terms ])
+
+    def remove(self, query_id):
+        """
+        Remove the query `query_id`, raise KeyError if there is none
+        """
+        with self.lock:
+            if not self._remove(query_id):
+                raise KeyError(query_id)
+
+    def _remove(self, query_id):
+        entry = self.queries.pop(query_id, None)
+        if entry is None:
+            return False
+
+        terms = entry[3]
+        if terms is None:
+            self.scan.discard(query_id)
+        else:
+            for t in terms:
+                ids = self.index[t]
+                ids.discard(query_id)
+                if not ids:
+                    del self.index[t]
+        return True
+
+    def percolate(self, doc):
+        """
+        Return the Percolation of the document `doc`: the ids of the
+        matching queries, in the order they were added, and the number
+        of candidate queries evaluated
+        """
+        with self.lock:
+            index = self.index
+
+            candidates = set(self.scan)
+            for pair in _pairs(doc):
+                try:
+                    ids = index.get(pair)
+                except TypeError:
+                    # unhashable value
+                    continue
+                if ids:
+                    candidates.update(ids)
+
+            queries = self.queries
+            entries = [ (i, queries[i]) for i in candidates ]
+
+        # the entries are never modified: they are evaluated out of the lock
+        matched = [ (e[0], i) for i, e in entries if _match(e[2], doc) ]
+        matched.sort()
+
+        with self.lock:
+            self.documents  += 1
+            self.candidates += len(entries)
+            self.matches    += len(matched)
+
+        return Percolation([ i for seq, i in matched ], len(entries))
+
+    def match(self, doc):
+        """
+        Ids of the queries matching the document `doc`
+        """
+        return self.percolate(doc).ids
+
+    def info(self):
+        with self.lock:
+            return QuerySetInfo(len(self.queries), len(self.queries) - len(self.scan), len(self.scan), self.documents, self.candidates, self.matches)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __contains__(self, query_id):
+        return query_id in self.queries
@@ -0,0 +1,94 @@
+#----------------------------------------------------------------------#
+# REGULAR EXPRESSION ANALYSIS                                          #
+#----------------------------------------------------------------------#
+#
+# `regexp` queries are expensive: every term of the field is matched
+# against an automaton. Many regular expressions typed by the users are
+# simpler than that and have a cheaper equivalent query:
+#
+#   r"error"        -> term     error
+#   r"err.*"        -> prefix   err
+#   r"e.r.*or"      -> wildcard e?r*or
+#
+# The expressions follow the Lucene syntax used by Elasticsearch with all
+# the optional operators enabled. An expression is anchored at both ends
+# and matches whole terms, like the term, prefix and wildcard queries.
+#
+
+#
+# Characters with a special meaning in a Lucene regular expression
+#
+_SPECIAL = frozenset('.?+*|{}[]()"\\#@&<>~')
+
+#
+# Characters with a special meaning in a wildcard pattern
+#
+_WILDCARD_SPECIAL = frozenset('*?\\')
+
+#
+# Escaped letters and digits may not stand for themselves: `\d` `\s` `\w`
+# `\D` `\S` `\W` are character classes (Elasticsearch 7.9+). Only escaped
+# punctuation is a literal character
+#
+_ESCAPED_CLASSES = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+def _tokens(pattern):
+    """
+    Split `pattern` into (is_literal, text) tokens: literal characters,
+    `.` and `.*`. Return None if the pattern uses any other operator.
+    """
+    tokens = []
+
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+
+        if c == '\\':
+            if i + 1 == n:
+                return None
+            if pattern[i+1] in _ESCAPED_CLASSES:
+                return None
+            tokens.append( (True, pattern[i+1]) )
+            i += 2
+
+        elif c == '.':
+            if pattern.startswith('*', i+1):
+                tokens.append( (False, '*') )
+                i += 2
+            else:
+                tokens.append( (False, '?') )
+                i += 1
+
+        elif c in _SPECIAL:
+            return None
+
+        else:
+            tokens.append( (True, c) )
+            i += 1
+
+    return tokens
+
+def analyze(pattern):
+    """
+    Return the cheapest query equivalent to the regular expression
+    `pattern` as a (query type, value) pair: ('term', ...), ('prefix', ...),
+    ('wildcard', ...) or ('regexp', pattern) when there is none.
+    """
+    tokens = _tokens(pattern)
+    if not tokens:
+        return 'regexp', pattern
+
+    if all([ lit for lit, text in tokens ]):
+        return 'term', ''.join([ text for lit, text in tokens ])
+
+    if tokens[-1] == (False, '*') and all([ lit for lit, text in tokens[:-1] ]) and len(tokens) > 1:
+        return 'prefix', ''.join([ text for lit, text in tokens[:-1] ])
+
+    #
+    # Escaped wildcard characters are left to the regexp query
+    #
+    if any([ lit and text in _WILDCARD_SPECIAL for lit, text in tokens ]):
+        return 'regexp', pattern
+
+    return 'wildcard', ''.join([ text for lit, text in tokens ])
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sys
+
+import pyparsing as pp
+
+from . import (
+    _intern,
+    StringLiteral, NumberLiteral, DateLiteral, RegExLiteral, Placeholder, SimpleTerm, ComplexTerm, CompareValue,
+    MultiValue, BoolMust, BoolMustNot, NotExpr, AndExpr, OrExpr, Query,
+)
+
+#----------------------------------------------------------------------#
+# SERIALIZATION                                                        #
+#----------------------------------------------------------------------#
+#
+# A parsed tree is serialized as a JSON object:
+#
+#   {"yaesql": <format version>, "nodes": [ <node>, ... ]}
+#
+# with the nodes in post-order (children first, the root last). A node is
+# a list: its tag, its values and the indexes of its children in "nodes",
+#
+#   ["S", val]                          StringLiteral
+#   ["N", val]                          NumberLiteral
+#   ["D", val, format, time_zone]       DateLiteral
+#   ["R", val, query type, query value] RegExLiteral (as composed)
+#   ["P", name]                         Placeholder
+#   ["T", expr]                         SimpleTerm
+#   ["F", field, expr]                  ComplexTerm
+#   ["C", op, expr]                     CompareValue
+#   ["V", expr, ...]                    MultiValue
+#   ["+", expr] ["-", expr] ["!", expr] BoolMust, BoolMustNot, NotExpr
+#   ["&", expr, ...] ["|", expr, ...]   AndExpr, OrExpr
+#   ["Q", expr, ...]                    Query
+#
+# Both ways are loops over the nodes, so the depth of a tree is not
+# bounded by the interpreter stack. Loading a tree runs no grammar and no
+# regular expression analysis: it only builds the nodes.
+#
+
+FORMAT_VERSION = 1
+
+_ENCODERS = {
+    StringLiteral : lambda n: ('S', (n.val,), ()),
+    NumberLiteral : lambda n: ('N', (n.val,), ()),
+    DateLiteral   : lambda n: ('D', (n.val, n.format, n.time_zone), ()),
+    RegExLiteral  : lambda n: ('R', (n.val,) + tuple(n.query), ()),
+    Placeholder   : lambda n: ('P', (n.val,), ()),
+    SimpleTerm    : lambda n: ('T', (), (n.expr,)),
+    ComplexTerm   : lambda n: ('F', (n.field_expr,), (n.value_expr,)),
+    CompareValue  : lambda n: ('C', (n.type,), (n.expr,)),
+    MultiValue    : lambda n: ('V', (), n.exprs),
+    BoolMust      : lambda n: ('+', (), (n.expr,)),
+    BoolMustNot   : lambda n: ('-', (), (n.expr,)),
+    NotExpr       : lambda n: ('!', (), (n.expr,)),
+    AndExpr       : lambda n: ('&', (), n.exprs),
+    OrExpr        : lambda n: ('|', (), n.exprs),
+    Query         : lambda n: ('Q', (), n.exprs),
+}
+
+def _regex(val, kind, value):
+    e = RegExLiteral(val, rewrite=False)
+    e.query = (_intern(kind), _intern(value))
+    return e
+
+_DECODERS = {
+    'S': lambda r, b: StringLiteral(r[1]),
+    'N': lambda r, b: NumberLiteral(r[1]),
+    'D': lambda r, b: DateLiteral(r[1], r[2], r[3]),
+    'R': lambda r, b: _regex(r[1], r[2], r[3]),
+    'P': lambda r, b: Placeholder(r[1]),
+    'T': lambda r, b: SimpleTerm(b[r[1]]),
+    'F': lambda r, b: ComplexTerm(r[1], b[r[2]]),
+    'C': lambda r, b: CompareValue( (r[1], b[r[2]]) ),
+    'V': lambda r, b: MultiValue([ b[i] for i in r[1:] ]),
+    '+': lambda r, b: BoolMust(b[r[1]]),
+    '-': lambda r, b: BoolMustNot(b[r[1]]),
+    '!': lambda r, b: NotExpr(b[r[1]]),
+    '&': lambda r, b: AndExpr([ b[i] for i in r[1:] ]),
+    '|': lambda r, b: OrExpr([ b[i] for i in r[1:] ]),
+    'Q': lambda r, b: Query([ b[i] for i in r[1:] ]),
+}
+
+def to_data(node):
+    """
+    The serialized form of the tree under `node` as a JSON compatible
+    dict. Raise TypeError for nodes of other classes (custom factories)
+    """
+    order = []
+    stack = [ node ]
+    while stack:
+        n = stack.pop()
+        encode = _ENCODERS.get(type(n))
+        if encode is None:
+            raise TypeError("Can not serialize %s nodes" % (type(n).__name__,))
+        tag, values, children = encode(n)
+        order.append( (n, tag, values, children) )
+        stack.extend(children)
+
+    # every node comes before its descendants in `order`
+    index = {}
+    nodes = []
+    for n, tag, values, children in reversed(order):
+        index[id(n)] = len(nodes)
+        nodes.append( [ tag ] + list(values) + [ index[id(c)] for c in children ] )
+
+    return { 'yaesql': FORMAT_VERSION, 'nodes': nodes }
+
+def from_data(data):
+    """
+    The tree serialized in `data` (see to_data()). Raise ValueError if
+    it is not a serialized tree of this format version
+    """
+    if not isinstance(data, dict) or data.get('yaesql') != FORMAT_VERSION:
+        raise ValueError("Not a serialized query of format version %d" % (FORMAT_VERSION,))
+
+    built = []
+    try:
+        for r in data['nodes']:
+            built.append( _DECODERS[r[0]](r, built) )
+        return built[-1]
+    except (KeyError, IndexError, TypeError) as e:
+        raise ValueError("Invalid serialized query: %s: %s" % (type(e).__name__, e)) from None
+
+def dumps(node):
+    """
+    Serialize the tree under `node` to compact JSON text (ASCII only)
+    """
+    return json.dumps(to_data(node), separators=(',', ':'))
+
+def loads(text):
+    """
+    Load a tree serialized by dumps() (a str or UTF-8 bytes)
+    """
+    return from_data(json.loads(text))
+
+#----------------------------------------------------------------------#
+# GRAMMAR VERSION                                                      #
+#----------------------------------------------------------------------#
+
+_grammar_version = None
+
+def grammar_version():
+    """
+    A hash of the sources building the parsed trees (grammars, node
+    classes and this module) and of the pyparsing version: stored trees
+    are valid for the same version only
+    """
+    global _grammar_version
+    if _grammar_version is None:
+        from . import fastparser, regex
+
+        h = hashlib.blake2b(digest_size=8)
+        h.update(b'%d' % (FORMAT_VERSION,))
+        h.update(pp.__version__.encode('utf-8'))
+        for module in (sys.modules['yaesql'], fastparser, regex, sys.modules[__name__]):
+            with open(module.__file__, 'rb') as fp:
+                h.update(fp.read())
+        _grammar_version = h.hexdigest()
+    return _grammar_version
@@ -0,0 +1,130 @@
+import collections
+import threading
+import weakref
+
+from . import SimpleTerm, ComplexTerm, MultiValue, AndExpr, OrExpr, Query
+
+from .serialize import _ENCODERS
+
+#----------------------------------------------------------------------#
+# SHARED NODES                                                         #
+#----------------------------------------------------------------------#
+#
+# Hash-consing of parsed trees: a NodeTable maps the structure of every
+# node it has seen, (class, values, children), to the node. Trees are
+# interned bottom-up, so the children of a node are already the shared
+# ones and its structure is a tuple of its values and of the identities
+# of its children. A node with the structure of a node in the table is
+# replaced by it in its parent.
+#
+# A node holding a value seen for the first time can not be in the table
+# either: it is not entered, and subtrees are shared from their second
+# occurrence on. So the branches of a query leading to its unique values
+# (ids, timestamps...) cost no table entry.
+#
+# The table holds its nodes weakly: a node is dropped from it when no
+# query uses it any more.
+#
+# The root Query of a tree is never shared (its is_sub flag tells it is
+# a root). Term nodes (SimpleTerm and ComplexTerm) get a memo once they
+# are shared, and memoize their DSL the first time they are composed for
+# a default field: every later compose() for that field, from any query,
+# returns the same DSL objects, which must never be modified. Nodes of
+# other classes than the parser ones are left as they are.
+#
+
+NodeTableInfo = collections.namedtuple('NodeTableInfo', 'hits misses currsize')
+
+_MEMOIZED = (SimpleTerm, ComplexTerm)
+
+def _set_children(node, children):
+    if isinstance(node, ComplexTerm):
+        node.value_expr = children[0]
+    elif isinstance(node, (MultiValue, AndExpr, OrExpr, Query)):
+        node.exprs = tuple(children)
+    else:
+        node.expr = children[0]
+
+class NodeTable(object):
+    """
+    Thread safe table of the nodes shared between the trees it interns
+    """
+
+    def __init__(self):
+        self.nodes = weakref.WeakValueDictionary()
+        self.lock  = threading.Lock()
+
+        self.hits   = 0
+        self.misses = 0
+
+    def intern(self, query):
+        """
+        Replace the subtrees of `query` with the identical shared ones and
+        return it. The tree is modified in place: it must not be in use
+        yet (e.g. just parsed)
+        """
+        order = []
+        stack = [ query ]
+        while stack:
+            n = stack.pop()
+            encode = _ENCODERS.get(type(n))
+            if encode is None:
+                continue
+            tag, values, children = encode(n)
+            order.append( (n, tag, values, children) )
+            stack.extend(children)
+
+        shared = {}
+        fresh  = set()
+
+        with self.lock:
+            nodes = self.nodes
+
+            # every node comes before its descendants in `order`
+            for n, tag, values, children in reversed(order):
+                if children:
+                    new = [ shared.get(id(c), c) for c in children ]
+                    for c, s in zip(children, new):
+                        if c is not s:
+                            _set_children(n, new)
+                            break
+                    children = tuple(new)
+
+                if isinstance(n, Query) and not n.is_sub:
+                    continue
+
+                if any([ id(c) in fresh for c in children ]):
+                    fresh.add(id(n))
+                    self.misses += 1
+                    continue
+
+                # 1 and 1.0 are equal, but not the same value
+                key = (tag,) + values + tuple([ type(v) for v in values ]) + children
+
+                s = nodes.get(key)
+                if s is None:
+                    nodes[key] = n
+                    if not children:
+                        # a new value
+                        fresh.add(id(n))
+                    self.misses += 1
+                    continue
+
+                shared[id(n)] = s
+                self.hits += 1
+
+                if isinstance(s, _MEMOIZED) and s._composed is None:
+                    s._composed = {}
+
+        return shared.get(id(query), query)
+
+    def info(self):
+        with self.lock:
+            return NodeTableInfo(self.hits, self.misses, len(self.nodes))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __reduce__(self):
+        # a copy (e.g. sent to a worker process) starts empty
+        return (NodeTable, ())